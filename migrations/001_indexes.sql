@@ -0,0 +1,74 @@
+--
+-- 001_indexes.sql
+--
+-- Adds the indexes used by the bookings, actions and cleaner queries
+-- and the table that keeps track of the applied migrations
+--
+-- Indexes are only added when missing (MySQL has no 'add index if not
+-- exists'), so the script can be run again after a partial failure: DDL
+-- statements commit on their own.
+--
+-- InnoDB created an index of its own for each foreign key of the older
+-- databases. Those made redundant by the new indexes (left prefixes of
+-- them) are dropped once the new index can serve the foreign key, so
+-- that migrated and fresh databases end up with the same indexes.
+--
+-- Apply it with sgfs_migrate.py or by hand:
+--  mysql -u sgfs_user -p sgfs < migrations/001_indexes.sql
+--
+-- Author: Riccardo Bruno (riccardo.bruno@ct.infn.it)
+--
+create table if not exists sgfs_schema_version (
+	 version          int unsigned not null
+	,version_ts       datetime not null
+	,version_desc     varchar(256)
+
+	,primary key (version)
+);
+
+--
+-- getBookings/closeBookings: transactions of the same (user,application)
+--
+set @sql=(select if(count(*)=0,'alter table sgfs_transactions add index sgfs_transactions_user_app (user_id,app_id)','do 0') from information_schema.statistics where table_schema=database() and table_name='sgfs_transactions' and index_name='sgfs_transactions_user_app');
+prepare sgfs_stmt from @sql;
+execute sgfs_stmt;
+deallocate prepare sgfs_stmt;
+set @sql=(select ifnull(concat('alter table sgfs_transactions ',group_concat(concat('drop index `',index_name,'`'))),'do 0') from (select index_name,group_concat(column_name order by seq_in_index) as index_columns from information_schema.statistics where table_schema=database() and table_name='sgfs_transactions' and non_unique=1 group by index_name) as i where index_columns in ('user_id','user_id,app_id') and index_name not in ('sgfs_transactions_user_app'));
+prepare sgfs_stmt from @sql;
+execute sgfs_stmt;
+deallocate prepare sgfs_stmt;
+--
+-- sgfs_cleaner: transactions older than the cutoff date
+--
+set @sql=(select if(count(*)=0,'alter table sgfs_transactions add index sgfs_transactions_from (transaction_from)','do 0') from information_schema.statistics where table_schema=database() and table_name='sgfs_transactions' and index_name='sgfs_transactions_from');
+prepare sgfs_stmt from @sql;
+execute sgfs_stmt;
+deallocate prepare sgfs_stmt;
+--
+-- getActionFiles and bookings joins: actions of a transaction by type
+--
+set @sql=(select if(count(*)=0,'alter table sgfs_actions add index sgfs_actions_transaction (transaction_id,action)','do 0') from information_schema.statistics where table_schema=database() and table_name='sgfs_actions' and index_name='sgfs_actions_transaction');
+prepare sgfs_stmt from @sql;
+execute sgfs_stmt;
+deallocate prepare sgfs_stmt;
+set @sql=(select ifnull(concat('alter table sgfs_actions ',group_concat(concat('drop index `',index_name,'`'))),'do 0') from (select index_name,group_concat(column_name order by seq_in_index) as index_columns from information_schema.statistics where table_schema=database() and table_name='sgfs_actions' and non_unique=1 group by index_name) as i where index_columns in ('transaction_id','transaction_id,action') and index_name not in ('sgfs_actions_transaction'));
+prepare sgfs_stmt from @sql;
+execute sgfs_stmt;
+deallocate prepare sgfs_stmt;
+--
+-- getBookings/closeBookings: bookings of a transaction and of an action
+--
+set @sql=(select if(count(*)=0,'alter table sgfs_bookings add index sgfs_bookings_transaction (transaction_id,action_id)','do 0') from information_schema.statistics where table_schema=database() and table_name='sgfs_bookings' and index_name='sgfs_bookings_transaction');
+prepare sgfs_stmt from @sql;
+execute sgfs_stmt;
+deallocate prepare sgfs_stmt;
+set @sql=(select if(count(*)=0,'alter table sgfs_bookings add index sgfs_bookings_action (action_id)','do 0') from information_schema.statistics where table_schema=database() and table_name='sgfs_bookings' and index_name='sgfs_bookings_action');
+prepare sgfs_stmt from @sql;
+execute sgfs_stmt;
+deallocate prepare sgfs_stmt;
+set @sql=(select ifnull(concat('alter table sgfs_bookings ',group_concat(concat('drop index `',index_name,'`'))),'do 0') from (select index_name,group_concat(column_name order by seq_in_index) as index_columns from information_schema.statistics where table_schema=database() and table_name='sgfs_bookings' and non_unique=1 group by index_name) as i where index_columns in ('transaction_id','transaction_id,action_id','action_id') and index_name not in ('sgfs_bookings_transaction','sgfs_bookings_action'));
+prepare sgfs_stmt from @sql;
+execute sgfs_stmt;
+deallocate prepare sgfs_stmt;
+
+insert ignore into sgfs_schema_version (version,version_ts,version_desc) values (1,now(),'Indexes for bookings, actions and cleaner queries');
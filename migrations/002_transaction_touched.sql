@@ -0,0 +1,21 @@
+--
+-- 002_transaction_touched.sql
+--
+-- Adds the time of the last request of each transaction, written by the
+-- reaper of every server process, so that a transaction still used
+-- through another process is not closed as idle
+--
+-- The column is only added when missing, so the script can be run again
+-- after a partial failure.
+--
+-- Apply it with sgfs_migrate.py or by hand:
+--  mysql -u sgfs_user -p sgfs < migrations/002_transaction_touched.sql
+--
+-- Author: Riccardo Bruno (riccardo.bruno@ct.infn.it)
+--
+set @sql=(select if(count(*)=0,'alter table sgfs_transactions add column transaction_touched datetime after transaction_to','do 0') from information_schema.columns where table_schema=database() and table_name='sgfs_transactions' and column_name='transaction_touched');
+prepare sgfs_stmt from @sql;
+execute sgfs_stmt;
+deallocate prepare sgfs_stmt;
+
+insert ignore into sgfs_schema_version (version,version_ts,version_desc) values (2,now(),'Last request of the open transactions');
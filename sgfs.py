@@ -41,26 +41,137 @@ __status__     = "Development"
 
 
 import os
+import re
 import sys
+import stat
+import errno
+import fcntl
+import select
+import socket
+import asyncore
+import uuid
+import hashlib
+import pipes
+import fnmatch
+import itertools
+import bisect
+import heapq
+import inspect
+import shutil
+import urlparse
+import urllib
+import StringIO
+import time
+import calendar
 import signal
+import atexit
+import ctypes
+import ctypes.util
 import cherrypy
 import MySQLdb
 import tempfile
+import threading
+import Queue
+import multiprocessing
 import simplejson as json
+from collections import OrderedDict, deque
 import gfalthr
+try:
+	import lfc as lfcapi
+except ImportError:
+	lfcapi = None
 from subprocess import Popen, PIPE, STDOUT
-from cherrypy.lib.static import serve_file
+try:
+	from cherrypy.lib.httputil import get_ranges
+except ImportError:
+	from cherrypy.lib.http import get_ranges
 from xml.dom.minidom import Document
+from xml.sax.saxutils import escape, quoteattr
 
 ##
 ## Some global stuff... (maybe config in the future)
 ##
 SGFS_Host=os.getenv('HOSTNAME')
 SGFS_Port=8088
+SGFS_DBPoolSize=16   # Max number of MySQL connections of the requests of each server process
+SGFS_DBBackgroundPoolSize=4 # Max number of MySQL connections of the background threads (reaper, action log, bookings)
+SGFS_DBPoolTimeout=10 # Seconds a request waits for a MySQL connection before a 503
+SGFS_RefCacheTTL=600 # Seconds before users/applications/infrastructures are reloaded
+SGFS_RefMissTTL=10   # Seconds unknown names are not looked up again (no reload)
+SGFS_LFCCacheSize=1024 # Max number of transactions whose LFC context is kept in memory
+SGFS_LFCCacheTTL=3600  # Seconds an LFC context may stay cached (transactions removed by the cleaner)
+SGFS_ProxyDir=os.path.join(tempfile.gettempdir(),'sgfs_proxies') # Shared proxy files
+SGFS_ProxyRenewalMargin=1800 # Seconds before expiry a shared proxy is renewed
+SGFS_ProxyRetryDelay=60      # Seconds between failed proxy renewal attempts
+SGFS_ProxyFetchTimeout=30    # Seconds to wait for the eToken server
+SGFS_LFCBackend='native'     # Catalog access: 'native' (lfc python API, if installed), 'cli' or 'fake'
+SGFS_ListCacheTTL=30         # Seconds a directory listing is served from memory
+SGFS_ListCacheSize=100000    # Max number of file entries kept by the listing cache
+SGFS_StreamChunkSize=16*1024 # Bytes of a streamed answer collected before sending them
+SGFS_CmdTimeout=300          # Seconds a foreground command may run before being killed
+SGFS_CmdQueueTimeout=60      # Seconds to wait for a free slot of the command type
+SGFS_CmdPollInterval=1.0     # Seconds between child process checks (without SIGCHLD)
+SGFS_CmdLineBuffer=1024      # Output lines read ahead of a slow consumer
+SGFS_GfalMinChunk=256*1024     # Bytes of the first GFAL read (and smallest read size)
+SGFS_GfalMaxChunk=4*1024*1024  # Largest GFAL read size
+SGFS_GfalReadTime=0.25         # Seconds; faster reads make the next one bigger
+SGFS_GfalReadAhead=4           # GFAL buffers read ahead of each client
+SGFS_GfalWorkers=32            # Idle GFAL worker processes kept, one (proxy,bdii,lfc) environment each (0: GFAL in the server process)
+SGFS_GfalWorkerIdle=300        # Seconds an idle GFAL worker process is kept
+SGFS_FileChunkSize=1024*1024   # Bytes read at once when a local file is sent through Python
+SGFS_FilePollInterval=0.5      # Max seconds between checks of a file still being downloaded
+SGFS_FileFirstByteTimeout=30   # Seconds lcg-cp may take to write the first bytes
+SGFS_FileStallTimeout=300      # Seconds a file being downloaded may stop growing
+SGFS_StagingDir=os.path.join(tempfile.gettempdir(),'sgfs_staging') # Files kept for fixed_download
+SGFS_StagingSize=20*1024*1024*1024 # Max bytes of the staging cache
+SGFS_DownloadStaging=True      # /download fetches files once in the staging cache
+SGFS_BookingLimit=32           # Max booking downloads running at once
+SGFS_BookingUserLimit=8        # Max booking downloads running for each user
+SGFS_BookingSELimit=8          # Max booking downloads from each storage element (None: no limit)
+SGFS_BookingCheckInterval=5    # Max seconds between two runs of the booking scheduler
+SGFS_DeleteParallelism=8       # Catalog deletes running at once for each /delete_many
+SGFS_ActionLogSize=10000       # Max actions waiting to be written (callers wait beyond)
+SGFS_ActionLogBatch=500        # Actions written with a single insert
+SGFS_ActionLogInterval=1.0     # Max seconds an action waits to be written
+SGFS_TransactionIdleTimeout=3600  # Seconds without requests before an open transaction is closed (None: never)
+SGFS_TransactionMaxAge=None       # Seconds an open transaction may live, even if still used (None: no limit)
+SGFS_BookingIdleTimeout=24*3600   # Seconds a booking may go unchecked before it is closed (None: never)
+SGFS_BookingMaxAge=7*24*3600      # Seconds a booking and its file may be kept (None: no limit)
+SGFS_BookingDirPrefix='sgfs_booking_' # Temporary directories of the booked files
+SGFS_ReaperScanInterval=60        # Seconds between two scans for unreferenced booking directories
+SGFS_ServerMode='threads'      # Standalone server: 'threads' (CherryPy) or 'async' (SGFSAsyncServer)
+SGFS_AsyncWorkers=16           # Threads running handlers and body reads of the async server
+SGFS_AsyncBuffer=256*1024      # Bytes waiting for a client before its next body chunk is read
+SGFS_AsyncMaxBody=16*1024*1024 # Largest request body accepted by the async server
+SGFS_AsyncBacklog=1024         # Pending connections of the async server
+SGFS_CmdLimits={             # Max concurrent commands of each type (None: any other)
+	'lfc-ls' : 16,
+	'lcg-cp' : 64,
+	'lcg-del':  8,
+	'lcg-lr' :  8,
+	'lcg-rf' :  8,
+	'wget'   :  4,
+	'openssl':  8,
+	None     : 16,
+}
+
+##
+## Block of a streamed SGFS output; keeps track of nesting and separators
+##
+class SGFSOutputBlock:
+	def __init__(self,name,depth):
+		self.name=name
+		self.depth=depth
+		self.empty=True
 
 ##
 ## Class that manages the SGFS outputs in XML or JSON formats
 ##
+## In stream mode the output is written while values are added; flush()
+## returns the text produced so far so that handlers can send it with
+## 'response.stream'. Values can only be added to the last opened block
+## or to one of its parents (which closes the inner blocks).
+##
 class SGFSOutput:
 	@staticmethod
 	def jsonMode(Mode=None):
@@ -68,10 +179,21 @@ class SGFSOutput:
 		if Mode is not None and Mode.lower() == 'true':
 			jsonMode = True
 		return jsonMode
+
+	@staticmethod
+	def prettyMode(Mode=None):
+		return Mode is None or Mode.lower() != 'false'
 		
-	def __init__(self,JSon=False):
+	def __init__(self,JSon=False,Stream=False,Pretty=True,indent='\t'):
 		self.JSon = JSon
-		if self.JSon is True:
+		self.Stream = Stream
+		self.Pretty = Pretty
+		if self.Stream is True:
+			self.indent = indent
+			self.chunks = []
+			self.chunks_size = 0
+			self.blocks = []
+		elif self.JSon is True:
 			self.doc = {}
 			self.index = 0
 		else:
@@ -82,7 +204,16 @@ class SGFSOutput:
 			answer_value="OK"
 		else:
 			answer_value="KO"
-		if self.JSon is True:
+		if self.Stream is True:
+			answer=SGFSOutputBlock('answer',1)
+			self.blocks.append(answer)
+			if self.JSon is True:
+				self.write('{"status": %s, "answer": [' % json.dumps(answer_value))
+			else:
+				self.write('<?xml version="1.0" encoding="UTF-8"?>\n<answer>')
+				self.openItem(answer)
+				self.write('<status>%s</status>' % answer_value)
+		elif self.JSon is True:
 			#answer=[{ 'status' : answer_value }]
 			#self.doc['answer'] = answer
 			answer = []
@@ -97,7 +228,16 @@ class SGFSOutput:
 		return answer
 	
 	def addBlockValue(self,block,key_name,key_value,key_attributes=None):
-		if self.JSon is True:
+		if self.Stream is True:
+			self.openItem(block)
+			if self.JSon is True:
+				if key_attributes is None:
+					self.write(json.dumps({ str(key_name) : str(key_value) }))
+				else:
+					self.write(json.dumps({ str(key_name) : { str(key_value) : self.jsonAttributes(key_attributes) }}))
+			else:
+				self.write('<%s%s>%s</%s>' % (key_name,self.xmlAttributes(key_attributes),escape(str(key_value)),key_name))
+		elif self.JSon is True:
 			if key_attributes is None:
 				block.append({ str(key_name) : str(key_value) })
 			else:
@@ -115,7 +255,13 @@ class SGFSOutput:
 			key_element.appendChild(key_node)
 	
 	def addValue(self,block,key_name,key_attributes=None):
-		if self.JSon is True:
+		if self.Stream is True:
+			self.openItem(block)
+			if self.JSon is True:
+				self.write(json.dumps({ str(key_name) : self.jsonAttributes(key_attributes) }))
+			else:
+				self.write('<%s%s/>' % (key_name,self.xmlAttributes(key_attributes)))
+		elif self.JSon is True:
 			attributes = {}
 			if key_attributes is not None:
 				for a in key_attributes:
@@ -129,7 +275,15 @@ class SGFSOutput:
 			block.appendChild(key_element)
 	
 	def newBlock(self,parent_block,block_name):
-		if self.JSon is True:
+		if self.Stream is True:
+			self.openItem(parent_block)
+			if self.JSon is True:
+				self.write('{%s: [' % json.dumps(str(block_name)))
+			else:
+				self.write('<%s>' % block_name)
+			block_element = SGFSOutputBlock(str(block_name),parent_block.depth+1)
+			self.blocks.append(block_element)
+		elif self.JSon is True:
 			block_element = []
 			parent_block.append({ str(block_name) : block_element })
 		else:
@@ -137,17 +291,430 @@ class SGFSOutput:
 			parent_block.appendChild(block_element) 
 		return block_element
 	
-	def render(self,indent='\t',encoding="UTF-8"):
+	def headers(self):
 		if self.JSon is True:
 			cherrypy.response.headers['Access-Control-Allow-Origin']='*'
 			cherrypy.response.headers['Content-Type']= 'application/json'
-			return json.dumps(self.doc)
 		else:
 			cherrypy.response.headers['Content-Type']= 'text/xml'
+
+	def render(self,indent='\t',encoding="UTF-8"):
+		self.headers()
+		if self.Stream is True:
+			return self.finish()
+		elif self.JSon is True:
+			return json.dumps(self.doc)
+		else:
 			return str(self.doc.toprettyxml(indent,encoding="UTF-8"))
 
+	#
+	# Stream mode helpers
+	#
+	def write(self,data):
+		self.chunks.append(data)
+		self.chunks_size+=len(data)
+
+	def flush(self,size=0):
+		# Returns the pending output once it is at least 'size' bytes
+		if self.chunks_size < size or self.chunks_size == 0:
+			return ''
+		data=''.join(self.chunks)
+		self.chunks=[]
+		self.chunks_size=0
+		return data
+
+	def finish(self):
+		self.closeBlocks(0)
+		if self.JSon is False and self.Pretty is True:
+			self.write('\n')
+		return self.flush()
+
+	def newLine(self,depth):
+		if self.Pretty is True:
+			return '\n'+self.indent*depth
+		return ''
+
+	def openItem(self,block):
+		self.closeBlocks(block.depth)
+		if self.JSon is True and block.empty is False:
+			self.write(',')
+			if self.Pretty is False:
+				self.write(' ')
+		self.write(self.newLine(block.depth))
+		block.empty=False
+
+	def closeBlocks(self,depth):
+		while len(self.blocks) > 0 and self.blocks[-1].depth > depth:
+			block=self.blocks.pop()
+			self.write(self.newLine(block.depth-1))
+			if self.JSon is True:
+				self.write(']}')
+			else:
+				self.write('</%s>' % block.name)
+
+	def jsonAttributes(self,key_attributes):
+		attributes=OrderedDict()
+		if key_attributes is not None:
+			for a in key_attributes:
+				attributes[str(a[0])]=str(a[1])
+		return attributes
+
+	def xmlAttributes(self,key_attributes):
+		if key_attributes is None:
+			return ''
+		return ''.join([' %s=%s' % (a[0],quoteattr(str(a[1]))) for a in key_attributes])
+
+##
+## Exception raised when a command cannot be started
+##
+class SGFSExecError(Exception):
+	pass
+
+##
+## Counts the running commands of each type against SGFS_CmdLimits
+##
+class SGFSLimiter:
+	def __init__(self,limits):
+		self.limits=limits
+		self.running={}
+		self.cond=threading.Condition()
+
+	def acquire(self,kind,timeout=None):
+		limit=self.limits.get(kind,self.limits.get(None))
+		if timeout is not None:
+			deadline=time.time()+timeout
+		self.cond.acquire()
+		try:
+			while self.running.get(kind,0) >= limit:
+				if timeout is None:
+					self.cond.wait()
+				else:
+					remaining=deadline-time.time()
+					if remaining <= 0:
+						return False
+					self.cond.wait(remaining)
+			self.running[kind]=self.running.get(kind,0)+1
+			return True
+		finally:
+			self.cond.release()
+
+	def release(self,kind):
+		self.cond.acquire()
+		try:
+			self.running[kind]-=1
+			self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+##
+## Future of a command run by SGFSExecutor
+##
+## The command runs in its own process group, so kill() also stops the
+## processes it started. Output (stderr merged into stdout, so error lines
+## keep their place) is collected by the executor thread while the command
+## runs; in 'lines' mode it is handed out line by line by iterLines()
+## instead of being kept in memory.
+##
+class SGFSFuture:
+	def __init__(self,executor,command,kind,timeout,lines):
+		self.executor=executor
+		self.command=command
+		self.kind=kind
+		self.timeout=timeout
+		self.lines=lines
+		self.deadline=None
+		if timeout is not None:
+			self.deadline=time.time()+timeout
+		self.p=None
+		self.pid=None
+		self.pipes={}          # fd -> (file,buffer list)
+		self.stdout=[]
+		self.partial=''
+		self.queue=deque()     # stdout lines in 'lines' mode
+		self.cond=threading.Condition()
+		self.finished=threading.Event()
+		self.callbacks=[]
+		self.returncode=None
+		self.timedout=False
+		self.killed=False
+
+	def start(self):
+		self.p=Popen(self.command, shell=True, stdin=SGFSExecutor.devnull, stdout=PIPE, stderr=STDOUT, close_fds=True, preexec_fn=os.setsid)
+		self.pid=self.p.pid
+		self.pipes[self.p.stdout.fileno()]=(self.p.stdout,self.stdout)
+
+	#
+	# Executor side
+	#
+	def readable(self):
+		fds=[]
+		for fd,(f,chunks) in self.pipes.items():
+			# Stop reading lines nobody is consuming (the pipe blocks the command)
+			if chunks is self.stdout and self.lines and not self.killed and len(self.queue) >= SGFS_CmdLineBuffer:
+				continue
+			fds.append(fd)
+		return fds
+
+	def read(self,fd):
+		f,chunks=self.pipes[fd]
+		try:
+			data=os.read(fd,64*1024)
+		except OSError:
+			data=''
+		if len(data) == 0:
+			del self.pipes[fd]
+			f.close()
+			if chunks is self.stdout and self.lines:
+				self.addLines('',True)
+		elif chunks is self.stdout and self.lines and self.killed:
+			pass # Nobody is going to read them
+		elif chunks is self.stdout and self.lines:
+			self.addLines(data,False)
+		else:
+			chunks.append(data)
+
+	def addLines(self,data,eof):
+		data=self.partial+data
+		lines=data.split('\n')
+		if eof:
+			self.partial=''
+			lines=[line+'\n' for line in lines[:-1]]+[lines[-1]]
+			lines=[line for line in lines if line != '']
+		else:
+			self.partial=lines[-1]
+			lines=[line+'\n' for line in lines[:-1]]
+		self.cond.acquire()
+		try:
+			self.queue.extend(lines)
+			self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+	def expire(self,now):
+		if self.deadline is not None and now >= self.deadline and not self.timedout:
+			print "[!] Timeout (%ss) for PID %s: %s" % (self.timeout,self.pid,self.command)
+			self.timedout=True
+			self.kill()
+
+	def reap(self):
+		# True once both pipes are closed and the process has exited
+		if len(self.pipes) > 0:
+			return False
+		if self.p.poll() is None:
+			return False
+		self.returncode=self.p.returncode
+		if self.timedout:
+			message="Timeout after %s seconds: %s" % (self.timeout,self.command)
+			if self.lines:
+				self.addLines(message,True)
+			else:
+				self.stdout.append(message)
+		self.cond.acquire()
+		try:
+			self.finished.set()
+			self.cond.notifyAll()
+			callbacks=self.callbacks
+			self.callbacks=[]
+		finally:
+			self.cond.release()
+		for callback in callbacks:
+			try:
+				callback(self)
+			except Exception, e:
+				print "[!] Callback of PID %s failed: %s" % (self.pid,e)
+		return True
+
+	def addCallback(self,callback):
+		# Called by the executor thread once the command ends (keep it short)
+		self.cond.acquire()
+		try:
+			if not self.finished.isSet():
+				self.callbacks.append(callback)
+				return
+		finally:
+			self.cond.release()
+		callback(self)
+
+	#
+	# Caller side
+	#
+	def done(self):
+		return self.finished.isSet()
+
+	def wait(self,timeout=None):
+		self.finished.wait(timeout)
+		return self.done()
+
+	def returnCode(self):
+		self.wait()
+		return self.returncode
+
+	def output(self):
+		self.wait()
+		return ''.join(self.stdout)
+
+	def result(self):
+		self.wait()
+		return self.returncode,self.output()
+
+	def iterLines(self):
+		while True:
+			self.cond.acquire()
+			try:
+				while len(self.queue) == 0 and not self.finished.isSet():
+					self.cond.wait(1)
+				if len(self.queue) == 0:
+					return
+				line=self.queue.popleft()
+				resume=len(self.queue) == SGFS_CmdLineBuffer/2
+			finally:
+				self.cond.release()
+			if resume:
+				self.executor.wakeup()
+			yield line
+
+	def kill(self):
+		self.killed=True
+		try:
+			os.killpg(self.pid,signal.SIGKILL)
+		except OSError:
+			pass
+		self.executor.wakeup()
+
+##
+## Class that runs commands on behalf of the request threads
+##
+## A single thread multiplexes the output pipes of every running command,
+## enforces their deadlines and reaps them as soon as they exit (woken up
+## by SIGCHLD when the handler could be installed, polling otherwise).
+## Each command type (lfc-ls, lcg-cp, ...) has its own concurrency limit.
+##
+class SGFSExecutor:
+	devnull  = open(os.devnull,'r')
+	instance = None
+	lock     = threading.Lock()
+	kinds    = re.compile(r'\b(lfc-ls|lcg-cp|lcg-del|lcg-lr|lcg-rf|wget|openssl)\b')
+
+	@staticmethod
+	def get():
+		if SGFSExecutor.instance is None:
+			SGFSExecutor.lock.acquire()
+			try:
+				if SGFSExecutor.instance is None:
+					SGFSExecutor.instance=SGFSExecutor()
+			finally:
+				SGFSExecutor.lock.release()
+		return SGFSExecutor.instance
+
+	def __init__(self,limits=SGFS_CmdLimits):
+		self.limiter=SGFSLimiter(limits)
+		self.futures=[]
+		self.lock=threading.Lock()
+		self.wakeup_r,self.wakeup_w=os.pipe()
+		for fd in (self.wakeup_r,self.wakeup_w):
+			fcntl.fcntl(fd,fcntl.F_SETFL,fcntl.fcntl(fd,fcntl.F_GETFL)|os.O_NONBLOCK)
+		self.sigchld=self.installSigChld()
+		self.thread=threading.Thread(target=self.run,name='SGFS-executor')
+		self.thread.daemon=True
+		self.thread.start()
+
+	def installSigChld(self):
+		# Signal handlers can only be set by the main thread
+		try:
+			signal.signal(signal.SIGCHLD,lambda signum,frame: None)
+			# After signal(): blocking reads and writes of the other threads
+			# (MySQL, pipes, sockets) are restarted instead of failing with
+			# EINTR; the waits with a timeout of this file retry on EINTR
+			signal.siginterrupt(signal.SIGCHLD,False)
+			signal.set_wakeup_fd(self.wakeup_w)
+			return True
+		except ValueError:
+			print "[i] SIGCHLD not available, polling child processes"
+			return False
+
+	def kindOf(self,command):
+		match=SGFSExecutor.kinds.search(command)
+		if match is None:
+			return None
+		return match.group(1)
+
+	def submit(self,command,kind=None,timeout=SGFS_CmdTimeout,lines=False):
+		if kind is None:
+			kind=self.kindOf(command)
+		if not self.limiter.acquire(kind,SGFS_CmdQueueTimeout):
+			raise SGFSExecError("Too many '%s' commands running" % kind)
+		future=SGFSFuture(self,command,kind,timeout,lines)
+		try:
+			future.start()
+		except OSError, e:
+			self.limiter.release(kind)
+			raise SGFSExecError("Unable to run '%s': %s" % (command,e))
+		self.lock.acquire()
+		try:
+			self.futures.append(future)
+		finally:
+			self.lock.release()
+		self.wakeup()
+		return future
+
+	def wakeup(self):
+		try:
+			os.write(self.wakeup_w,'x')
+		except OSError:
+			pass # Pipe full, the executor is going to wake up anyway
+
+	def nextTimeout(self,futures,now):
+		timeout=SGFS_CmdPollInterval
+		for future in futures:
+			if future.deadline is not None:
+				timeout=min(timeout,max(future.deadline-now,0))
+			if len(future.pipes) == 0 and not self.sigchld:
+				# Pipes closed, waiting for the exit status
+				timeout=min(timeout,0.05)
+		return timeout
+
+	def run(self):
+		while True:
+			self.lock.acquire()
+			try:
+				futures=list(self.futures)
+			finally:
+				self.lock.release()
+			poller=select.poll()
+			poller.register(self.wakeup_r,select.POLLIN)
+			readers={}
+			for future in futures:
+				for fd in future.readable():
+					readers[fd]=future
+					poller.register(fd,select.POLLIN)
+			try:
+				events=poller.poll(self.nextTimeout(futures,time.time())*1000)
+			except select.error, e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+			for fd,event in events:
+				if fd == self.wakeup_r:
+					try:
+						while os.read(self.wakeup_r,4096):
+							pass
+					except OSError:
+						pass
+				else:
+					readers[fd].read(fd)
+			now=time.time()
+			for future in futures:
+				future.expire(now)
+				if future.reap():
+					self.lock.acquire()
+					try:
+						self.futures.remove(future)
+					finally:
+						self.lock.release()
+					self.limiter.release(future.kind)
+
 ##
-## Class that executes commands
+## Class that executes commands (through the shared SGFSExecutor)
 ##
 class ExecCmd:
 	p       = None
@@ -156,44 +723,1359 @@ class ExecCmd:
 
 	def __init__(self):
 		self.p=None
-		
-	def __del__(self):
-		if self.p is not None:
-			print "[i] Waiting for PID: %s" % self.p.pid
-			self.p.wait()
 	
-	def cmd(self,command):
+	def cmd(self,command,timeout=SGFS_CmdTimeout):
 		self.command=command
 		print "[!] %s" % self.command
-		self.p = Popen(self.command, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-		self.output = self.p.stdout.read()
+		self.p = SGFSExecutor.get().submit(self.command,timeout=timeout)
+		self.output = self.p.output()
 		return self.output
-	
-	def bgCmd(self,command):
+
+	def lines(self,command,timeout=SGFS_CmdTimeout):
+		# Hands out the command output line by line while it runs
+		self.command=command
+		print "[!] %s" % self.command
+		self.p = SGFSExecutor.get().submit(self.command,timeout=timeout,lines=True)
+		return self.p.iterLines()
+
+	def bgCmd(self,command,timeout=None):
 		self.command=command
 		print "[&] %s" % self.command
-		self.p = Popen(self.command, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
+		self.p = SGFSExecutor.get().submit(self.command,timeout=timeout)
 		return self.p
 	
 	def returnCode(self):
-		self.p.wait()
-		return self.p.returncode
+		return self.p.returnCode()
 		
 	def kill(self):
 		if self.p is not None:
-			os.kill(self.p.pid,signal.SIGKILL)
+			self.p.kill()
 			
 	def killAll(self):
-		if self.p is not None:
-			cmd = """ps -o pid= --ppid %s | xargs kill""" % self.p.pid
-			print "[!] %s" % cmd 
-			p=Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-			p.wait()
-			self.kill()
+		# Commands run in their own process group
+		self.kill()
+
+##
+## State of a booking download (see SGFSBookingSupervisor)
+##
+class SGFSBooking:
+	def __init__(self,booking_id,file_name,file_size,cmd,user=None,se=None,priority=0,se_lookup=None):
+		self.booking_id = booking_id
+		self.file_name  = file_name
+		self.file_size  = file_size
+		self.cmd        = cmd
+		self.user       = user
+		self.se         = se
+		self.se_lookup  = se_lookup # Finds se once the booking may start
+		self.resolving  = False
+		self.priority   = priority
+		self.queue_time = time.time()
+		self.future     = None
+		self.pid        = None
+		self.start_time = None
+		self.error      = None
+		self.cancelled  = False # Closed (see SGFSBookingSupervisor.remove)
+
+	def start(self):
+		try:
+			self.future=ExecCmd().bgCmd(self.cmd)
+			self.pid=self.future.pid
+		except SGFSExecError, e:
+			print "[booking %s] %s" % (self.booking_id,e)
+			self.error=str(e)
+		self.start_time=time.time()
+
+	def staged(self):
+		try:
+			return os.stat(self.file_name).st_size
+		except OSError:
+			return 0
+
+	def exitStatus(self):
+		if self.future is None or not self.future.done():
+			return None
+		return self.future.returnCode()
+
+	def status(self):
+		if self.error is not None:
+			return 'failed'
+		if self.future is None:
+			return 'queued'
+		exit_status=self.exitStatus()
+		if exit_status is None:
+			return 'running'
+		if exit_status == 0:
+			return 'done'
+		return 'failed'
+
+##
+## Schedules and keeps track of the booking downloads (lcg-cp)
+##
+## Bookings wait in a queue ordered by priority (higher first), then by
+## arrival; the scheduler thread starts them while the number of running
+## downloads stays within SGFS_BookingLimit, SGFS_BookingUserLimit for
+## their user and SGFS_BookingSELimit for their storage element. Bookings
+## that cannot start because of their user or SE limit do not hold back
+## the following ones. Limits apply to each server process.
+## The SE of a booking may be given as a lookup (a replica query), which
+## is run in background only when the booking could start, so that long
+## lists of bookings are submitted without waiting for their replicas.
+## The lcg-cp commands run through SGFSExecutor, which reaps them as soon
+## as they exit, so their status is known without looking at the process
+## table. Bookings started by another server process (or before a restart)
+## are checked through /proc/<pid>/cmdline.
+##
+class SGFSBookingSupervisor:
+	instance = None
+	lock     = threading.Lock()
+
+	@staticmethod
+	def get():
+		SGFSBookingSupervisor.lock.acquire()
+		try:
+			if SGFSBookingSupervisor.instance is None:
+				SGFSBookingSupervisor.instance=SGFSBookingSupervisor()
+			return SGFSBookingSupervisor.instance
+		finally:
+			SGFSBookingSupervisor.lock.release()
+
+	def __init__(self):
+		self.cond     = threading.Condition()
+		self.bookings = {} # booking_id -> SGFSBooking
+		self.queue    = [] # (-priority,sequence,SGFSBooking), sorted
+		self.running  = [] # started SGFSBooking
+		self.lookups  = 0  # SE lookups running
+		self.sequence = itertools.count()
+		self.thread   = threading.Thread(target=self.run,name='sgfs-bookings')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def submit(self,booking_id,file_name,file_size,cmd,user=None,se=None,priority=0,se_lookup=None):
+		booking=SGFSBooking(booking_id,file_name,file_size,cmd,user,se,priority,se_lookup)
+		# Closed by the reaper if nobody asks for it anymore
+		SGFSReaper.get().addBooking(booking_id,file_name)
+		self.cond.acquire()
+		try:
+			self.bookings[int(booking_id)]=booking
+			bisect.insort(self.queue,(-priority,self.sequence.next(),booking))
+			self.cond.notify()
+		finally:
+			self.cond.release()
+		return booking
+
+	def wakeup(self,future=None):
+		self.cond.acquire()
+		try:
+			self.cond.notify()
+		finally:
+			self.cond.release()
+
+	def run(self):
+		SGFSDB.background()
+		while True:
+			self.cond.acquire()
+			try:
+				bookings,lookups=self.schedule()
+				if len(bookings) == 0 and len(lookups) == 0:
+					self.cond.wait(SGFS_BookingCheckInterval)
+			finally:
+				self.cond.release()
+			for booking in lookups:
+				thread=threading.Thread(target=self.lookupSE,args=(booking,),name='sgfs-booking-se')
+				thread.setDaemon(True)
+				thread.start()
+			for booking in bookings:
+				self.start(booking)
+
+	def schedule(self):
+		# Called with the lock held; returns the bookings to start and the
+		# bookings whose SE must be looked up first
+		self.running=[booking for booking in self.running if booking.status() == 'running']
+		users={}
+		ses={}
+		for booking in self.running:
+			users[booking.user]=users.get(booking.user,0)+1
+			ses[booking.se]=ses.get(booking.se,0)+1
+		bookings=[]
+		lookups=[]
+		i=0
+		while i < len(self.queue) and len(self.running)+self.lookups < SGFS_BookingLimit:
+			booking=self.queue[i][2]
+			if booking.se_lookup is not None:
+				if not booking.resolving:
+					booking.resolving=True
+					self.lookups+=1
+					lookups.append(booking)
+				i+=1
+				continue
+			if users.get(booking.user,0) >= SGFS_BookingUserLimit or \
+			   (SGFS_BookingSELimit is not None and booking.se is not None and ses.get(booking.se,0) >= SGFS_BookingSELimit):
+				i+=1
+				continue
+			del self.queue[i]
+			users[booking.user]=users.get(booking.user,0)+1
+			ses[booking.se]=ses.get(booking.se,0)+1
+			self.running.append(booking)
+			bookings.append(booking)
+		return bookings,lookups
+
+	def lookupSE(self,booking):
+		try:
+			se=booking.se_lookup()
+		except Exception, e:
+			print "[booking %s] Unable to find the storage element: %s" % (booking.booking_id,e)
+			se=None
+		self.cond.acquire()
+		try:
+			booking.se=se
+			booking.se_lookup=None
+			booking.resolving=False
+			self.lookups-=1
+			self.cond.notify()
+		finally:
+			self.cond.release()
+
+	def start(self,booking):
+		# Runs without the lock: bgCmd may wait for a free lcg-cp slot, while
+		# the booking gets closed; kill() cannot stop it before it starts
+		if booking.cancelled:
+			return
+		booking.start()
+		if booking.future is None:
+			return
+		self.cond.acquire()
+		try:
+			cancelled=booking.cancelled
+		finally:
+			self.cond.release()
+		if cancelled:
+			print "Killing closed booking %s (pid: %s)" % (booking.booking_id,booking.pid)
+			booking.future.kill()
+			return
+		booking.future.addCallback(self.wakeup)
+		try:
+			sgfsDB=SGFSDB()
+			sgfsDB.updateBookingPid(booking.booking_id,booking.pid)
+		finally:
+			SGFSDB.release()
+
+	def lookup(self,booking_id):
+		self.cond.acquire()
+		try:
+			return self.bookings.get(int(booking_id))
+		finally:
+			self.cond.release()
+
+	def remove(self,booking_id):
+		self.cond.acquire()
+		try:
+			booking=self.bookings.pop(int(booking_id),None)
+			if booking is not None:
+				booking.cancelled=True
+				self.queue=[item for item in self.queue if item[2] is not booking]
+			return booking
+		finally:
+			self.cond.release()
+
+	def forget(self,booking_ids):
+		# Drops finished bookings once reported done or closed; queued and
+		# running ones are left to kill()
+		self.cond.acquire()
+		try:
+			for booking_id in booking_ids:
+				try:
+					booking=self.bookings.get(int(booking_id))
+				except (TypeError,ValueError):
+					continue
+				if booking is not None and booking.status() in ('done','failed'):
+					del self.bookings[int(booking_id)]
+		finally:
+			self.cond.release()
+
+	def status(self,booking_id,download_pid):
+		# 'queued', 'running', 'done' or 'failed'
+		booking=self.lookup(booking_id)
+		if booking is not None:
+			return booking.status()
+		if download_pid is None:
+			# Queued by another server process (or lost by a restart)
+			return 'queued'
+		if SGFSBookingSupervisor.isLcgCp(download_pid):
+			return 'running'
+		return 'failed'
+
+	def kill(self,booking_id,download_pid):
+		booking=self.remove(booking_id)
+		if booking is not None:
+			if booking.future is not None and not booking.future.done():
+				print "Killing booking %s (pid: %s)" % (booking_id,booking.pid)
+				booking.future.kill()
+			return
+		if download_pid is not None and SGFSBookingSupervisor.isLcgCp(download_pid):
+			print "Killing pid: %s" % download_pid
+			try:
+				# Commands run in their own process group
+				os.killpg(int(download_pid),signal.SIGKILL)
+			except OSError:
+				print "EXCEPTION: kill %s" % download_pid
+
+	@staticmethod
+	def isLcgCp(pid):
+		try:
+			cmdline=open('/proc/%d/cmdline' % int(pid)).read()
+		except (IOError,ValueError):
+			return False
+		return 'lcg-cp' in cmdline
+
+##
+## GFAL worker process, serving the files of one (proxy,bdii,lfc) key
+##
+## The worker sets X509_USER_PROXY, LCG_GFAL_INFOSYS and LFC_HOST once
+## and then runs the gfal_open/gfal_lseek/gfal_read/gfal_close requests
+## of any number of files, each request in its own thread. Requests and
+## answers share one pipe and carry a request id: a thread of the server
+## hands the answers to the waiting callers, read buffers follow their
+## answer as raw bytes (send_bytes). Downloads with different credentials
+## never share an environment and run in parallel in separate processes.
+##
+class SGFSGfalWorker:
+	def __init__(self,key):
+		self.key        = key
+		self.broken     = False
+		self.files      = 0 # Open files (see SGFSGfalPool)
+		self.idle_since = time.time()
+		self.lock       = threading.Lock()
+		self.sendLock   = threading.Lock()
+		self.replies    = {} # request id -> (Queue,read)
+		self.requests   = itertools.count()
+		self.conn,child_conn = multiprocessing.Pipe()
+		self.process=multiprocessing.Process(target=SGFSGfalWorker.serve,args=(child_conn,key),name='sgfs-gfal-worker')
+		self.process.daemon=True
+		try:
+			self.process.start()
+		finally:
+			child_conn.close()
+		self.thread=threading.Thread(target=self.receive,name='sgfs-gfal-replies')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	@staticmethod
+	def serve(conn,key):
+		# Runs in the worker process: signals are left to the server and
+		# its sockets and pipes are closed, so that clients see them closed
+		for signum in (signal.SIGTERM,signal.SIGHUP,signal.SIGUSR1,signal.SIGCHLD):
+			signal.signal(signum,signal.SIG_DFL)
+		signal.signal(signal.SIGINT,signal.SIG_IGN)
+		signal.set_wakeup_fd(-1)
+		try:
+			max_fd=os.sysconf('SC_OPEN_MAX')
+		except (ValueError,OSError):
+			max_fd=1024
+		os.closerange(3,conn.fileno())
+		os.closerange(conn.fileno()+1,max_fd)
+		px_file,bdii_host,lfc_host=key
+		os.environ["X509_USER_PROXY"] = px_file
+		os.environ["LCG_GFAL_INFOSYS"] = bdii_host
+		os.environ["LFC_HOST"]=lfc_host
+		sendLock=threading.Lock()
+		while True:
+			try:
+				request=conn.recv()
+			except (EOFError,IOError):
+				break
+			thread=threading.Thread(target=SGFSGfalWorker.answer,args=(conn,sendLock,request))
+			thread.setDaemon(True)
+			thread.start()
+
+	@staticmethod
+	def answer(conn,sendLock,request):
+		# Worker process thread
+		request_id,name=request[:2]
+		data=None
+		if name == 'read':
+			result,data=gfalthr.gfal_read(*request[2:])
+			if data is None or result <= 0:
+				result=-1
+			else:
+				result=min(result,len(data))
+		elif name == 'open':
+			result=gfalthr.gfal_open(*request[2:])
+		elif name == 'lseek':
+			result=gfalthr.gfal_lseek(*request[2:])
+		else:
+			result=gfalthr.gfal_close(*request[2:])
+		sendLock.acquire()
+		try:
+			conn.send((request_id,result))
+			if data is not None and result > 0:
+				conn.send_bytes(data,0,result)
+		except (IOError,OSError):
+			pass
+		finally:
+			sendLock.release()
+
+	def receive(self):
+		# Hands the answers of the worker to the waiting callers
+		try:
+			while True:
+				request_id,result=self.conn.recv()
+				self.lock.acquire()
+				try:
+					reply,read=self.replies.pop(request_id)
+				finally:
+					self.lock.release()
+				if read:
+					data=None
+					if result > 0:
+						data=self.conn.recv_bytes()
+					result=(result,data)
+				reply.put(result)
+		except (EOFError,IOError,OSError):
+			pass
+		self.fail()
+
+	def fail(self):
+		# The process is gone: callers get an error
+		self.lock.acquire()
+		try:
+			self.broken=True
+			replies,self.replies=self.replies,{}
+		finally:
+			self.lock.release()
+		for reply,read in replies.values():
+			reply.put(read and (-1,None) or -1)
+
+	def call(self,name,*args):
+		reply=Queue.Queue(1)
+		read=name == 'read'
+		self.lock.acquire()
+		try:
+			if self.broken:
+				return read and (-1,None) or -1
+			request_id=self.requests.next()
+			self.replies[request_id]=(reply,read)
+		finally:
+			self.lock.release()
+		self.sendLock.acquire()
+		try:
+			try:
+				self.conn.send((request_id,name)+args)
+			except (IOError,OSError):
+				self.fail()
+		finally:
+			self.sendLock.release()
+		return reply.get()
+
+	def alive(self):
+		return not self.broken and self.process.is_alive()
+
+	def stop(self):
+		# Dead processes are reaped by multiprocessing when the next starts
+		self.broken=True
+		try:
+			self.conn.close()
+		except (IOError,OSError):
+			pass
+		if self.process.is_alive():
+			self.process.terminate()
+
+##
+## GFAL file opened by an SGFSGfalWorker (see SGFSGfalReader)
+##
+class SGFSGfalFile:
+	def __init__(self,pool,worker,gfal_f):
+		self.pool   = pool
+		self.worker = worker
+		self.gfal_f = gfal_f
+
+	def lseek(self,offset,whence):
+		return self.worker.call('lseek',self.gfal_f,offset,whence)
+
+	def read(self,size):
+		return self.worker.call('read',self.gfal_f,size)
+
+	def close(self):
+		returnCode=self.worker.call('close',self.gfal_f)
+		self.pool.release(self.worker)
+		return returnCode
+
+##
+## GFAL file opened by the server process itself (SGFS_GfalWorkers=0)
+##
+class SGFSGfalLocalFile:
+	def __init__(self,gfal_f):
+		self.gfal_f = gfal_f
+
+	def lseek(self,offset,whence):
+		return gfalthr.gfal_lseek(self.gfal_f,offset,whence)
+
+	def read(self,size):
+		return gfalthr.gfal_read(self.gfal_f,size)
+
+	def close(self):
+		return gfalthr.gfal_close(self.gfal_f)
+
+##
+## Pool of GFAL worker processes, keyed by (proxy,bdii,lfc)
+##
+## All the files of a key are served by the same worker, started by the
+## first open(); there is no limit on busy workers, so downloads never
+## wait for each other. Up to SGFS_GfalWorkers workers without open files
+## are kept for later downloads (the least recently used are stopped
+## beyond that) for at most SGFS_GfalWorkerIdle seconds.
+## Without workers files are opened by the server process, which has a
+## single environment: gfal_open calls are then serialized.
+##
+class SGFSGfalPool:
+	instance = None
+	lock     = threading.Lock()
+
+	@staticmethod
+	def get():
+		if SGFSGfalPool.instance is None:
+			SGFSGfalPool.lock.acquire()
+			try:
+				if SGFSGfalPool.instance is None:
+					SGFSGfalPool.instance=SGFSGfalPool()
+			finally:
+				SGFSGfalPool.lock.release()
+		return SGFSGfalPool.instance
+
+	@staticmethod
+	def stopAll():
+		if SGFSGfalPool.instance is not None:
+			SGFSGfalPool.instance.stopIdle(0,0)
+
+	def __init__(self,size=SGFS_GfalWorkers,idle_time=SGFS_GfalWorkerIdle):
+		self.size      = size
+		self.idle_time = idle_time
+		self.lock      = threading.Lock()
+		self.workers   = {} # key -> SGFSGfalWorker
+
+	def open(self,px_file,bdii_host,lfc_host,lfc_file_name):
+		# Returns the opened GFAL file or None
+		if self.size == 0:
+			return self.openLocal(px_file,bdii_host,lfc_host,lfc_file_name)
+		worker=self.acquire((px_file,bdii_host,lfc_host))
+		if worker is None:
+			return None
+		gfal_f=worker.call('open',"lfn:%s" % lfc_file_name,os.O_RDONLY,0755)
+		if gfal_f < 0:
+			self.release(worker)
+			return None
+		return SGFSGfalFile(self,worker,gfal_f)
+
+	def openLocal(self,px_file,bdii_host,lfc_host,lfc_file_name):
+		LFCNativeBackend.envLock.acquire()
+		try:
+			os.environ["X509_USER_PROXY"] = px_file
+			os.environ["LCG_GFAL_INFOSYS"] = bdii_host
+			os.environ["LFC_HOST"]=lfc_host
+			gfal_f=gfalthr.gfal_open("lfn:%s" % lfc_file_name,os.O_RDONLY,0755)
+		finally:
+			LFCNativeBackend.envLock.release()
+		if gfal_f < 0:
+			return None
+		return SGFSGfalLocalFile(gfal_f)
+
+	def take(self,key):
+		# Called with the lock held; the running worker of key (or None)
+		worker=self.workers.get(key)
+		if worker is not None and not worker.alive():
+			del self.workers[key]
+			if worker.files == 0:
+				worker.stop()
+			worker=None
+		if worker is not None:
+			worker.files+=1
+		return worker
+
+	def acquire(self,key):
+		self.lock.acquire()
+		try:
+			worker=self.take(key)
+		finally:
+			self.lock.release()
+		if worker is not None:
+			return worker
+		# Started without the lock: forking takes a while
+		try:
+			started=SGFSGfalWorker(key)
+		except OSError, e:
+			print "[i] Unable to start a GFAL worker: %s" % e
+			return None
+		self.lock.acquire()
+		try:
+			worker=self.take(key)
+			if worker is None:
+				worker,started=started,None
+				worker.files=1
+				self.workers[key]=worker
+		finally:
+			self.lock.release()
+		if started is not None:
+			# Another request started one first
+			started.stop()
+		self.stopIdle(self.size,self.idle_time)
+		return worker
+
+	def release(self,worker):
+		self.lock.acquire()
+		try:
+			worker.files-=1
+			worker.idle_since=time.time()
+			if worker.files == 0 and (worker.broken or self.workers.get(worker.key) is not worker):
+				# Dead, or replaced while its files were still open
+				if self.workers.get(worker.key) is worker:
+					del self.workers[worker.key]
+				worker.stop()
+		finally:
+			self.lock.release()
+		self.stopIdle(self.size,self.idle_time)
+
+	def stopIdle(self,size,idle_time):
+		# Keeps at most size idle workers, idle for less than idle_time
+		self.lock.acquire()
+		try:
+			now=time.time()
+			idle=sorted([(worker.idle_since,key) for key,worker in self.workers.items() if worker.files == 0])
+			for count,(idle_since,key) in enumerate(idle):
+				if len(idle)-count > size or now-idle_since >= idle_time:
+					self.workers.pop(key).stop()
+		finally:
+			self.lock.release()
+
+##
+## Reads a GFAL file ahead of the client
+##
+## A producer thread fills a bounded queue with large buffers while the
+## response generator sends the previous ones. The size of each read
+## adapts to the measured throughput: it is doubled while reads are
+## faster than SGFS_GfalReadTime and halved when they are much slower.
+## Only the given (start,stop) byte ranges are read, in order, and no
+## buffer crosses the end of a range (see SGFSRanges).
+## Without readAhead (async server, whose pool already reads the next
+## chunk while the previous one is sent) chunks() reads each buffer
+## itself and no thread is started.
+## The reader owns the GFAL file (see SGFSGfalPool) and closes it when
+## the transfer ends or when the consumer stops iterating chunks().
+##
+class SGFSGfalReader:
+	readAhead = True
+
+	def __init__(self,gfal_f,file_size,label=None,ranges=None):
+		if ranges is None:
+			ranges=[(0,file_size)]
+		self.gfal_f        = gfal_f
+		self.file_size     = file_size
+		self.ranges        = ranges
+		self.length        = sum([stop-start for start,stop in ranges])
+		self.label         = label
+		self.transfer_size = 0
+		self.complete      = False
+		self.stopped       = False
+		self.started       = False
+		self.queue         = None
+
+	def __del__(self):
+		# Never read (HEAD requests, clients gone before the body)
+		if not self.started:
+			self.gfal_f.close()
+
+	def put(self,item):
+		# Waits for room in the queue unless the consumer went away
+		while not self.stopped:
+			try:
+				self.queue.put(item,True,1)
+				return True
+			except Queue.Full:
+				pass
+		return False
+
+	def reads(self):
+		chunk_size = SGFS_GfalMinChunk
+		position   = 0
+		try:
+			for start,stop in self.ranges:
+				if start != position:
+					if self.gfal_f.lseek(start,os.SEEK_SET) < 0:
+						print "[%s] Unable to seek at %s" % (self.label,start)
+						return
+					position = start
+				while position < stop and not self.stopped:
+					size = min(chunk_size,stop-position)
+					start_time = time.time()
+					block_size,data = self.gfal_f.read(size)
+					elapsed = time.time()-start_time
+					if data is None or block_size <= 0:
+						print "[%s] Unable to download (%s/%s)" % (self.label,position,self.file_size)
+						return
+					if block_size < len(data):
+						data = data[:block_size]
+					position += block_size
+					yield data
+					if block_size == size:
+						if elapsed < SGFS_GfalReadTime and chunk_size < SGFS_GfalMaxChunk:
+							chunk_size *= 2
+						elif elapsed > 4*SGFS_GfalReadTime and chunk_size > SGFS_GfalMinChunk:
+							chunk_size /= 2
+			self.complete = not self.stopped
+		finally:
+			self.gfal_f.close()
+
+	def produce(self,reads):
+		try:
+			for data in reads:
+				if not self.put(data):
+					return
+		finally:
+			reads.close()
+			self.put(None)
+
+	def chunks(self):
+		# Reading starts with the first chunk requested by the client
+		self.started=True
+		reads=self.reads()
+		if SGFSGfalReader.readAhead:
+			self.queue=Queue.Queue(SGFS_GfalReadAhead)
+			thread=threading.Thread(target=self.produce,args=(reads,),name='sgfs-gfal-reader')
+			thread.setDaemon(True)
+			thread.start()
+			reads=iter(self.queue.get,None)
+		try:
+			for data in reads:
+				if self.stopped:
+					break
+				self.transfer_size += len(data)
+				yield data
+		finally:
+			self.stop()
+			if self.queue is None:
+				reads.close()
+		if self.complete:
+			print "[%s] transfer: (done)" % self.label
+
+	def stop(self):
+		# May be called by other threads (see SGFSGfalFetch.kill)
+		if not self.stopped and not self.complete:
+			print "[%s] Stopping interrupted transfer at (%s/%s)" % (self.label,self.transfer_size,self.length)
+		self.stopped=True
+		if self.queue is not None:
+			try:
+				self.queue.put_nowait(None)
+			except Queue.Full:
+				pass
+
+##
+## Copies a GFAL file into a local file with an SGFSGfalReader
+##
+## It has the same done/wait/returnCode/kill interface of the command
+## futures, so it can be followed as an lcg-cp writing the file.
+##
+class SGFSGfalFetch:
+	def __init__(self,gfal_f,file_size,file_name,label=None):
+		self.reader     = SGFSGfalReader(gfal_f,file_size,label)
+		self.file_name  = file_name
+		self.label      = label
+		self.returncode = None
+		self.finished   = threading.Event()
+		# Created here so that readers can open it at once
+		self.fd         = os.open(self.file_name,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0644)
+		self.thread     = threading.Thread(target=self.run,name='sgfs-gfal-fetch')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def run(self):
+		returncode=1
+		try:
+			try:
+				for data in self.reader.chunks():
+					written=os.write(self.fd,data)
+					while written < len(data):
+						written+=os.write(self.fd,buffer(data,written))
+				if self.reader.complete:
+					returncode=0
+			finally:
+				os.close(self.fd)
+		except OSError, e:
+			print "[%s] Unable to write '%s': %s" % (self.label,self.file_name,e)
+		finally:
+			self.returncode=returncode
+			self.finished.set()
+
+	def done(self):
+		return self.finished.isSet()
+
+	def wait(self,timeout=None):
+		self.finished.wait(timeout)
+		return self.done()
+
+	def returnCode(self):
+		self.wait()
+		return self.returncode
+
+	def kill(self):
+		self.reader.stop()
+
+##
+## Waits for a local file to change (inotify through ctypes when the C
+## library offers it, polling every SGFS_FilePollInterval otherwise)
+##
+## The file itself is watched once it exists, its directory until then.
+## Watches must be created before checking the file, so that changes made
+## in between are not missed. wait() may return on unrelated events:
+## callers always check the file again.
+##
+class SGFSFileWatch:
+	IN_MODIFY      = 0x002
+	IN_ATTRIB      = 0x004
+	IN_CLOSE_WRITE = 0x008
+	IN_MOVED_TO    = 0x080
+	IN_CREATE      = 0x100
+	libc           = None
+	libcLoaded     = False
+
+	@staticmethod
+	def inotify():
+		if not SGFSFileWatch.libcLoaded:
+			SGFSFileWatch.libcLoaded=True
+			try:
+				libc=ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+				if hasattr(libc,'inotify_init1') and hasattr(libc,'inotify_add_watch'):
+					SGFSFileWatch.libc=libc
+			except OSError:
+				pass
+			if SGFSFileWatch.libc is None:
+				print "[!] inotify is not available; polling files every %s seconds" % SGFS_FilePollInterval
+		return SGFSFileWatch.libc
+
+	def __init__(self,file_name):
+		self.file_name    = file_name
+		self.fd           = -1
+		self.wd           = -1
+		self.watchingFile = False
+		libc=SGFSFileWatch.inotify()
+		if libc is not None:
+			self.fd=libc.inotify_init1(os.O_NONBLOCK)
+			if self.fd >= 0:
+				self.watch()
+
+	def watch(self):
+		libc=SGFSFileWatch.libc
+		if self.wd >= 0:
+			libc.inotify_rm_watch(self.fd,self.wd)
+		self.wd=libc.inotify_add_watch(self.fd,self.file_name,SGFSFileWatch.IN_MODIFY|SGFSFileWatch.IN_ATTRIB|SGFSFileWatch.IN_CLOSE_WRITE)
+		self.watchingFile=self.wd >= 0
+		if not self.watchingFile:
+			self.wd=libc.inotify_add_watch(self.fd,os.path.dirname(self.file_name) or '.',SGFSFileWatch.IN_CREATE|SGFSFileWatch.IN_MOVED_TO)
+			if self.wd < 0:
+				self.close()
+			elif os.path.exists(self.file_name):
+				# Created while the directory watch was being added
+				self.watch()
+
+	def wait(self,timeout=None):
+		if timeout is None or timeout > SGFS_FilePollInterval:
+			timeout=SGFS_FilePollInterval
+		if self.fd < 0:
+			time.sleep(timeout)
+			return
+		try:
+			readable=select.select([self.fd],[],[],timeout)[0]
+		except select.error:
+			return
+		if len(readable) > 0:
+			try:
+				while len(os.read(self.fd,4096)) > 0:
+					pass
+			except OSError:
+				pass
+		if not self.watchingFile and self.fd >= 0:
+			self.watch()
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd=-1
+			self.wd=-1
+
+	@staticmethod
+	def waitData(file_name,timeout,writer=None):
+		# Waits until file_name is not empty; False on timeout or when the
+		# writer (a command future) ended without writing anything
+		deadline=time.time()+timeout
+		watch=SGFSFileWatch(file_name)
+		try:
+			while True:
+				try:
+					if os.stat(file_name).st_size > 0:
+						return True
+				except OSError:
+					pass
+				if writer is not None and writer.done():
+					return False
+				remaining=deadline-time.time()
+				if remaining <= 0:
+					return False
+				watch.wait(remaining)
+		finally:
+			watch.close()
+
+##
+## Sends a local file (booking or lcg-cp staging copy) to the client
+##
+## When the file is already complete and the WSGI server offers a file
+## wrapper (mod_wsgi and the async server send it with sendfile; the
+## CherryPy HTTP server has none), the middleware installed by
+## get_wsgi_app() and main_async() takes the response over (the stream
+## is offered through a thread-local: CherryPy hands the application a
+## copy of the WSGI environ), so the bytes never go through Python.
+## Otherwise chunks()
+## reads the file in large windows; a file still written by 'writer' (the
+## future of its lcg-cp) is followed until it reaches the expected size.
+## As SGFSGfalReader, only the given (start,stop) ranges are sent.
+## onDone is called once, after the last byte has been handed out.
+## Without blocking (async server) chunks() yields an empty chunk instead
+## of waiting for the file to grow; the server asks again later.
+##
+class SGFSFileStream:
+	offered  = threading.local()
+	blocking = True
+
+	def __init__(self,file_name,file_size,writer=None,onDone=None,label=None,ranges=None):
+		if ranges is None:
+			ranges=[(0,file_size)]
+		self.file_name  = file_name
+		self.file_size  = file_size
+		self.writer     = writer
+		self.onDone     = onDone
+		self.label      = label
+		self.ranges     = ranges
+		self.sent       = 0
+		self.fd         = None
+		self.watch      = None
+		self.handedOver = False
+		self.finished   = False
+
+	def register(self):
+		# Offers the stream to the WSGI middleware (if any), which runs
+		# the application in the same thread
+		SGFSFileStream.offered.stream=self
+
+	@staticmethod
+	def take():
+		# The stream offered by the last handler of this thread (or None)
+		fileStream=getattr(SGFSFileStream.offered,'stream',None)
+		SGFSFileStream.offered.stream=None
+		return fileStream
+
+	def writing(self):
+		return self.writer is not None and not self.writer.done()
+
+	def complete(self):
+		try:
+			return not self.writing() and os.stat(self.file_name).st_size >= self.file_size
+		except OSError:
+			return False
+
+	def handOver(self,file_wrapper):
+		# Returns the server file wrapper sending the (single) range or None;
+		# the server stops at the Content-Length of the answer
+		if len(self.ranges) != 1 or self.sent > 0 or self.finished or not self.complete():
+			return None
+		fileobj=open(self.file_name,'rb')
+		fileobj.seek(self.ranges[0][0])
+		wrapper=file_wrapper(fileobj,SGFS_FileChunkSize)
+		self.handedOver=True
+		self.finish()
+		return wrapper
+
+	def finish(self):
+		if not self.finished:
+			self.finished=True
+			if self.onDone is not None:
+				self.onDone()
+
+	def chunks(self):
+		if self.handedOver:
+			return
+		last_growth=time.time()
+		try:
+			while self.fd is None:
+				try:
+					self.fd=os.open(self.file_name,os.O_RDONLY)
+				except OSError, e:
+					# The writer may not have created the file yet
+					if e.errno != errno.ENOENT or not self.writing() or time.time()-last_growth > SGFS_FileStallTimeout:
+						raise
+					if not SGFSFileStream.blocking:
+						yield ''
+						continue
+					self.waitGrowth()
+			for start,stop in self.ranges:
+				position=os.lseek(self.fd,start,os.SEEK_SET)
+				while position < stop:
+					data=os.read(self.fd,min(SGFS_FileChunkSize,stop-position))
+					if len(data) > 0:
+						position+=len(data)
+						self.sent+=len(data)
+						last_growth=time.time()
+						yield data
+						continue
+					# End of a file that may still be growing
+					if not self.writing() and os.fstat(self.fd).st_size <= position:
+						print "[%s] File '%s' ended at (%s/%s)" % (self.label,self.file_name,position,self.file_size)
+						return
+					if time.time()-last_growth > SGFS_FileStallTimeout:
+						print "[%s] File '%s' stalled at (%s/%s)" % (self.label,self.file_name,position,self.file_size)
+						return
+					if not SGFSFileStream.blocking:
+						yield ''
+						continue
+					self.waitGrowth()
+			self.finish()
+		finally:
+			self.close()
+
+	def waitGrowth(self):
+		# The first call only starts watching: the caller checks the file
+		# again, then waits for the changes made after that
+		if self.watch is None:
+			self.watch=SGFSFileWatch(self.file_name)
+		else:
+			self.watch.wait()
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd=None
+		if self.watch is not None:
+			self.watch.close()
+			self.watch=None
+
+##
+## HTTP Range support of the download services
+##
+## parse() returns the (start,stop) byte ranges asked by the client or
+## None when the whole file has to be sent (no or invalid Range header);
+## unsatisfiable ranges are answered with 416. setHeaders() prepares the
+## 200/206 answer and body() wraps the chunks of the ranges into a
+## multipart/byteranges body when more than one range was asked. The
+## chunks must never cross the end of a range.
+##
+class SGFSRanges:
+	def __init__(self,file_size,content_type='application/x-download'):
+		self.file_size    = file_size
+		self.content_type = content_type
+		self.ranges       = None
+		self.boundary     = None
+
+	def parse(self):
+		cherrypy.response.headers['Accept-Ranges']='bytes'
+		try:
+			ranges=get_ranges(cherrypy.request.headers.get('Range'),self.file_size)
+		except ValueError:
+			ranges=None
+		if ranges is not None:
+			if len(ranges) == 0:
+				cherrypy.response.headers['Content-Range']='bytes */%s' % self.file_size
+				raise cherrypy.HTTPError(416,"Requested Range Not Satisfiable")
+			self.ranges=[(max(start,0),min(stop,self.file_size)) for start,stop in ranges]
+		return self.ranges
+
+	def partHeader(self,start,stop):
+		return "--%s\r\nContent-Type: %s\r\nContent-Range: bytes %s-%s/%s\r\n\r\n" % (self.boundary,self.content_type,start,stop-1,self.file_size)
+
+	def setHeaders(self):
+		headers=cherrypy.response.headers
+		if self.ranges is None:
+			headers['Content-Length']='%s' % self.file_size
+			return
+		cherrypy.response.status=206
+		if len(self.ranges) == 1:
+			start,stop=self.ranges[0]
+			headers['Content-Range' ]='bytes %s-%s/%s' % (start,stop-1,self.file_size)
+			headers['Content-Length']='%s' % (stop-start)
+			return
+		self.boundary=uuid.uuid4().hex
+		length=len("--%s--\r\n" % self.boundary)
+		for start,stop in self.ranges:
+			length+=len(self.partHeader(start,stop))+stop-start+2
+		headers['Content-Type'  ]='multipart/byteranges; boundary=%s' % self.boundary
+		headers['Content-Length']='%s' % length
+
+	def body(self,chunks):
+		if self.boundary is None:
+			return chunks
+		return self.multipart(iter(chunks))
+
+	def multipart(self,chunks):
+		try:
+			for start,stop in self.ranges:
+				yield self.partHeader(start,stop)
+				left=stop-start
+				while left > 0:
+					data=chunks.next()
+					left-=len(data)
+					yield data
+				yield "\r\n"
+			yield "--%s--\r\n" % self.boundary
+		finally:
+			if hasattr(chunks,'close'):
+				chunks.close()
+
+##
+## Thread-safe LRU cache with an optional time to live for each entry
+##
+## The cache holds at most 'size' units; by default each entry weights
+## one unit, callers may give a different weight to bigger entries.
+##
+class SGFSLRUCache:
+	def __init__(self,size,ttl=None):
+		self.size=size
+		self.ttl=ttl
+		self.weight=0
+		self.entries=OrderedDict() # key -> (timestamp,weight,value)
+		self.lock=threading.Lock()
+
+	def get(self,key):
+		self.lock.acquire()
+		try:
+			entry=self.entries.pop(key,None)
+			if entry is None:
+				return None
+			if self.ttl is not None and time.time()-entry[0] > self.ttl:
+				self.weight-=entry[1]
+				return None
+			# Move it to the most recently used position
+			self.entries[key]=entry
+			return entry[2]
+		finally:
+			self.lock.release()
+
+	def put(self,key,value,weight=1):
+		self.lock.acquire()
+		try:
+			self.pop(key)
+			if weight > self.size:
+				return
+			self.entries[key]=(time.time(),weight,value)
+			self.weight+=weight
+			while self.weight > self.size:
+				self.weight-=self.entries.popitem(last=False)[1][1]
+		finally:
+			self.lock.release()
+
+	def pop(self,key):
+		entry=self.entries.pop(key,None)
+		if entry is not None:
+			self.weight-=entry[1]
+
+	def evict(self,key):
+		self.lock.acquire()
+		try:
+			self.pop(key)
+		finally:
+			self.lock.release()
+
+	def clear(self):
+		self.lock.acquire()
+		try:
+			self.entries.clear()
+			self.weight=0
+		finally:
+			self.lock.release()
+
+##
+## Class that keeps a bounded pool of MySQL connections
+##
+## Each thread gets its own connection on the first query and keeps it
+## until release() is called (see the 'sgfs_dbrelease' CherryPy tools);
+## in this way all queries of a single request share one connection.
+## Threads running outside of CherryPy requests must call release().
+## Background threads (see SGFSDB.background()) take their connections
+## from a budget of their own, so they never starve the requests. A
+## thread waits at most 'timeout' seconds for a connection, then gets a
+## 503 error. Idle connections are checked with ping() before being
+## reused and replaced with a new one when stale.
+##
+class SGFSDBPool:
+	def __init__(self,connect_args,size=SGFS_DBPoolSize,background_size=SGFS_DBBackgroundPoolSize,timeout=SGFS_DBPoolTimeout):
+		self.connect_args=connect_args
+		self.size=size
+		self.timeout=timeout
+		self.idle=[]
+		self.lock=threading.Lock()
+		self.slots=threading.Condition()
+		self.limits={False: size, True: background_size}
+		self.used={False: 0, True: 0}
+		self.local=threading.local()
+
+	def acquire(self,background=False):
+		dbConn=getattr(self.local,'dbConn',None)
+		if dbConn is not None:
+			return dbConn
+		self.take(background)
+		try:
+			dbConn=self.checkout()
+		except:
+			self.give(background)
+			raise
+		self.local.dbConn=dbConn
+		self.local.background=background
+		return dbConn
+
+	def take(self,background):
+		deadline=time.time()+self.timeout
+		self.slots.acquire()
+		try:
+			while self.used[background] >= self.limits[background]:
+				remaining=deadline-time.time()
+				if remaining <= 0:
+					print "[DB] No free connection after %s seconds" % self.timeout
+					raise cherrypy.HTTPError(503,"No database connection available, try again later")
+				self.slots.wait(remaining)
+			self.used[background]+=1
+		finally:
+			self.slots.release()
+
+	def give(self,background):
+		self.slots.acquire()
+		try:
+			self.used[background]-=1
+			# Waiters of both budgets share the condition
+			self.slots.notifyAll()
+		finally:
+			self.slots.release()
+
+	def checkout(self):
+		while True:
+			self.lock.acquire()
+			try:
+				if len(self.idle) == 0:
+					break
+				dbConn=self.idle.pop()
+			finally:
+				self.lock.release()
+			try:
+				dbConn.ping()
+				return dbConn
+			except MySQLdb.Error:
+				print "[DB] Dropping stale connection"
+				self.discard(dbConn)
+		return MySQLdb.connect(*self.connect_args)
+
+	def release(self):
+		dbConn=getattr(self.local,'dbConn',None)
+		if dbConn is None:
+			return
+		self.local.dbConn=None
+		try:
+			# Uncommitted work never leaks to the next request
+			dbConn.rollback()
+			self.lock.acquire()
+			try:
+				self.idle.append(dbConn)
+			finally:
+				self.lock.release()
+		except MySQLdb.Error:
+			self.discard(dbConn)
+		self.give(self.local.background)
+
+	def discard(self,dbConn):
+		try:
+			dbConn.close()
+		except MySQLdb.Error:
+			pass
+
+##
+## Class that keeps in memory the SGFS reference tables
+##
+## Users, applications and infrastructures rarely change, so they are
+## loaded all together and reloaded after SGFS_RefCacheTTL seconds, on
+## invalidate() (SIGUSR1 or the /refresh_cache service) or when a name
+## is not found. Unknown names reload the tables at most once every
+## SGFS_RefMissTTL seconds, so repeated bad names do not reload them
+## on every request.
+##
+class SGFSRefCache:
+	def __init__(self,ttl=SGFS_RefCacheTTL,miss_ttl=SGFS_RefMissTTL):
+		self.ttl=ttl
+		self.miss_ttl=miss_ttl
+		self.loadLock=threading.Lock()
+		self.loaded_at=None
+		self.users={}           # user_name -> user_id
+		self.applications={}    # app_name  -> app_id
+		self.app_infras={}      # app_id    -> infra_id
+		self.infrastructures={} # infra_id  -> sgfs_infrastructures row
+
+	def expired(self):
+		return self.loaded_at is None or time.time()-self.loaded_at > self.ttl
+
+	def invalidate(self):
+		print "[i] Reference data cache invalidated"
+		self.loaded_at=None
+
+	def load(self,sgfsDB):
+		users={}
+		applications={}
+		app_infras={}
+		infrastructures={}
+		sgfsDB.connect()
+		cursor=sgfsDB.execute("""select user_id,user_name from sgfs_users;""")
+		for row in cursor.fetchall():
+			users[row[1]]=row[0]
+		cursor=sgfsDB.execute("""select app_id,app_name,infra_id from sgfs_applications;""")
+		for row in cursor.fetchall():
+			applications[row[1]]=row[0]
+			app_infras[row[0]]=row[2]
+		cursor=sgfsDB.execute("""select infra_id,infra_name,infra_desc,infra_pxhost,infra_pxport,infra_pxid,infra_pxvo,infra_pxrole,infra_pxrenewal,infra_bdii,infra_lfc from sgfs_infrastructures;""")
+		for row in cursor.fetchall():
+			infrastructures[row[0]]=tuple(row)
+		sgfsDB.close()
+		# Swap the whole set of tables at once; readers never see a mix
+		self.users=users
+		self.applications=applications
+		self.app_infras=app_infras
+		self.infrastructures=infrastructures
+		self.loaded_at=time.time()
+
+	def stale(self,max_age):
+		return self.loaded_at is None or time.time()-self.loaded_at >= max_age
+
+	def refresh(self,sgfsDB,max_age=None):
+		# Reloads expired tables, or tables older than max_age seconds;
+		# threads waiting for the lock find them already reloaded
+		self.loadLock.acquire()
+		try:
+			if self.expired() or (max_age is not None and self.stale(max_age)):
+				self.load(sgfsDB)
+		finally:
+			self.loadLock.release()
+
+	def lookup(self,sgfsDB,table,key):
+		reloaded=self.expired()
+		if reloaded:
+			self.refresh(sgfsDB)
+		value=getattr(self,table).get(key)
+		if value is None and not reloaded and self.stale(self.miss_ttl):
+			# Maybe a brand new entry; give the database a second chance
+			self.refresh(sgfsDB,self.miss_ttl)
+			value=getattr(self,table).get(key)
+		if value is None:
+			raise KeyError("Unknown %s: '%s'" % (table,key))
+		return value
+
 ##
 ## Class that interacts with the SGFS database
 ##
 class SGFSDB:
+	pool     = None
+	poolLock = threading.Lock()
+	threads  = threading.local() # 'background' flag of the calling thread
+	refCache = SGFSRefCache()
+	lfcCache = SGFSLRUCache(SGFS_LFCCacheSize,SGFS_LFCCacheTTL) # transaction_id -> LFC
+
 	def __init__(self):
 		self.database_host='localhost'
 		self.database_port='3036'
@@ -202,15 +2084,36 @@ class SGFSDB:
 		self.database_password='sgfs_password'
 		self.dbConn=None
 
+	def getPool(self):
+		if SGFSDB.pool is None:
+			SGFSDB.poolLock.acquire()
+			try:
+				if SGFSDB.pool is None:
+					SGFSDB.pool = SGFSDBPool((\
+						self.database_host,\
+						self.database_username,\
+						self.database_password,\
+						self.database_name))
+			finally:
+				SGFSDB.poolLock.release()
+		return SGFSDB.pool
+
 	def connect(self):
-		self.dbConn = MySQLdb.connect(\
-			self.database_host,\
-			self.database_username,\
-			self.database_password,\
-			self.database_name)
+		self.dbConn = self.getPool().acquire(getattr(SGFSDB.threads,'background',False))
+
+	@staticmethod
+	def background():
+		# Called by long-lived threads serving no request (see SGFSDBPool)
+		SGFSDB.threads.background=True
 
 	def close(self):
-		self.dbConn.close()
+		# The connection stays bound to the thread until release()
+		self.dbConn=None
+
+	@staticmethod
+	def release():
+		if SGFSDB.pool is not None:
+			SGFSDB.pool.release()
 
 	def commit(self):
 		self.dbConn.commit()
@@ -222,34 +2125,21 @@ class SGFSDB:
 		return cursor
 
 	def getUserId(self,user_name=None):
-		self.connect()
-		cursor = self.execute("""select user_id from sgfs_users where user_name = '%s';""" % user_name)
-		user_id=cursor.fetchone()[0]
-		self.close()
-		return user_id
+		return SGFSDB.refCache.lookup(self,'users',user_name)
 
 	def getApplicationId(self,application_name=None):
-		self.connect()
-		cursor = self.execute("""select app_id from sgfs_applications where app_name = '%s';""" % application_name)
-		application_id=cursor.fetchone()[0]
-		self.close()
-		return application_id
+		return SGFSDB.refCache.lookup(self,'applications',application_name)
 
 	def getAppInfraId(self,app_id=None):
-		self.connect()
-		cursor = self.execute("""select infra_id from sgfs_applications where app_id=%s""" % app_id)
-		infra_id=cursor.fetchone()[0]
-		self.close()
-		return infra_id
+		return SGFSDB.refCache.lookup(self,'app_infras',long(app_id))
 
 	def registerTransaction(self,user_name,app_name):
 		user_id=self.getUserId(user_name)
 		app_id=self.getApplicationId(app_name)
 		infra_id=self.getAppInfraId(app_id)
 		self.connect()
-		self.execute("""insert into sgfs_transactions (user_id,app_id,infra_id,transaction_from,transaction_ip) values (%s,%s,%s,now(),'%s');""" %(user_id,app_id,infra_id,cherrypy.request.remote.ip))
-		cursor=self.execute("""select max(transaction_id) from sgfs_transactions where user_id=%s and app_id=%s;""" %(user_id,app_id))
-		transaction_id= cursor.fetchone()[0]
+		cursor=self.execute("""insert into sgfs_transactions (user_id,app_id,infra_id,transaction_from,transaction_ip) values (%s,%s,%s,now(),'%s');""" %(user_id,app_id,infra_id,cherrypy.request.remote.ip))
+		transaction_id=cursor.lastrowid
 		self.commit()
 		self.close()
 		return transaction_id
@@ -261,62 +2151,99 @@ class SGFSDB:
 		self.close()
 		return app_vo
 
-	def storeTransactionProxy(self,transaction_id,tmpfile):
+	def storeTransactionProxy(self,transaction_id,tmpfile):
+		self.connect()
+		self.execute("""update sgfs_transactions set transaction_proxy = '%s' where transaction_id = %s;""" % (tmpfile,transaction_id))
+		self.commit()
+		self.close()
+		SGFSDB.lfcCache.evict(str(transaction_id))
+
+	def getInfrastrucutureById(self,infra_id):
+		return SGFSDB.refCache.lookup(self,'infrastructures',long(infra_id))
+
+	def closeTransaction(self,transaction_id):
+		SGFSDB.lfcCache.evict(str(transaction_id))
+		self.connect()
+		self.execute("""update sgfs_transactions set transaction_to = now() where transaction_id=%s;""" % transaction_id)
+		self.commit()
+		cursor=self.execute("""select transaction_proxy from sgfs_transactions where transaction_id=%s;""" % transaction_id)
+		tmp_file=cursor.fetchone()[0]
+		self.close()
+		return tmp_file
+
+	def getOpenTransactions(self):
+		# (transaction_id,transaction_from,last request) of the transactions
+		# not closed yet
 		self.connect()
-		self.execute("""update sgfs_transactions set transaction_proxy = '%s' where transaction_id = %s;""" % (tmpfile,transaction_id))
-		self.commit()
+		cursor=self.execute("""select transaction_id, unix_timestamp(transaction_from), unix_timestamp(coalesce(transaction_touched,transaction_from)) from sgfs_transactions where transaction_to is null;""")
+		transactions=cursor.fetchall()
 		self.close()
+		return transactions
 
-	def getInfrastrucutureById(self,infra_id):
+	def getTransactionTimes(self,transaction_id):
+		# (transaction_from,last request) of an open transaction or None
 		self.connect()
-		cursor=self.execute("""select infra_id,infra_name,infra_desc,infra_pxhost,infra_pxport,infra_pxid,infra_pxvo,infra_pxrole,infra_pxrenewal,infra_bdii,infra_lfc from sgfs_infrastructures where infra_id=%s;""" % infra_id)
+		cursor=self.execute("""select unix_timestamp(transaction_from), unix_timestamp(coalesce(transaction_touched,transaction_from)) from sgfs_transactions where transaction_id=%s and transaction_to is null;""" % transaction_id)
 		row=cursor.fetchone()
-		t =  (row[0], \
-		      row[1], \
-		      row[2], \
-		      row[3], \
-		      row[4], \
-		      row[5], \
-		      row[6], \
-		      row[7], \
-		      row[8], \
-		      row[9], \
-		      row[10])
 		self.close()
-		return t
+		return row
 
-	def closeTransaction(self,transaction_id):
+	def touchTransactions(self,touches):
+		# Many (last request,transaction_id) with a single update; the
+		# latest time written by any server process is kept
 		self.connect()
-		self.execute("""update sgfs_transactions set transaction_to = now() where transaction_id=%s;""" % transaction_id)
+		sql_query="""update sgfs_transactions set transaction_touched=greatest(coalesce(transaction_touched,transaction_from),from_unixtime(%s)) where transaction_id=%s and transaction_to is null;"""
+		self.dbConn.cursor().executemany(sql_query,touches)
 		self.commit()
-		cursor=self.execute("""select transaction_proxy from sgfs_transactions where transaction_id=%s;""" % transaction_id)
-		tmp_file=cursor.fetchone()[0]
 		self.close()
-		return tmp_file
 
 	def getTransactionLFCData(self,transaction_id):
+		return self.getTransactionLFC(transaction_id).lfcData()
+
+	def getTransactionLFC(self,transaction_id):
+		# The LFC context does not change during the whole transaction life
+		lfc=SGFSDB.lfcCache.get(str(transaction_id))
+		if lfc is not None:
+			return lfc
 		self.connect()
 		cursor=self.execute("""select i.infra_bdii, i.infra_lfc, a.app_lfcdir, u.user_name, transaction_proxy, i.infra_pxvo from sgfs_transactions t, sgfs_infrastructures i, sgfs_users u, sgfs_applications a where t.infra_id=i.infra_id and t.app_id = a.app_id and t.user_id=u.user_id and t.transaction_id=%s;""" % transaction_id)
 		row=cursor.fetchone()
-		t = (row[0], \
-		     row[1], \
-		     row[2], \
-		     row[3], \
-		     row[4], \
-		     row[5])
 		self.close()
-		return t
+		lfc=LFC(row[0], \
+		        row[1], \
+		        row[2], \
+		        row[3], \
+		        row[4], \
+		        row[5])
+		SGFSDB.lfcCache.put(str(transaction_id),lfc)
+		return lfc
 
 	def registerAction(self,transaction_id,action,lfc_file_name,file_name):
+		# Written at once, for the callers that need the action_id
 		self.connect()
-		self.execute("""insert into sgfs_actions (transaction_id,action_ts,action,lfc_file_name,file_name,action_ip) values (%s,now(),%s,'%s','%s','%s');""" %(transaction_id,action,lfc_file_name,file_name,cherrypy.request.remote.ip))
-		cursor = self.execute("""select max(action_id) from sgfs_actions;""")
-		action_id=cursor.fetchone()[0]
+		cursor=self.execute("""insert into sgfs_actions (transaction_id,action_ts,action,lfc_file_name,file_name,action_ip) values (%s,now(),%s,'%s','%s','%s');""" %(transaction_id,action,lfc_file_name,file_name,cherrypy.request.remote.ip))
+		action_id=cursor.lastrowid
 		self.commit()
 		self.close()
 		return action_id
 
+	def logAction(self,transaction_id,action,lfc_file_name,file_name):
+		# Written later by the action log (see SGFSActionLog)
+		SGFSActionLog.get().add(transaction_id,action,lfc_file_name,file_name,cherrypy.request.remote.ip)
+
+	def insertActions(self,actions):
+		# Many (transaction_id,action_ts,action,lfc_file_name,file_name,action_ip)
+		# with a single insert
+		self.connect()
+		sql_query="""insert into sgfs_actions (transaction_id,action_ts,action,lfc_file_name,file_name,action_ip) values (%s,%s,%s,%s,%s,%s);"""
+		print "%s [%s rows]" % (sql_query,len(actions))
+		self.dbConn.cursor().executemany(sql_query,actions)
+		self.commit()
+		self.close()
+
 	def getActionFiles(self,transaction_id):
+		# Pending DOWNLOAD actions must be seen too
+		SGFSActionLog.flushAll()
 		self.connect()
 		cursor=self.execute("""select file_name from sgfs_actions where transaction_id=%s and action=0;""" % transaction_id)
 		file_list=()
@@ -325,15 +2252,43 @@ class SGFSDB:
 		self.close()
 		return file_list
 
-	def registerBooking(self,action_id,transaction_id,file_size,p):
+	def registerBooking(self,action_id,transaction_id,file_size,download_pid=None):
+		# download_pid is NULL until the booking leaves the queue
+		if download_pid is None:
+			download_pid='NULL'
 		self.connect()
-		self.execute("""insert into sgfs_bookings (action_id,transaction_id,file_size,download_file_size,download_pid,booking_ip) values (%s,%s,%s,0,%s,'%s');""" % (action_id,transaction_id,file_size,p.pid,cherrypy.request.remote.ip))
-		cursor = self.execute("""select max(booking_id) from sgfs_bookings;""")
-		booking_id=cursor.fetchone()[0]
+		cursor=self.execute("""insert into sgfs_bookings (action_id,transaction_id,file_size,download_file_size,download_pid,booking_ip) values (%s,%s,%s,0,%s,'%s');""" % (action_id,transaction_id,file_size,download_pid,cherrypy.request.remote.ip))
+		booking_id=cursor.lastrowid
 		self.commit()
 		self.close()
 		return booking_id
 
+	def logActions(self,transaction_id,action,files):
+		# Actions on many (lfc_file_name,file_name), written together later
+		actionLog=SGFSActionLog.get()
+		for lfc_file_name,file_name in files:
+			actionLog.add(transaction_id,action,lfc_file_name,file_name,cherrypy.request.remote.ip)
+
+	def registerBookings(self,transaction_id,bookings):
+		# BOOKING actions and bookings of many (lfc_file_name,file_name,file_size)
+		# in a single transaction; returns their (action_id,booking_id)
+		ids=[]
+		self.connect()
+		for lfc_file_name,file_name,file_size in bookings:
+			cursor=self.execute("""insert into sgfs_actions (transaction_id,action_ts,action,lfc_file_name,file_name,action_ip) values (%s,now(),2,'%s','%s','%s');""" %(transaction_id,lfc_file_name,file_name,cherrypy.request.remote.ip))
+			action_id=cursor.lastrowid
+			cursor=self.execute("""insert into sgfs_bookings (action_id,transaction_id,file_size,download_file_size,download_pid,booking_ip) values (%s,%s,%s,0,NULL,'%s');""" % (action_id,transaction_id,file_size,cherrypy.request.remote.ip))
+			ids.append((action_id,cursor.lastrowid))
+		self.commit()
+		self.close()
+		return ids
+
+	def updateBookingPid(self,booking_id,download_pid):
+		self.connect()
+		self.execute("""update sgfs_bookings set download_pid = %s where booking_id = %s;""" % (download_pid,booking_id))
+		self.commit()
+		self.close()
+
 	def getTransactionKeys(self,transaction_id):
 		self.connect()
 		cursor = self.execute("""select user_id, app_id from sgfs_transactions where transaction_id = %s""" % transaction_id)
@@ -370,40 +2325,48 @@ class SGFSDB:
 		self.close()
 		return file_name
 
+	def getOpenBookings(self):
+		# (booking_id,download_pid,file_name,booking time) of the open bookings
+		self.connect()
+		cursor=self.execute("""select b.booking_id, b.download_pid, a.file_name, unix_timestamp(a.action_ts) from sgfs_bookings b, sgfs_actions a where a.action_id = b.action_id and a.action=2;""")
+		bookings=cursor.fetchall()
+		self.close()
+		return bookings
+
 	def closeBookings(self,transaction_id,booking_ids):
+		# One select and one update for all the bookings; returns their
+		# files and (booking_id,download_pid)
 		booking_files=()
 		booking_pids=()
 		if booking_ids is None:
-			booking_ids=()
 			user_id, app_id = self.getTransactionKeys(transaction_id)
 			self.connect()
 			cursor = self.execute("""select b.booking_id, b.download_pid ,a.file_name from sgfs_bookings b, sgfs_actions a, sgfs_transactions t where a.transaction_id = t.transaction_id and b.transaction_id = t.transaction_id and a.action_id = b.action_id and a.action=2 and t.user_id = %s and t.app_id = %s;""" % (user_id,app_id))
-			for row in cursor.fetchall():
-				booking_ids=booking_ids+(row[0],)
-				booking_pids=booking_pids+(row[1],)
-				booking_files=booking_files+(row[2],)
-			self.close()
 		else:
+			# Ids from the request (strings) or from the database (numbers)
+			booking_ids=[str(booking_id).strip() for booking_id in booking_ids]
+			booking_ids=[booking_id for booking_id in booking_ids if booking_id.isdigit()]
+			if len(booking_ids) == 0:
+				return (booking_files,booking_pids)
 			self.connect()
-			for booking_id in booking_ids:
-				cursor = self.execute("""select a.file_name, b.download_pid from sgfs_actions a, sgfs_bookings b  where a.action_id = b.action_id and b.download_pid is not NULL and b.booking_id = %s;""" % booking_id)
-				for row in cursor.fetchall():
-					booking_files=booking_files+(row[0],)
-					booking_pids=booking_pids+(row[1],)
-			self.close()
-		self.connect()
-		for booking_id in booking_ids:
-			self.execute("""update sgfs_actions set action=3 where action_id = (select action_id from sgfs_bookings where booking_id = %s);""" % booking_id)
-		self.commit()
+			cursor = self.execute("""select b.booking_id, b.download_pid, a.file_name from sgfs_actions a, sgfs_bookings b where a.action_id = b.action_id and b.booking_id in (%s);""" % ','.join(booking_ids))
+		booking_ids=()
+		for row in cursor.fetchall():
+			booking_ids=booking_ids+(row[0],)
+			booking_pids=booking_pids+((row[0],row[1]),)
+			booking_files=booking_files+(row[2],)
+		if len(booking_ids) > 0:
+			self.execute("""update sgfs_actions a join sgfs_bookings b on a.action_id = b.action_id set a.action=3 where b.booking_id in (%s);""" % ','.join([str(booking_id) for booking_id in booking_ids]))
+			self.commit()
 		self.close()
 		return (booking_files,booking_pids)
 		
 	def orphanBooking(self, booking_id, download_pid):
 		self.connect()
 		#self.execute("""update sgfs_bookings set download_pid=NULL where booking_id = %s and download_pid = %s;""" % (booking_id,download_pid))
-		self.execute("""update sgfs_actions set action=5 where action_id=(select action_id from sgfs_bookings where booking_id=%s);""" % booking_id)
+		self.execute("""update sgfs_actions a join sgfs_bookings b on a.action_id = b.action_id set a.action=5 where b.booking_id=%s;""" % booking_id)
 		self.commit()
-		cursor=self.execute("""select file_name from sgfs_actions where action_id = (select b.action_id from sgfs_bookings b where booking_id = %s);""" % booking_id);
+		cursor=self.execute("""select a.file_name from sgfs_actions a, sgfs_bookings b where a.action_id = b.action_id and b.booking_id = %s;""" % booking_id);
 		file_name=cursor.fetchone()[0]
 		self.close()
 		return file_name
@@ -432,10 +2395,574 @@ class SGFSDB:
 		self.close()
 		return user_name,application_name,lfc_file_name,lfc_absolute_path,date_from,date_to,down_count
 
+##
+## Write-behind log of the SGFS actions
+##
+## Actions are queued with the time and address of the request and a
+## background thread writes them with batched inserts, once SGFS_ActionLogBatch
+## of them are waiting or the oldest one waited SGFS_ActionLogInterval seconds.
+## Callers only wait when SGFS_ActionLogSize actions are already queued.
+## flush() returns once everything queued before it has been written; it is
+## called on shutdown (engine 'stop' and atexit).
+##
+class SGFSActionLog:
+	log     = None
+	logLock = threading.Lock()
+
+	@staticmethod
+	def get():
+		if SGFSActionLog.log is None:
+			SGFSActionLog.logLock.acquire()
+			try:
+				if SGFSActionLog.log is None:
+					SGFSActionLog.log=SGFSActionLog()
+			finally:
+				SGFSActionLog.logLock.release()
+		return SGFSActionLog.log
+
+	@staticmethod
+	def flushAll():
+		if SGFSActionLog.log is not None:
+			SGFSActionLog.log.flush()
+
+	def __init__(self,size=SGFS_ActionLogSize,batch=SGFS_ActionLogBatch,interval=SGFS_ActionLogInterval):
+		self.size=size
+		self.batch=batch
+		self.interval=interval
+		self.cond=threading.Condition()
+		self.actions=deque()  # (queue_time,(transaction_id,action_ts,...))
+		self.queued=0         # Actions ever queued
+		self.taken=0          # Actions ever taken by the writer
+		self.written=0        # Actions ever written (or lost)
+		self.flushTo=0        # Actions to write at once, for flush()
+		self.thread=threading.Thread(target=self.run,name='sgfs-actionlog')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def add(self,transaction_id,action,lfc_file_name,file_name,action_ip):
+		now=time.time()
+		action_ts=time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(now))
+		self.cond.acquire()
+		try:
+			while len(self.actions) >= self.size:
+				self.cond.wait(self.interval)
+			self.actions.append((now,(transaction_id,action_ts,action,lfc_file_name,file_name,action_ip)))
+			self.queued+=1
+			if len(self.actions) >= self.batch:
+				self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+	def flush(self):
+		# Waits for the actions queued so far only (not the later ones)
+		self.cond.acquire()
+		try:
+			ticket=self.queued
+			self.flushTo=max(self.flushTo,ticket)
+			self.cond.notifyAll()
+			while self.written < ticket:
+				self.cond.wait(self.interval)
+		finally:
+			self.cond.release()
+
+	def ready(self):
+		# True when the writer has to take a batch
+		if len(self.actions) == 0:
+			return False
+		if len(self.actions) >= self.batch or self.flushTo > self.taken:
+			return True
+		return time.time() >= self.actions[0][0]+self.interval
+
+	def run(self):
+		SGFSDB.background()
+		while True:
+			self.cond.acquire()
+			try:
+				while not self.ready():
+					if len(self.actions) == 0:
+						self.cond.wait()
+					else:
+						self.cond.wait(max(0,self.actions[0][0]+self.interval-time.time()))
+				actions=[]
+				while len(self.actions) > 0 and len(actions) < self.batch:
+					actions.append(self.actions.popleft()[1])
+				self.taken+=len(actions)
+				# Room for callers waiting in add()
+				self.cond.notifyAll()
+			finally:
+				self.cond.release()
+			self.write(actions)
+			self.cond.acquire()
+			try:
+				self.written+=len(actions)
+				self.cond.notifyAll()
+			finally:
+				self.cond.release()
+
+	def write(self,actions):
+		try:
+			SGFSDB().insertActions(actions)
+		except Exception, e:
+			print "[actionlog] Unable to write %s actions: %s" % (len(actions),e)
+			for action in actions:
+				print "[actionlog] Lost action: %s" % (action,)
+		finally:
+			SGFSDB.release()
+
+##
+## Background reaper of stale transactions, bookings and booking directories
+##
+## Open transactions and bookings are kept with their creation and last
+## access times; a heap of (deadline,sequence,kind,key) wakes the reaper
+## thread when the earliest one may expire. Touches only update the access
+## time: popped entries whose deadline moved are pushed back, forgotten
+## ones are dropped. A transaction expires SGFS_TransactionIdleTimeout
+## seconds after its last request or SGFS_TransactionMaxAge seconds after
+## it began and is then closed as /close does. Requests may be served by
+## other server processes: the last request of each transaction is
+## written to the database at every scan and read back before closing it,
+## so only transactions idle in every process are closed. Bookings expire
+## in the same way (last /bookings check or download) and are closed as
+## /close_bookings does; bookings left in the queue of a previous server
+## run are marked as orphans. Every SGFS_ReaperScanInterval seconds booking directories are
+## removed unless LFC.book() registered them (booking not submitted yet)
+## or an open booking of the database references them. Open transactions
+## and bookings are loaded from the database when the reaper starts.
+## Requests naming a transaction touch it, and so does every chunk of
+## their streamed answer (long downloads).
+##
+class SGFSReaper:
+	reaper     = None
+	reaperLock = threading.Lock()
+
+	@staticmethod
+	def get():
+		if SGFSReaper.reaper is None:
+			SGFSReaper.reaperLock.acquire()
+			try:
+				if SGFSReaper.reaper is None:
+					SGFSReaper.reaper=SGFSReaper()
+			finally:
+				SGFSReaper.reaperLock.release()
+		return SGFSReaper.reaper
+
+	@staticmethod
+	def deadline(created,touched,idle,max_age):
+		# None when neither limit applies
+		deadlines=[]
+		if idle is not None:
+			deadlines.append(touched+idle)
+		if max_age is not None:
+			deadlines.append(created+max_age)
+		if len(deadlines) == 0:
+			return None
+		return min(deadlines)
+
+	def __init__(self):
+		self.cond         = threading.Condition()
+		self.heap         = []  # (deadline,sequence,kind,key)
+		self.sequence     = itertools.count()
+		self.transactions = {}  # transaction_id -> [created,touched]
+		self.touched      = {}  # transaction_id -> last request, not in the database yet
+		self.bookings     = {}  # booking_id -> [created,touched,file_name,download_pid]
+		self.dirs         = {}  # booking directory -> created, until its booking is added
+		self.thread       = threading.Thread(target=self.run,name='sgfs-reaper')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def push(self,deadline,kind,key=None):
+		# Called with the lock held
+		if deadline is None:
+			return
+		heapq.heappush(self.heap,(deadline,self.sequence.next(),kind,key))
+		if self.heap[0][2] == kind and self.heap[0][3] == key:
+			self.cond.notify()
+
+	def entryDeadline(self,kind,key):
+		# Called with the lock held; current deadline of an entry
+		if kind == 'transaction':
+			created,touched=self.transactions[key]
+			return SGFSReaper.deadline(created,touched,SGFS_TransactionIdleTimeout,SGFS_TransactionMaxAge)
+		created,touched,file_name,download_pid=self.bookings[key]
+		return SGFSReaper.deadline(created,touched,SGFS_BookingIdleTimeout,SGFS_BookingMaxAge)
+
+	def addTransaction(self,transaction_id,created=None,touched=None):
+		now=time.time()
+		self.cond.acquire()
+		try:
+			if created is None:
+				created=now
+			if touched is None:
+				touched=now
+			self.transactions[long(transaction_id)]=[created,touched]
+			self.push(self.entryDeadline('transaction',long(transaction_id)),'transaction',long(transaction_id))
+		finally:
+			self.cond.release()
+
+	def addBooking(self,booking_id,file_name,created=None,download_pid=None,touched=None):
+		now=time.time()
+		if created is None:
+			created=now
+		if touched is None:
+			touched=now
+		self.cond.acquire()
+		try:
+			if file_name:
+				self.dirs.pop(os.path.dirname(file_name),None)
+			self.bookings[long(booking_id)]=[created,touched,file_name,download_pid]
+			self.push(self.entryDeadline('booking',long(booking_id)),'booking',long(booking_id))
+		finally:
+			self.cond.release()
+
+	def addDir(self,booking_dir):
+		# Booking directory created before its booking is registered
+		self.cond.acquire()
+		try:
+			self.dirs[booking_dir]=time.time()
+		finally:
+			self.cond.release()
+
+	def touch(self,entries,key,unsaved=None):
+		try:
+			key=long(key)
+		except (TypeError,ValueError):
+			return
+		now=time.time()
+		self.cond.acquire()
+		try:
+			entry=entries.get(key)
+			if entry is not None:
+				entry[1]=now
+			if unsaved is not None:
+				unsaved[key]=now
+		finally:
+			self.cond.release()
+
+	def touchTransaction(self,transaction_id):
+		# Also transactions begun by other server processes, which read
+		# the requests served here from the database (see saveTouches)
+		self.touch(self.transactions,transaction_id,self.touched)
+
+	def touchBooking(self,booking_id):
+		self.touch(self.bookings,booking_id)
+
+	def forget(self,entries,keys):
+		self.cond.acquire()
+		try:
+			for key in keys:
+				try:
+					entries.pop(long(key),None)
+				except (TypeError,ValueError):
+					pass
+		finally:
+			self.cond.release()
+
+	def forgetTransaction(self,transaction_id):
+		self.forget(self.transactions,(transaction_id,))
+
+	def forgetBookings(self,booking_ids):
+		self.forget(self.bookings,booking_ids)
+
+	@staticmethod
+	def touchRequest():
+		# CherryPy tool: any request naming a transaction keeps it alive
+		handler=cherrypy.request.handler
+		if handler is None or SGFSReaper.reaper is None:
+			return
+		transaction_id=handler.kwargs.get('transaction_id')
+		if transaction_id is None and len(handler.args) > 0:
+			try:
+				args=inspect.getargspec(handler.callable).args
+			except TypeError:
+				return
+			if len(args) > 1 and args[1] == 'transaction_id':
+				transaction_id=handler.args[0]
+		if transaction_id is not None:
+			SGFSReaper.reaper.touchTransaction(transaction_id)
+			cherrypy.request.sgfs_transaction_id=transaction_id
+
+	@staticmethod
+	def touchResponse():
+		# CherryPy tool: streamed answers keep their transaction alive
+		# while they are sent
+		transaction_id=getattr(cherrypy.request,'sgfs_transaction_id',None)
+		body=cherrypy.response.body
+		if transaction_id is None or SGFSReaper.reaper is None or isinstance(body,(basestring,list,tuple)):
+			return
+		cherrypy.response.body=SGFSReaper.reaper.touchBody(transaction_id,body)
+
+	def touchBody(self,transaction_id,body):
+		try:
+			for data in body:
+				self.touchTransaction(transaction_id)
+				yield data
+		finally:
+			if hasattr(body,'close'):
+				body.close()
+
+	def load(self):
+		sgfsDB=SGFSDB()
+		for transaction_id,transaction_from,transaction_touched in sgfsDB.getOpenTransactions():
+			self.addTransaction(transaction_id,float(transaction_from),float(transaction_touched))
+		supervisor=SGFSBookingSupervisor.get()
+		for booking_id,download_pid,file_name,booking_ts in sgfsDB.getOpenBookings():
+			if supervisor.lookup(booking_id) is not None:
+				self.addBooking(booking_id,file_name,float(booking_ts))
+			elif download_pid is None:
+				# Still queued when the previous server run stopped
+				self.addBooking(booking_id,file_name,0,download_pid,0)
+			else:
+				self.addBooking(booking_id,file_name,float(booking_ts),download_pid)
+		print "[reaper] Loaded %s transactions and %s bookings" % (len(self.transactions),len(self.bookings))
+
+	def run(self):
+		SGFSDB.background()
+		self.cond.acquire()
+		try:
+			self.push(time.time(),'load')
+		finally:
+			self.cond.release()
+		while True:
+			self.cond.acquire()
+			try:
+				while len(self.heap) == 0 or self.heap[0][0] > time.time():
+					if len(self.heap) == 0:
+						self.cond.wait()
+					else:
+						self.cond.wait(self.heap[0][0]-time.time())
+				deadline,sequence,kind,key=heapq.heappop(self.heap)
+				entry=None
+				if kind in ('transaction','booking'):
+					entries=kind == 'transaction' and self.transactions or self.bookings
+					if key not in entries:
+						continue
+					deadline=self.entryDeadline(kind,key)
+					if deadline > time.time():
+						self.push(deadline,kind,key)
+						continue
+					entry=entries.pop(key)
+			finally:
+				self.cond.release()
+			try:
+				if kind == 'load':
+					self.load()
+					self.schedule(time.time()+SGFS_ReaperScanInterval,'scan')
+				elif kind == 'scan':
+					self.scan()
+				elif kind == 'transaction':
+					self.expireTransaction(key,entry)
+				else:
+					self.expireBooking(key,entry)
+			except Exception, e:
+				print "[reaper] Unable to process %s %s: %s" % (kind,key,e)
+				if kind == 'load':
+					self.schedule(time.time()+SGFS_ReaperScanInterval,'load')
+			finally:
+				SGFSDB.release()
+
+	def schedule(self,deadline,kind,key=None):
+		# push() for the reaper thread, which does not hold the lock
+		self.cond.acquire()
+		try:
+			self.push(deadline,kind,key)
+		finally:
+			self.cond.release()
+
+	def expireTransaction(self,transaction_id,entry):
+		# Requests served by the other server processes are in the database
+		self.saveTouches()
+		sgfsDB=SGFSDB()
+		times=sgfsDB.getTransactionTimes(transaction_id)
+		if times is None:
+			# Already closed (/close or another server process)
+			return
+		created=float(times[0])
+		touched=max(entry[1],float(times[1]))
+		deadline=SGFSReaper.deadline(created,touched,SGFS_TransactionIdleTimeout,SGFS_TransactionMaxAge)
+		if deadline is None or deadline > time.time():
+			self.addTransaction(transaction_id,created,touched)
+			return
+		print "[reaper] Closing expired transaction %s" % transaction_id
+		end_transaction(sgfsDB,transaction_id)
+
+	def saveTouches(self):
+		# Writes the last requests served by this process to the database
+		self.cond.acquire()
+		try:
+			touched,self.touched=self.touched,{}
+		finally:
+			self.cond.release()
+		if len(touched) == 0:
+			return
+		try:
+			SGFSDB().touchTransactions([(touched_at,transaction_id) for transaction_id,touched_at in touched.items()])
+		except:
+			# Written at the next scan
+			self.cond.acquire()
+			try:
+				for transaction_id,touched_at in touched.items():
+					self.touched[transaction_id]=max(touched_at,self.touched.get(transaction_id,0))
+			finally:
+				self.cond.release()
+			raise
+
+	def expireBooking(self,booking_id,entry):
+		created,touched,file_name,download_pid=entry
+		sgfsDB=SGFSDB()
+		supervisor=SGFSBookingSupervisor.get()
+		if supervisor.lookup(booking_id) is None and download_pid is None:
+			print "[reaper] Orphan booking %s" % booking_id
+			release_bookings((sgfsDB.orphanBooking(booking_id,None),),())
+			return
+		print "[reaper] Closing expired booking %s" % booking_id
+		release_bookings(*sgfsDB.closeBookings(None,[str(booking_id)]))
+		# Also when the cleaner already removed its row
+		supervisor.forget((booking_id,))
+
+	def scan(self):
+		try:
+			self.saveTouches()
+			self.removeDirs()
+		finally:
+			self.schedule(time.time()+SGFS_ReaperScanInterval,'scan')
+
+	def removeDirs(self):
+		# Booking directories neither registered by LFC.book() nor used by
+		# open bookings; the bookings of every server process are read from
+		# the database
+		sgfsDB=SGFSDB()
+		used=set([os.path.dirname(file_name) for booking_id,download_pid,file_name,booking_ts in sgfsDB.getOpenBookings() if file_name])
+		now=time.time()
+		self.cond.acquire()
+		try:
+			used.update([os.path.dirname(entry[2]) for entry in self.bookings.values() if entry[2]])
+			for booking_dir,created in self.dirs.items():
+				# Never submitted (request failed before the booking was added)
+				if SGFS_BookingIdleTimeout is not None and now-created > SGFS_BookingIdleTimeout:
+					del self.dirs[booking_dir]
+			used.update(self.dirs.keys())
+		finally:
+			self.cond.release()
+		temp_dir=tempfile.gettempdir()
+		for dir_name in os.listdir(temp_dir):
+			if not dir_name.startswith(SGFS_BookingDirPrefix):
+				continue
+			booking_dir=os.path.join(temp_dir,dir_name)
+			if booking_dir in used:
+				continue
+			try:
+				# Other server processes may be registering its booking
+				if os.stat(booking_dir).st_mtime > now-SGFS_ReaperScanInterval:
+					continue
+				print "[reaper] Removing unreferenced booking directory %s" % booking_dir
+				shutil.rmtree(booking_dir)
+			except OSError, e:
+				print "[reaper] EXCEPTION: rmtree %s: %s" % (booking_dir,e)
+
+##
+## Class that holds a proxy file shared by all the transactions of the
+## same (infrastructure,VO,role) and keeps it renewed in background
+##
+class SGFSProxy:
+	def __init__(self,proxy_file):
+		self.proxy_file=proxy_file
+		self.expires=None
+		self.lock=threading.Lock()
+		self.timer=None
+
+	def valid(self,margin=0):
+		return self.expires is not None and time.time()+margin < self.expires
+
+	def get(self,infrastructure):
+		if self.valid(SGFS_ProxyRetryDelay):
+			return self.proxy_file
+		self.lock.acquire()
+		try:
+			# Another thread may have fetched it in the meantime
+			if not self.valid(SGFS_ProxyRetryDelay):
+				self.fetch(infrastructure)
+		finally:
+			self.lock.release()
+		return self.proxy_file
+
+	def fetch(self,infrastructure):
+		# Download aside and rename, so readers never see a partial file
+		fd,temp_file=tempfile.mkstemp(dir=os.path.dirname(self.proxy_file))
+		os.close(fd)
+		expires=None
+		if infrastructure.getProxy(temp_file) == 0:
+			expires=self.readExpiry(temp_file)
+		if expires is not None:
+			os.rename(temp_file,self.proxy_file)
+			self.expires=expires
+			print "[i] Proxy '%s' valid until %s" % (self.proxy_file,time.ctime(expires))
+			delay=max(expires-SGFS_ProxyRenewalMargin-time.time(),SGFS_ProxyRetryDelay)
+		else:
+			os.unlink(temp_file)
+			print "[!] Unable to get a new proxy for '%s'" % self.proxy_file
+			delay=SGFS_ProxyRetryDelay
+		self.schedule(infrastructure,delay)
+
+	def renew(self,infrastructure):
+		self.lock.acquire()
+		try:
+			self.fetch(infrastructure)
+		finally:
+			self.lock.release()
+
+	def schedule(self,infrastructure,delay):
+		if self.timer is not None:
+			self.timer.cancel()
+		self.timer=threading.Timer(delay,self.renew,(infrastructure,))
+		self.timer.daemon=True
+		self.timer.start()
+
+	@staticmethod
+	def readExpiry(proxy_file):
+		# The first certificate in the file is the proxy itself
+		execCmd=ExecCmd()
+		output=execCmd.cmd("""openssl x509 -noout -enddate -in %s""" % proxy_file).strip()
+		if execCmd.returnCode() != 0 or not output.startswith('notAfter='):
+			return None
+		try:
+			return calendar.timegm(time.strptime(output[len('notAfter='):],'%b %d %H:%M:%S %Y %Z'))
+		except ValueError:
+			return None
+
+##
+## Class that keeps one SGFSProxy for each (infrastructure,VO,role)
+##
+class SGFSProxyManager:
+	def __init__(self,proxy_dir=SGFS_ProxyDir):
+		self.proxy_dir=proxy_dir
+		self.proxies={}
+		self.lock=threading.Lock()
+
+	def isShared(self,proxy_file):
+		return proxy_file is not None and os.path.dirname(proxy_file) == self.proxy_dir
+
+	def getProxy(self,infrastructure):
+		key=(infrastructure.infra_id,infrastructure.px_vo,infrastructure.px_role)
+		self.lock.acquire()
+		try:
+			proxy=self.proxies.get(key)
+			if proxy is None:
+				if not os.path.isdir(self.proxy_dir):
+					os.makedirs(self.proxy_dir,0700)
+				proxy_name="x509up_%s_%s_%s" % key
+				proxy_file=os.path.join(self.proxy_dir,proxy_name.replace(os.sep,'_'))
+				proxy=SGFSProxy(proxy_file)
+				self.proxies[key]=proxy
+		finally:
+			self.lock.release()
+		return proxy.get(infrastructure)
+
+
 ##
 ## Class that manages Infrastructure settings
 ##
 class Infrastructure:
+	proxyManager = SGFSProxyManager()
 	
 	def __init__(self, infra_id=None):
 		self.infra_id=0
@@ -484,13 +3011,561 @@ class Infrastructure:
 		execCmd=ExecCmd()
 		if temp_file is None:
 			temp_file = "/tmp/x509up_u$(id -u)"
-		execCmd.cmd("""wget \"http://%s:%s/eTokenServer/eToken/%s?voms=%s:%s&proxy-renewal=%s\" -O %s && chmod 600 %s""" % (self.px_host,self.px_port,self.px_id,self.px_vo,self.px_role,self.px_renewal,temp_file,temp_file))
-		
+		execCmd.cmd("""wget --timeout=%s --tries=1 \"http://%s:%s/eTokenServer/eToken/%s?voms=%s:%s&proxy-renewal=%s\" -O %s && chmod 600 %s""" % (SGFS_ProxyFetchTimeout,self.px_host,self.px_port,self.px_id,self.px_vo,self.px_role,self.px_renewal,temp_file,temp_file))
+		return execCmd.returnCode()
+
+	def sharedProxy(self):
+		return Infrastructure.proxyManager.getProxy(self)
+
+	@staticmethod
+	def isSharedProxy(proxy_file):
+		return Infrastructure.proxyManager.isShared(proxy_file)
+
+##
+## Class that holds a single LFC catalog entry
+##
+class LFCEntry:
+	def __init__(self,name='',size=0,flags='',date='',remark='',guid=None,mtime=None):
+		self.name=name
+		self.size=size
+		self.flags=flags
+		self.date=date
+		self.remark=remark
+		self.guid=guid
+		self.mtime=mtime
+
+	def timestamp(self):
+		# Parsed on demand, only sorting needs it
+		if self.mtime is None:
+			self.mtime=LFCEntry.parseDate(self.date)
+		return self.mtime
+
+	@staticmethod
+	def parseDate(date):
+		# lfc-ls prints 'Mon DD HH:MM' for the last six months, 'Mon DD YYYY' otherwise
+		try:
+			if ':' in date:
+				year=time.localtime().tm_year
+				mtime=time.mktime(time.strptime("%s %s" % (date,year),'%b %d %H:%M %Y'))
+				if mtime > time.time()+24*3600:
+					mtime=time.mktime(time.strptime("%s %s" % (date,year-1),'%b %d %H:%M %Y'))
+				return mtime
+			return time.mktime(time.strptime(date,'%b %d %Y'))
+		except ValueError:
+			return 0
+
+	@staticmethod
+	def fromLsLine(line):
+		# 'lfc-ls -l --comment' line; returns None if not an entry line
+		rec_items=line.split()
+		if len(rec_items) < 9:
+			return None
+		try:
+			size=long(rec_items[4])
+		except ValueError:
+			return None
+		return LFCEntry(rec_items[8],                                           \
+		                size,                                                   \
+		                rec_items[0],                                           \
+		                '%s %s %s' % (rec_items[5],rec_items[6],rec_items[7]), \
+		                ' '.join(rec_items[9:]))
+
+##
+## Exception raised by the LFC backends while listing entries
+##
+class LFCError(Exception):
+	def __init__(self,returnCode,cmd,output):
+		Exception.__init__(self,output)
+		self.returnCode=returnCode
+		self.cmd=cmd
+		self.output=output
+
+##
+## LFC backends - Perform the catalog operations for the LFC class
+##
+## Each operation returns a (returnCode,cmd,result) tuple where cmd
+## describes what has been executed and result is either the operation
+## output or an error message when returnCode is not zero. iterList()
+## hands out the entries one by one and raises LFCError instead.
+##
+class LFCBackend:
+	def list(self,lfc,lfc_dir):
+		raise NotImplementedError
+
+	def iterList(self,lfc,lfc_dir):
+		returnCode,cmd,entries=self.list(lfc,lfc_dir)
+		if returnCode != 0:
+			raise LFCError(returnCode,cmd,entries)
+		for entry in entries:
+			yield entry
+
+	def stat(self,lfc,lfc_path):
+		raise NotImplementedError
+
+	def rm(self,lfc,lfc_path):
+		raise NotImplementedError
+
+	def replicas(self,lfc,lfc_path):
+		raise NotImplementedError
+
+	def register(self,lfc,surl,lfc_path):
+		raise NotImplementedError
+
+##
+## Command line backend (lfc-ls, lcg-del, lcg-lr, lcg-rf)
+##
+class LFCCLIBackend(LFCBackend):
+	def env(self,lfc):
+		return """export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && """ % (lfc.infra_bdii,lfc.infra_lfc,lfc.transaction_proxy)
+
+	def list(self,lfc,lfc_dir):
+		cmd="""%slfc-ls -l --comment %s""" % (self.env(lfc),pipes.quote(lfc_dir))
+		try:
+			return 0,cmd,[entry for entry in self.iterList(lfc,lfc_dir)]
+		except LFCError, e:
+			return e.returnCode,e.cmd,e.output
+
+	def iterList(self,lfc,lfc_dir):
+		# Entries are parsed while lfc-ls is still writing them
+		execCmd=ExecCmd()
+		cmd="""%slfc-ls -l --comment %s""" % (self.env(lfc),pipes.quote(lfc_dir))
+		errors=[]
+		done=False
+		try:
+			for line in execCmd.lines(cmd):
+				entry=LFCEntry.fromLsLine(line)
+				if entry is None:
+					errors.append(line)
+				else:
+					yield entry
+			done=True
+		finally:
+			if not done:
+				# The reader stopped early; lfc-ls is no more needed
+				execCmd.kill()
+		returnCode=execCmd.returnCode()
+		if returnCode != 0:
+			raise LFCError(returnCode,cmd,''.join(errors))
+
+	def stat(self,lfc,lfc_path):
+		execCmd=ExecCmd()
+		cmd="""%slfc-ls -l %s""" % (self.env(lfc),pipes.quote(lfc_path))
+		output=execCmd.cmd(cmd)
+		returnCode=execCmd.returnCode()
+		if returnCode != 0:
+			return returnCode,cmd,output
+		entry=LFCEntry.fromLsLine(output)
+		if entry is None:
+			return 1,cmd,output
+		return returnCode,cmd,entry
+
+	def rm(self,lfc,lfc_path):
+		execCmd=ExecCmd()
+		cmd="""%slcg-del -a %s""" % (self.env(lfc),pipes.quote('lfn:%s' % lfc_path))
+		output=execCmd.cmd(cmd)
+		return execCmd.returnCode(),cmd,output
+
+	def replicas(self,lfc,lfc_path):
+		execCmd=ExecCmd()
+		cmd="""%slcg-lr %s""" % (self.env(lfc),pipes.quote('lfn:%s' % lfc_path))
+		output=execCmd.cmd(cmd)
+		returnCode=execCmd.returnCode()
+		if returnCode != 0:
+			return returnCode,cmd,output
+		return returnCode,cmd,[surl for surl in output.split('\n') if surl != '']
+
+	def register(self,lfc,surl,lfc_path):
+		execCmd=ExecCmd()
+		cmd="""%slcg-rf -v --vo %s -l %s %s""" % (self.env(lfc),lfc.infra_pxvo,pipes.quote('lfn:%s' % lfc_path),pipes.quote(surl))
+		output=execCmd.cmd(cmd)
+		returnCode=execCmd.returnCode()
+		if returnCode != 0:
+			return returnCode,cmd,output
+		# The guid is the second ':' separated field of the output
+		fields=' '.join(output.split()).split(':')
+		if len(fields) < 2:
+			return returnCode,cmd,''
+		return returnCode,cmd,fields[1].strip()
+
+##
+## Native backend; uses the LFC python API in-process for catalog reads
+##
+## The LFC client library takes its settings from the process environment,
+## so native calls are serialized by envLock. Deletions and registrations
+## also need the storage elements, they are left to the command line tools.
+##
+class LFCNativeBackend(LFCCLIBackend):
+	envLock = threading.Lock()
+
+	def setEnv(self,lfc):
+		os.environ["X509_USER_PROXY"] = lfc.transaction_proxy
+		os.environ["LCG_GFAL_INFOSYS"] = lfc.infra_bdii
+		os.environ["LFC_HOST"]=lfc.infra_lfc
+
+	def error(self,lfc_path):
+		return "%s: %s" % (lfc_path,lfcapi.sstrerror(lfcapi.cvar.serrno))
+
+	@staticmethod
+	def modeString(mode):
+		if stat.S_ISDIR(mode):
+			flags='d'
+		elif stat.S_ISLNK(mode):
+			flags='l'
+		else:
+			flags='-'
+		for who in ('USR','GRP','OTH'):
+			for what,char in (('R','r'),('W','w'),('X','x')):
+				if mode & getattr(stat,'S_I%s%s' % (what,who)):
+					flags+=char
+				else:
+					flags+='-'
+		return flags
+
+	@staticmethod
+	def dateString(mtime):
+		# Same layout of lfc-ls: time for recent entries, year for the others
+		t=time.localtime(mtime)
+		if abs(time.time()-mtime) < 183*24*3600:
+			return "%s %d %s" % (time.strftime('%b',t),t.tm_mday,time.strftime('%H:%M',t))
+		return "%s %d %s" % (time.strftime('%b',t),t.tm_mday,t.tm_year)
+
+	def entry(self,name,st,remark='',guid=None):
+		return LFCEntry(name,                        \
+		                long(st.filesize),           \
+		                self.modeString(st.filemode),\
+		                self.dateString(st.mtime),   \
+		                remark or '',                \
+		                guid,                        \
+		                st.mtime)
+
+	def list(self,lfc,lfc_dir):
+		cmd="""lfc_opendirg %s""" % lfc_dir
+		entries=[]
+		LFCNativeBackend.envLock.acquire()
+		try:
+			self.setEnv(lfc)
+			dirp=lfcapi.lfc_opendirg(lfc_dir,'')
+			if dirp is None:
+				return 1,cmd,self.error(lfc_dir)
+			try:
+				while True:
+					# Entry stat and comment (lfc_readdirc has no stat)
+					dir_entry=lfcapi.lfc_readdirxc(dirp)
+					if dir_entry is None:
+						break
+					entries.append(self.entry(dir_entry.d_name,dir_entry,dir_entry.comment))
+			finally:
+				lfcapi.lfc_closedir(dirp)
+		finally:
+			LFCNativeBackend.envLock.release()
+		return 0,cmd,entries
+
+	def stat(self,lfc,lfc_path):
+		cmd="""lfc_statg %s""" % lfc_path
+		LFCNativeBackend.envLock.acquire()
+		try:
+			self.setEnv(lfc)
+			st=lfcapi.lfc_filestatg()
+			if lfcapi.lfc_statg(lfc_path,'',st) != 0:
+				return 1,cmd,self.error(lfc_path)
+			return 0,cmd,self.entry(lfc_path,st,'',st.guid)
+		finally:
+			LFCNativeBackend.envLock.release()
+
+	def replicas(self,lfc,lfc_path):
+		cmd="""lfc_getreplica %s""" % lfc_path
+		LFCNativeBackend.envLock.acquire()
+		try:
+			self.setEnv(lfc)
+			returnCode,replicas=lfcapi.lfc_getreplica(lfc_path,'','')
+			if returnCode != 0:
+				return returnCode,cmd,self.error(lfc_path)
+			return 0,cmd,[replica.sfn for replica in replicas]
+		finally:
+			LFCNativeBackend.envLock.release()
+
+##
+## In-memory backend, used for testing the service without a catalog
+##
+class LFCFakeBackend(LFCBackend):
+	def __init__(self):
+		self.entries={}  # lfc_path -> (LFCEntry,[surl,...])
+		self.lock=threading.Lock()
+
+	def add(self,lfc_path,size=0,surls=(),remark=''):
+		entry=LFCEntry(os.path.basename(lfc_path),size,'-rw-rw-r--',time.strftime('%b %d %H:%M'),remark,str(uuid.uuid4()))
+		self.lock.acquire()
+		try:
+			self.entries[lfc_path]=(entry,list(surls))
+		finally:
+			self.lock.release()
+		return entry
+
+	def notFound(self,cmd,lfc_path):
+		return 1,cmd,"%s: No such file or directory" % lfc_path
+
+	def list(self,lfc,lfc_dir):
+		cmd="""list %s""" % lfc_dir
+		self.lock.acquire()
+		try:
+			entries=[e[0] for p,e in sorted(self.entries.items()) if os.path.dirname(p) == lfc_dir]
+		finally:
+			self.lock.release()
+		return 0,cmd,entries
+
+	def stat(self,lfc,lfc_path):
+		cmd="""stat %s""" % lfc_path
+		item=self.entries.get(lfc_path)
+		if item is None:
+			return self.notFound(cmd,lfc_path)
+		entry=item[0]
+		return 0,cmd,LFCEntry(lfc_path,entry.size,entry.flags,entry.date,entry.remark,entry.guid)
+
+	def rm(self,lfc,lfc_path):
+		cmd="""rm %s""" % lfc_path
+		self.lock.acquire()
+		try:
+			if self.entries.pop(lfc_path,None) is None:
+				return self.notFound(cmd,lfc_path)
+		finally:
+			self.lock.release()
+		return 0,cmd,''
+
+	def replicas(self,lfc,lfc_path):
+		cmd="""replicas %s""" % lfc_path
+		item=self.entries.get(lfc_path)
+		if item is None:
+			return self.notFound(cmd,lfc_path)
+		return 0,cmd,list(item[1])
+
+	def register(self,lfc,surl,lfc_path):
+		cmd="""register %s %s""" % (surl,lfc_path)
+		return 0,cmd,self.add(lfc_path,0,(surl,)).guid
+
+def get_lfc_backend(name=SGFS_LFCBackend):
+	if name == 'native' and lfcapi is not None:
+		return LFCNativeBackend()
+	if name == 'fake':
+		return LFCFakeBackend()
+	return LFCCLIBackend()
+
+##
+## File of the staging cache (see SGFSStagingCache)
+##
+## part_name is the file being written by its writer (an lcg-cp future or
+## an SGFSGfalFetch); once complete it is renamed into file_name and shared
+## by the following downloads. The readers of a part file follow its
+## growth until done() (see SGFSFileStream).
+##
+class SGFSStagedFile:
+	def __init__(self,key,file_name,part_name,size,cached=True):
+		self.key       = key
+		self.file_name = file_name
+		self.part_name = part_name
+		self.size      = size
+		self.cached    = cached
+		self.complete  = part_name is None
+		self.failed    = False
+		self.writer    = None
+		self.refs      = 1
+
+	def path(self):
+		if self.complete:
+			return self.file_name
+		return self.part_name
+
+	def done(self):
+		return self.complete or self.failed or (self.writer is not None and self.writer.done())
+
+##
+## Content-addressed cache of the files staged by the download services
+##
+## Files are stored in SGFS_StagingDir, named after the sha1 of the LFC
+## host, the GUID (or the LFN) and the catalog size and modification time,
+## so that a changed catalog entry never matches an old copy. The cache
+## holds at most SGFS_StagingSize bytes; least recently used files are
+## removed first, but never while a download is reading them (refs).
+## Only one copy of each file is fetched at a time: later requests attach
+## to the part file being written. The fetch is cancelled when its last
+## reader goes away, otherwise committed when it succeeds.
+## Downloads in progress reserve their size until they are committed.
+## The index is rebuilt from the directory on first use; each server
+## process keeps its own index of the shared directory.
+##
+class SGFSStagingCache:
+	def __init__(self,path,size):
+		self.path     = path
+		self.size     = size
+		self.lock     = threading.Lock()
+		self.entries  = OrderedDict() # key -> SGFSStagedFile (complete files)
+		self.fetching = {}            # key -> SGFSStagedFile (part files)
+		self.used     = 0
+		self.reserved = 0
+		self.loaded   = False
+
+	@staticmethod
+	def key(lfc_host,lfc_file_path,file_entry):
+		if file_entry.guid:
+			name="guid:%s" % file_entry.guid
+		else:
+			name="lfn:%s" % lfc_file_path
+		return hashlib.sha1("%s|%s|%s|%d" % (lfc_host,name,file_entry.size,int(file_entry.timestamp()))).hexdigest()
+
+	def load(self):
+		# Called with the lock held
+		if self.loaded:
+			return
+		self.loaded=True
+		try:
+			os.makedirs(self.path)
+		except OSError:
+			pass
+		files=[]
+		for name in os.listdir(self.path):
+			file_name=os.path.join(self.path,name)
+			try:
+				file_stat=os.stat(file_name)
+			except OSError:
+				continue
+			if name.endswith('.part'):
+				# Left by a stopped server (nobody is writing it)
+				if time.time()-file_stat.st_mtime > SGFS_FileStallTimeout:
+					self.unlink(file_name)
+				continue
+			files.append((file_stat.st_atime,name,file_stat.st_size))
+		files.sort()
+		for atime,name,size in files:
+			staged=SGFSStagedFile(name,os.path.join(self.path,name),None,size)
+			staged.refs=0
+			self.entries[name]=staged
+			self.used+=size
+		print "[staging] %s files (%s bytes) in '%s'" % (len(self.entries),self.used,self.path)
+
+	def lookup(self,key,size):
+		# Returns the complete or being fetched file of the given key
+		# (referenced) or None
+		self.lock.acquire()
+		try:
+			self.load()
+			staged=self.fetching.get(key)
+			if staged is not None:
+				staged.refs+=1
+				return staged
+			staged=self.entries.get(key)
+			if staged is None:
+				return None
+			if staged.size != size or not os.path.exists(staged.file_name):
+				self.remove(staged)
+				return None
+			del self.entries[key]
+			self.entries[key]=staged
+			staged.refs+=1
+			return staged
+		finally:
+			self.lock.release()
+
+	def reserve(self,key,size):
+		# Returns a new (referenced) part file that the caller has to fetch;
+		# it will be cached only if its size fits in the cache once unused
+		# files have been removed
+		self.lock.acquire()
+		try:
+			self.load()
+			cached=self.evict(size)
+			if cached:
+				self.reserved+=size
+			staged=SGFSStagedFile(key,os.path.join(self.path,key),os.path.join(self.path,"%s.%s.part" % (key,uuid.uuid4().hex)),size,cached)
+			self.fetching[key]=staged
+			return staged
+		finally:
+			self.lock.release()
+
+	def evict(self,size):
+		# Called with the lock held
+		for staged in list(self.entries.values()):
+			if self.used+self.reserved+size <= self.size:
+				break
+			if staged.refs == 0:
+				self.remove(staged)
+		return self.used+self.reserved+size <= self.size
+
+	def remove(self,staged):
+		# Called with the lock held
+		if self.entries.get(staged.key) is staged:
+			del self.entries[staged.key]
+			self.used-=staged.size
+			self.unlink(staged.file_name)
+
+	def fail(self,staged):
+		# The fetch could not be started; readers already attached will stop
+		self.lock.acquire()
+		try:
+			staged.failed=True
+			if self.fetching.get(staged.key) is staged:
+				del self.fetching[staged.key]
+		finally:
+			self.lock.release()
+
+	def release(self,staged):
+		# Gives back a reference; when the last reader of a part file goes
+		# away the fetch is cancelled if incomplete, then the part file is
+		# committed if the fetch succeeded, otherwise removed
+		self.lock.acquire()
+		try:
+			staged.refs-=1
+			if staged.refs > 0:
+				return
+			if staged.complete:
+				if not staged.cached:
+					self.unlink(staged.file_name)
+				return
+			if self.fetching.get(staged.key) is staged:
+				del self.fetching[staged.key]
+		finally:
+			self.lock.release()
+		writer=staged.writer
+		ok=False
+		if writer is not None:
+			if not writer.done() and self.partSize(staged) < staged.size:
+				print "[staging] cancelling the fetch of '%s'" % staged.part_name
+				writer.kill()
+			if writer.wait(SGFS_CmdTimeout):
+				ok=writer.returnCode() == 0 and self.partSize(staged) == staged.size
+		self.lock.acquire()
+		try:
+			if staged.cached:
+				self.reserved-=staged.size
+			if ok and staged.cached and staged.key not in self.entries:
+				os.rename(staged.part_name,staged.file_name)
+				staged.complete=True
+				self.entries[staged.key]=staged
+				self.used+=staged.size
+				print "[staging] cached '%s' (%s bytes)" % (staged.file_name,staged.size)
+			else:
+				self.unlink(staged.part_name)
+		finally:
+			self.lock.release()
+
+	def partSize(self,staged):
+		try:
+			return os.stat(staged.part_name).st_size
+		except OSError:
+			return -1
+
+	def unlink(self,file_name):
+		try:
+			os.unlink(file_name)
+		except OSError:
+			print "[staging] EXCEPTION: unlink %s" % file_name
 
 ##
 ## LFC Class - Manages the LFC file catalog
 ##
 class LFC:
+	backend   = get_lfc_backend()
+	listCache = SGFSLRUCache(SGFS_ListCacheSize,SGFS_ListCacheTTL) # (lfc host,dir) -> [LFCEntry,...]
+	stagingCache = SGFSStagingCache(SGFS_StagingDir,SGFS_StagingSize)
+
 	def __init__(self,infra_bdii=None,infra_lfc=None,app_lfcdir=None,user_name=None,transaction_proxy=None,infra_pxvo=None):
 		self.infra_bdii=infra_bdii
 		self.infra_lfc=infra_lfc
@@ -510,99 +3585,303 @@ class LFC:
 		print "Proxy : '%s'" % self.transaction_proxy
 		print "VO    : '%s'" % self.infra_pxvo
 
-	def list(self,lfc_file_name=None):
-		execCmd=ExecCmd()
-		if lfc_file_name is not None:
-			cmd_extension = '| grep %s' % lfc_file_name
-		else:
-			cmd_extension = ''
-		files_list=execCmd.cmd("""export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && lfc-ls -l --comment /grid/%s/sgfs/%s/%s %s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,self.app_lfcdir,self.user_name,cmd_extension))
-		return (execCmd.returnCode(),files_list)
+	def lfcData(self):
+		return (self.infra_bdii,       \
+		        self.infra_lfc,        \
+		        self.app_lfcdir,       \
+		        self.user_name,        \
+		        self.transaction_proxy,\
+		        self.infra_pxvo)
+
+	def userDir(self):
+		return "/grid/%s/sgfs/%s/%s" % (self.infra_pxvo,self.app_lfcdir,self.user_name)
+
+	def listKey(self,lfc_dir=None):
+		# The user directory holds VO, application directory and user name
+		if lfc_dir is None:
+			lfc_dir=self.userDir()
+		return (self.infra_lfc,lfc_dir)
+
+	def list(self,lfc_file_name=None,refresh=False):
+		try:
+			files_list=[entry for entry in self.iterList(refresh=refresh) \
+			            if lfc_file_name is None or entry.name == lfc_file_name]
+		except LFCError, e:
+			return (e.returnCode,e.output)
+		return (0,files_list)
+
+	def iterList(self,pattern=None,refresh=False):
+		files_list=None
+		if not refresh:
+			files_list=LFC.listCache.get(self.listKey())
+		if files_list is None:
+			files_list=self.fetchList()
+		for entry in files_list:
+			if pattern is None or fnmatch.fnmatchcase(entry.name,pattern):
+				yield entry
+
+	def fetchList(self):
+		# The listing is cached only if read up to the end and small enough
+		key=self.listKey()
+		files_list=[]
+		for entry in LFC.backend.iterList(self,self.userDir()):
+			if files_list is not None:
+				files_list.append(entry)
+				if len(files_list) >= SGFS_ListCacheSize:
+					files_list=None
+			yield entry
+		if files_list is not None:
+			LFC.listCache.put(key,files_list,len(files_list)+1)
+
+	sortKeys = {
+		'name': lambda entry: entry.name,
+		'size': lambda entry: entry.size,
+		'date': lambda entry: entry.timestamp(),
+	}
+
+	def listFiles(self,offset=0,limit=None,pattern=None,sort=None,refresh=False):
+		# sort is one of sortKeys, prefixed by '-' for descending order
+		entries=self.iterList(pattern,refresh)
+		if sort is not None:
+			# Sorting needs the whole listing before the first entry
+			entries=sorted(entries,key=LFC.sortKeys[sort.lstrip('-')],reverse=sort.startswith('-'))
+		if limit is None:
+			return itertools.islice(entries,offset,None)
+		return itertools.islice(entries,offset,offset+limit)
 		
 	def file(self,lcgCpCmd,lfc_file_name,lfc_absolute_path=False):
-		execCmd   = ExecCmd()
-		lfc_file_name=lfc_file_name.replace('(','\(')\
-		                           .replace(')','\)')
 		tmpdir  = tempfile.mkdtemp()
 		if lfc_absolute_path == True:
 			tmpfile = "%s/%s" %(tmpdir,os.path.basename(lfc_file_name))
-			cmd="""export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && lfc-ls -l %s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,lfc_file_name)
+			lfc_file_path = lfc_file_name
 		else:
 			tmpfile = "%s/%s" %(tmpdir,lfc_file_name)
-			cmd="""export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && lfc-ls -l /grid/%s/sgfs/%s/%s/%s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,self.app_lfcdir,self.user_name,lfc_file_name)
-		file_entry=execCmd.cmd(cmd)
-		returnCode=execCmd.returnCode()
+			lfc_file_path = "%s/%s" % (self.userDir(),lfc_file_name)
+		returnCode,cmd,file_entry=LFC.backend.stat(self,lfc_file_path)
 		if returnCode == 0:
-			cmd="""echo '%s' | awk '{ print $5 }'""" % file_entry
-			file_size=execCmd.cmd(cmd).strip()
-			if lfc_absolute_path == True:
-				cmd="""export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && lcg-cp --vo %s -n 3 lfn:%s file:%s"""  % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,lfc_file_name,tmpfile)
-			else:
-				cmd="""export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && lcg-cp --vo %s -n 3 lfn:/grid/%s/sgfs/%s/%s/%s file:%s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,self.infra_pxvo,self.app_lfcdir,self.user_name,lfc_file_name,tmpfile)
-			p=lcgCpCmd.bgCmd(cmd)
-			count=execCmd.cmd('for ((i=0; i<30; i++)); do if [ -s %s ]; then i=0; break; fi; sleep 1; done; echo $i' % tmpfile)
-			i_count=int(count)
-			if(i_count != 0):
-				tmpfile="Timeout downloading file: '%s'" % lfc_file_name
-				returnCode=1
-				os.kill(p.pid, signal.SIGKILL)
+			file_size=file_entry.size
+			returnCode,cmd,result=self.fetch(lcgCpCmd,lfc_file_path,tmpfile)
+			if returnCode != 0:
+				tmpfile=result
 		else:
 			tmpfile=file_entry
 			file_size=0
 		return returnCode,cmd,file_size,tmpfile
 
+	def stage(self,lcgCpCmd,lfc_file_path,gfal=False,start=True,label=None):
+		# As file() but through the staging cache; returns an SGFSStagedFile
+		# that must be given back with LFC.stagingCache.release(). The file
+		# is fetched with lcg-cp (lcgCpCmd) or GFAL unless already staged or
+		# being fetched; with start=False the staged file may be None
+		returnCode,cmd,file_entry=LFC.backend.stat(self,lfc_file_path)
+		if returnCode != 0:
+			return returnCode,cmd,0,file_entry
+		key=SGFSStagingCache.key(self.infra_lfc,lfc_file_path,file_entry)
+		staged=LFC.stagingCache.lookup(key,file_entry.size)
+		if staged is not None:
+			print "[staging] hit '%s' -> '%s'" % (lfc_file_path,staged.path())
+			return 0,cmd,file_entry.size,staged
+		if not start:
+			return 0,cmd,file_entry.size,None
+		staged=LFC.stagingCache.reserve(key,file_entry.size)
+		if gfal:
+			returnCode,cmd,result=self.fetchGfal(lfc_file_path,staged.part_name,file_entry.size,label)
+		else:
+			returnCode,cmd,result=self.fetch(lcgCpCmd,lfc_file_path,staged.part_name)
+		if returnCode != 0:
+			LFC.stagingCache.fail(staged)
+			LFC.stagingCache.release(staged)
+			return returnCode,cmd,0,result
+		staged.writer=result
+		return 0,cmd,file_entry.size,staged
+
+	def fetch(self,lcgCpCmd,lfc_file_path,tmpfile):
+		# Starts lcg-cp in background and waits for its first bytes;
+		# returns the future of lcg-cp or an error message
+		cmd="""export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && lcg-cp --vo %s -n 3 %s %s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,pipes.quote('lfn:%s' % lfc_file_path),pipes.quote('file:%s' % tmpfile))
+		p=lcgCpCmd.bgCmd(cmd)
+		if not SGFSFileWatch.waitData(tmpfile,SGFS_FileFirstByteTimeout,p):
+			if p.done():
+				return 1,cmd,"Unable to download file: '%s' (%s)" % (os.path.basename(lfc_file_path),p.output().strip())
+			p.kill()
+			return 1,cmd,"Timeout downloading file: '%s'" % os.path.basename(lfc_file_path)
+		return 0,cmd,p
+
+	def fetchGfal(self,lfc_file_path,tmpfile,file_size,label=None):
+		# Copies the file with GFAL in background; returns an SGFSGfalFetch
+		cmd="gfal_open('lfn:%s')" % lfc_file_path
+		gfal_f=SGFSGfalPool.get().open(self.transaction_proxy,self.infra_bdii,self.infra_lfc,lfc_file_path)
+		if gfal_f is None:
+			return 1,cmd,"Unable to open file: '%s'" % os.path.basename(lfc_file_path)
+		return 0,cmd,SGFSGfalFetch(gfal_f,file_size,tmpfile,label)
+
 	def rm(self,lfc_file_name):
-		execCmd=ExecCmd()
-		execCmd.cmd("""export LCG_GFAL_INFOSYS=%s ; export LFC_HOST=%s ; export X509_USER_PROXY=%s ;lcg-del -a lfn:/grid/%s/sgfs/%s/%s/%s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,self.app_lfcdir,self.user_name,lfc_file_name))
-		return "lfn:/grid/%s/sgfs/%s/%s/%s" % (self.infra_pxvo,self.app_lfcdir,self.user_name,lfc_file_name)
+		lfc_file_path="%s/%s" % (self.userDir(),lfc_file_name)
+		LFC.backend.rm(self,lfc_file_path)
+		LFC.listCache.evict(self.listKey())
+		return "lfn:%s" % lfc_file_path
 
-	def book(self, lfc_file_name):
-		tmpdir  = tempfile.mkdtemp()
+	def rmMany(self, lfc_file_names=None, pattern=None):
+		# Deletes the given files (or all the files matching pattern) with at
+		# most SGFS_DeleteParallelism deletes running at once; returns the
+		# (lfc_file_name,returnCode,cmd,output,lfn_name) of each delete
+		if lfc_file_names is None:
+			try:
+				lfc_file_names=sorted([entry.name for entry in self.iterList(pattern) if not entry.flags.startswith('d')])
+			except LFCError, e:
+				return e.returnCode,e.cmd,e.output
+		pending=Queue.Queue()
+		for index,lfc_file_name in enumerate(lfc_file_names):
+			pending.put((index,lfc_file_name))
+		results=[None]*len(lfc_file_names)
+		def worker():
+			while True:
+				try:
+					index,lfc_file_name=pending.get_nowait()
+				except Queue.Empty:
+					return
+				lfc_file_path="%s/%s" % (self.userDir(),lfc_file_name)
+				try:
+					returnCode,cmd,output=LFC.backend.rm(self,lfc_file_path)
+				except Exception, e:
+					# A failed delete must not stop the others
+					returnCode,cmd,output=-1,None,str(e)
+				results[index]=(lfc_file_name,returnCode,cmd,output,"lfn:%s" % lfc_file_path)
+		workers=[threading.Thread(target=worker) for i in range(min(SGFS_DeleteParallelism,len(lfc_file_names)))]
+		for thread in workers:
+			thread.start()
+		for thread in workers:
+			thread.join()
+		LFC.listCache.evict(self.listKey())
+		return 0,None,results
+
+	def book(self, lfc_file_name, file_size=None):
+		# Returns the lcg-cp command of the booking (see SGFSBookingSupervisor)
+		# with the size and the local name of the file, or the error output
+		if file_size is None:
+			returnCode,cmd,file_entry=LFC.backend.stat(self,"%s/%s" % (self.userDir(),lfc_file_name))
+			if returnCode != 0:
+				return returnCode,cmd,0,file_entry
+			file_size = file_entry.size
+		tmpdir  = tempfile.mkdtemp(prefix=SGFS_BookingDirPrefix)
+		# Spared by the reaper until the booking is submitted
+		SGFSReaper.get().addDir(tmpdir)
 		tmpfile = "%s/%s" %(tmpdir,lfc_file_name)
-		result, file_info = self.list(lfc_file_name)
-		file_size = file_info.split('\n')[0].split()[4]
-		execCmd=ExecCmd()
-		p=execCmd.bgCmd("""export LCG_GFAL_INFOSYS=%s ; export LFC_HOST=%s ; export X509_USER_PROXY=%s ; lcg-cp --vo %s -n 3 lfn:/grid/%s/sgfs/%s/%s/%s file:%s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,self.infra_pxvo,self.app_lfcdir,self.user_name,lfc_file_name,tmpfile))
-		return tmpfile, file_size, p
+		cmd="""export LCG_GFAL_INFOSYS=%s ; export LFC_HOST=%s ; export X509_USER_PROXY=%s ; lcg-cp --vo %s -n 3 %s %s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,pipes.quote('lfn:%s/%s' % (self.userDir(),lfc_file_name)),pipes.quote('file:%s' % tmpfile))
+		return 0,cmd,file_size,tmpfile
+
+	def bookMany(self, lfc_file_names=None, pattern=None):
+		# Books the given files (or all the files matching pattern) with a
+		# single listing; returns the (lfc_file_name,file_name,file_size,cmd)
+		# of each booking and the names that were not found
+		try:
+			sizes=dict([(entry.name,entry.size) for entry in self.iterList(pattern) if not entry.flags.startswith('d')])
+		except LFCError, e:
+			return e.returnCode,e.cmd,e.output,()
+		if lfc_file_names is None:
+			lfc_file_names=sorted(sizes.keys())
+		bookings=[]
+		missing=[]
+		for lfc_file_name in lfc_file_names:
+			if lfc_file_name in sizes:
+				returnCode,cmd,file_size,file_name=self.book(lfc_file_name,sizes[lfc_file_name])
+				bookings.append((lfc_file_name,file_name,file_size,cmd))
+			else:
+				missing.append(lfc_file_name)
+		return 0,None,bookings,missing
+
+	def storageElement(self, lfc_file_name):
+		# Host of the first replica of the file (None if unknown)
+		returnCode,cmd,surls=self.getSurls(lfc_file_name)
+		if returnCode != 0 or len(surls) == 0:
+			return None
+		return urlparse.urlsplit(surls[0]).hostname
+
+	def storageElementLookup(self, lfc_file_name):
+		# storageElement, deferred to the booking scheduler (None: not needed)
+		if SGFS_BookingSELimit is None:
+			return None
+		return lambda: self.storageElement(lfc_file_name)
 
 	def getSurls(self,lfc_file_name):
-		execCmd=ExecCmd()
-		cmd="""export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && lcg-lr lfn:/grid/%s/sgfs/%s/%s/%s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,self.app_lfcdir,self.user_name,lfc_file_name)
-		surls=execCmd.cmd(cmd)
-		returnCode=execCmd.returnCode()
-		return returnCode,cmd,surls.split('\n')
+		returnCode,cmd,surls=LFC.backend.replicas(self,"%s/%s" % (self.userDir(),lfc_file_name))
+		if returnCode != 0:
+			surls=[surls]
+		return returnCode,cmd,surls
 
 	def regSurl(self, surl, lfc_file_name, lfc_path=None):
-		execCmd=ExecCmd()
 		if(lfc_path != None):
-		    lfc_path="lfn:/grid/%s/%s/%s" % (self.infra_pxvo,lfc_path,lfc_file_name) 
+		    lfc_path="/grid/%s/%s/%s" % (self.infra_pxvo,lfc_path,lfc_file_name) 
 		else:
-			lfc_path="lfn:/grid/%s/sgfs/%s/%s/%s" % (self.infra_pxvo,self.app_lfcdir,self.user_name,lfc_file_name)
-		cmd="""export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && lcg-rf -v --vo %s -l %s %s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,self.infra_pxvo,lfc_path,surl)
-		cmd_output=execCmd.cmd(cmd)
-		returnCode=execCmd.returnCode()
-		if (0 == returnCode):
-			cmd="""echo %s | awk  -F':' '{ print $2 }'""" % cmd_output
-			cmd_output=execCmd.cmd(cmd)
-		return returnCode,cmd,cmd_output,lfc_path
+			lfc_path="%s/%s" % (self.userDir(),lfc_file_name)
+		returnCode,cmd,cmd_output=LFC.backend.register(self,surl,lfc_path)
+		LFC.listCache.evict(self.listKey(os.path.dirname(lfc_path)))
+		return returnCode,cmd,cmd_output,"lfn:%s" % lfc_path
 		
 	def file_data(self,lfc_file_name,lfc_absolute_path=False):
 		file_size=0
-		lfc_file_name=lfc_file_name.replace('(','\(')\
-		                           .replace(')','\)')
 		if lfc_absolute_path == True:
 			lfc_file_path=lfc_file_name
 		else:
-			lfc_file_path="""/grid/%s/sgfs/%s/%s/%s""" % (self.infra_pxvo,self.app_lfcdir,self.user_name,lfc_file_name)
-		cmd="""export LCG_GFAL_INFOSYS=%s && export LFC_HOST=%s && export X509_USER_PROXY=%s && lfc-ls -l %s""" % (self.infra_bdii,self.infra_lfc,self.transaction_proxy,lfc_file_path)
-		execCmd=ExecCmd()
-		file_entry=execCmd.cmd(cmd)
-		returnCode=execCmd.returnCode()
+			lfc_file_path="%s/%s" % (self.userDir(),lfc_file_name)
+		returnCode,cmd,file_entry=LFC.backend.stat(self,lfc_file_path)
 		if returnCode == 0:
-			cmd="""echo '%s' | awk '{ print $5 }'""" % file_entry
-			file_size=execCmd.cmd(cmd).strip()
+			file_size=file_entry.size
 		return returnCode,cmd,file_size,lfc_file_path
 
+##
+## List of file names given to the batch services, either as a comma
+## separated string or as a repeated parameter (None if not given)
+##
+def get_file_names(files):
+	if files is None:
+		return None
+	if not isinstance(files,list):
+		files=files.split(',')
+	return [file_name for file_name in files if len(file_name) > 0]
+
+def end_transaction(sgfsDB,transaction_id):
+	# Closes the transaction (/close and reaper)
+	SGFSReaper.get().forgetTransaction(transaction_id)
+	# Before close the transactio; remove all files in action table
+	for action_file in sgfsDB.getActionFiles(transaction_id):
+		action_dir=os.path.dirname(action_file)
+		print "Removing %s - %s" % (action_file,action_dir)
+		try:
+			os.unlink(action_file)
+		except OSError:
+			print "EXCEPTION: unlink %s" % action_file
+		try:
+			os.rmdir(action_dir)
+		except OSError:
+			print "EXCEPTION: rmdir  %s" % action_dir
+	tmpfile=sgfsDB.closeTransaction(transaction_id)
+	# Shared proxies stay alive for the other transactions
+	if not Infrastructure.isSharedProxy(tmpfile):
+		print "Removing proxy file - %s" % tmpfile
+		try:
+			os.unlink(tmpfile)
+		except OSError:
+			print "EXCEPTION: unlink %s" % tmpfile
+
+def release_bookings(booking_files,booking_pids):
+	# Stops the downloads of closed bookings and removes their files
+	# (/close_bookings and reaper)
+	SGFSReaper.get().forgetBookings([booking_id for booking_id,booking_pid in booking_pids])
+	for booking_id,booking_pid in booking_pids:
+		SGFSBookingSupervisor.get().kill(booking_id,booking_pid)
+	for booking_file in booking_files:
+		booking_file_dir=os.path.dirname(booking_file)
+		print "Removing %s - %s" % (booking_file,booking_file_dir)
+		try:
+			os.unlink(booking_file)
+		except OSError:
+			print "EXCEPTION: unlink %s" % booking_file
+		try:
+			os.rmdir(booking_file_dir)
+		except OSError:
+			print "EXCEPTION: rmdir  %s" % booking_file_dir
+
 ##
 ## CherryPy REST handler classes
 ##
@@ -642,16 +3921,19 @@ limitations under the License.'''
 		service_block=sgfsOutput.newBlock(answer_block,'services')
 		sgfsOutput.addBlockValue(service_block,"service","Shows this information",(('address','/'),))
 		sgfsOutput.addBlockValue(service_block,"service","Begin a new transaction with a given user name and application name",(('address','/begin/<username>/<appname>'),))
-		sgfsOutput.addBlockValue(service_block,"service","List user' files stored on the LFC file catalog",(('address','/list/<transaction_id>'),))
-		sgfsOutput.addBlockValue(service_block,"service","Synchronous download a given file from the LFC file catalog",(('address','/download/<transaction_id>/<file_name>'),))
+		sgfsOutput.addBlockValue(service_block,"service","List user' files stored on the LFC file catalog",(('address','/list/<transaction_id>[?offset=<n>&limit=<n>&pattern=<glob>&sort=[-]name|size|date&refresh=true]'),))
+		sgfsOutput.addBlockValue(service_block,"service","Synchronous download a given file from the LFC file catalog (HTTP Range requests allowed)",(('address','/download/<transaction_id>/<file_name>'),))
 		sgfsOutput.addBlockValue(service_block,"service","Delete a given file from the LFC file catalog",(('address','/delete/<transaction_id>/<file_name>'),))
-		sgfsOutput.addBlockValue(service_block,"service","Book a file to be downloaded from LFC to the server",(('address','/book/<transaction_id>/<file_name>'),))
+		sgfsOutput.addBlockValue(service_block,"service","Delete many files at once, given by name or by pattern",(('address','/delete_many/<transaction_id>?files=<name>,<name>,...|pattern=<glob>'),))
+		sgfsOutput.addBlockValue(service_block,"service","Book a file to be downloaded from LFC to the server",(('address','/book/<transaction_id>/<file_name>[?priority=<n>]'),))
+		sgfsOutput.addBlockValue(service_block,"service","Book many files at once, given by name or by pattern",(('address','/book_many/<transaction_id>?files=<name>,<name>,...|pattern=<glob>[&priority=<n>]'),))
 		sgfsOutput.addBlockValue(service_block,"service","Show the list of booked files containing their statuses",(('address','/bookings/<transaction_id>'),))
 		sgfsOutput.addBlockValue(service_block,"service","Closes all booking associated to the given transaction",(('address','/close_bookings/<transaction_id>'),))
-		sgfsOutput.addBlockValue(service_block,"service","Download a booked file",(('address','/sync_download/<transaction_id>/<booking_id>'),))
+		sgfsOutput.addBlockValue(service_block,"service","Download a booked file (HTTP Range requests allowed)",(('address','/sync_download/<transaction_id>/<booking_id>'),))
 		sgfsOutput.addBlockValue(service_block,"service","Close the given transaction",(('address','/close/<transaction_id>'),))
 		sgfsOutput.addBlockValue(service_block,"service","Get the SURL address of a given LFC file",(('address','/surl/<transaction_id>/<file_name>'),))
 		sgfsOutput.addBlockValue(service_block,"service","Registers a given SURL into the LFC file catalog (Works only in POST mode!)",(('address','/register_surl/<transaction_id>/<surl>/<lfc_file_name>[/<lfc_file_path>]'),))
+		sgfsOutput.addBlockValue(service_block,"service","Reload cached users, applications, infrastructures and transaction data",(('address','/refresh_cache'),))
 		return sgfsOutput.render('\t')
 
 class JSONTester:
@@ -672,6 +3954,22 @@ class JSONTester:
 		#    a default xxxxx statement could be: '_jqjsp'
 		#    return "_jqjsp(<json_answer>)"
 
+class refreshCache:
+	@cherrypy.expose
+	def index(self,json=None):
+		http_method = getattr(self,cherrypy.request.method)
+		return (http_method)(json)
+
+	def GET(self,json=None):
+		# Drop cached reference data and transaction contexts; next
+		# lookups reload them (called by sgfs_cleaner.sh)
+		SGFSDB.refCache.invalidate()
+		SGFSDB.lfcCache.clear()
+		# SGFS Answer
+		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
+		answer_block=sgfsOutput.Answer(True)
+		return sgfsOutput.render('\t')
+
 class beginTransaction:
 	@cherrypy.expose
 	def index(self,user_name=None,application_name=None,json=None):
@@ -682,11 +3980,12 @@ class beginTransaction:
 		# Register the new transaction on the database
 		sgfsDB=SGFSDB()
 		transaction_id=sgfsDB.registerTransaction(user_name,application_name)
-		# Associate a proxy to the new transaction
-		tmpfile = tempfile.mktemp()
+		# Closed by the reaper if the client never does
+		SGFSReaper.get().addTransaction(transaction_id)
+		# Associate the shared infrastructure proxy to the new transaction
 		infra_id=sgfsDB.getInfrastructureId(transaction_id)
 		infrastructure=Infrastructure(infra_id)
-		infrastructure.getProxy(tmpfile)
+		tmpfile=infrastructure.sharedProxy()
 		sgfsDB.storeTransactionProxy(transaction_id,tmpfile)
 		# SGFS Answer
 		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
@@ -702,25 +4001,7 @@ class endTransaction:
 		
 	def GET(self,transaction_id=None,json=None):
 		# End the given transaction on the database
-		sgfsDB=SGFSDB()
-		# Before close the transactio; remove all files in action table
-		for action_file in sgfsDB.getActionFiles(transaction_id):
-			action_dir=os.path.dirname(action_file)
-			print "Removing %s - %s" % (action_file,action_dir)
-			try:
-				os.unlink(action_file)
-			except OSError:
-				print "EXCEPTION: unlink %s" % action_file
-			try:
-				os.rmdir(action_dir)
-			except OSError:
-				print "EXCEPTION: rmdir  %s" % action_dir
-		tmpfile=sgfsDB.closeTransaction(transaction_id)
-		print "Removing proxy file - %s" % tmpfile
-		try:
-			os.unlink(tmpfile)
-		except OSError:
-			print "EXCEPTION: unlink %s" % tmpfile
+		end_transaction(SGFSDB(),transaction_id)
 		# SGFS Answer
 		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
 		answer_block=sgfsOutput.Answer(True)
@@ -729,48 +4010,53 @@ class endTransaction:
 
 class listTransactionFiles:
 	@cherrypy.expose
-	def index(self,transaction_id=None,json=None):
+	def index(self,transaction_id=None,json=None,refresh=None,offset=None,limit=None,pattern=None,sort=None,pretty=None):
 		http_method = getattr(self,cherrypy.request.method)
-		return (http_method)(transaction_id,json)
+		return (http_method)(transaction_id,json,refresh,offset,limit,pattern,sort,pretty)
+	index._cp_config = {'response.stream': True}
 		
-	def GET(self,transaction_id=None,json=None):
+	def GET(self,transaction_id=None,json=None,refresh=None,offset=None,limit=None,pattern=None,sort=None,pretty=None):
+		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json),True,SGFSOutput.prettyMode(pretty))
+		# Check paging parameters
+		try:
+			offset=int(offset or 0)
+			if limit is not None:
+				limit=int(limit)
+			if offset < 0 or (limit is not None and limit < 0) or \
+			   (sort is not None and sort.lstrip('-') not in LFC.sortKeys):
+				raise ValueError
+		except ValueError:
+			answer_block=sgfsOutput.Answer(False)
+			sgfsOutput.addBlockValue(answer_block,'error',"Wrong offset, limit or sort (%s) parameter" % ','.join(sorted(LFC.sortKeys)))
+			return sgfsOutput.render('\t')
 		# Register the new transaction on the database
 		sgfsDB=SGFSDB()
-		infra_bdii,        \
-		infra_lfc,         \
-		app_lfcdir,        \
-		user_name,         \
-		transaction_proxy, \
-		infra_pxvo = sgfsDB.getTransactionLFCData(transaction_id)
-		# Create the LFC object
-		lfc = LFC(infra_bdii,infra_lfc,app_lfcdir,user_name,transaction_proxy,infra_pxvo)
-		# Get file list
-		result, file_list=lfc.list()
-		# SGFS Answer
-		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
-		if result == 0:
-			answer_block=sgfsOutput.Answer(True)
-			for file_rec in file_list.split('\n'):
-				file_remark=''
-				if len(file_rec) > 0:
-					try:
-						rec_items   = file_rec.split()
-						file_name   = rec_items[8]
-						file_size   = rec_items[4]
-						file_flags  = rec_items[0]
-						file_date   = '%s %s %s' % (rec_items[5],rec_items[6],rec_items[7])
-						file_remark = ''
-						if rec_items[9:] != []:
-							for w in rec_items[9:]:
-								file_remark ="%s %s" %(file_remark,w)
-						file_remark = file_remark.strip()
-					except:
-						pass
-					sgfsOutput.addValue(answer_block,'file',(('name',file_name),('size',file_size),('flags',file_flags),('date',file_date),('remark',file_remark),))
-		else:
+		# Retrieve the (cached) LFC object of the transaction
+		lfc = sgfsDB.getTransactionLFC(transaction_id)
+		# Get file list (refresh=true skips the listing cache); the first
+		# entry is read here so that listing errors make a KO answer
+		file_list=lfc.listFiles(offset,limit,pattern,sort,refresh is not None and refresh.lower() == 'true')
+		try:
+			first_entry=[entry for entry in itertools.islice(file_list,1)]
+		except LFCError, e:
 			answer_block=sgfsOutput.Answer(False)
-			sgfsOutput.addBlockValue(answer_block,'error',file_list)
-		return sgfsOutput.render('\t')
+			sgfsOutput.addBlockValue(answer_block,'error',e.output)
+			return sgfsOutput.render('\t')
+		# SGFS Answer (streamed while entries arrive)
+		sgfsOutput.headers()
+		answer_block=sgfsOutput.Answer(True)
+		return self.content(sgfsOutput,answer_block,itertools.chain(first_entry,file_list))
+
+	def content(self,sgfsOutput,answer_block,file_list):
+		try:
+			for entry in file_list:
+				sgfsOutput.addValue(answer_block,'file',(('name',entry.name),('size',entry.size),('flags',entry.flags),('date',entry.date),('remark',entry.remark),))
+				data=sgfsOutput.flush(SGFS_StreamChunkSize)
+				if len(data) > 0:
+					yield data
+		except LFCError, e:
+			sgfsOutput.addBlockValue(answer_block,'error',e.output)
+		yield sgfsOutput.render('\t')
 
 class delFile:
 	@cherrypy.expose
@@ -781,66 +4067,150 @@ class delFile:
 	def GET(self,transaction_id=None,lfc_file_name=None,json=None):
 		# Register the new transaction on the database
 		sgfsDB=SGFSDB()
-		infra_bdii,        \
-		infra_lfc,         \
-		app_lfcdir,        \
-		user_name,         \
-		transaction_proxy, \
-		infra_pxvo = sgfsDB.getTransactionLFCData(transaction_id)
-		# Create the LFC object
-		lfc = LFC(infra_bdii,infra_lfc,app_lfcdir,user_name,transaction_proxy,infra_pxvo)
+		# Retrieve the (cached) LFC object of the transaction
+		lfc = sgfsDB.getTransactionLFC(transaction_id)
 		# Get file from storage
 		lfn_name=lfc.rm(lfc_file_name)
 		# Register the DELETE action on file
-		sgfsDB.registerAction(transaction_id,1,lfn_name,'')
+		sgfsDB.logAction(transaction_id,1,lfn_name,'')
 		# SGFS Answer
 		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
 		answer_block=sgfsOutput.Answer(True)
 		sgfsOutput.addBlockValue(answer_block,"lfn_name",lfn_name)
 		return sgfsOutput.render('\t')
 
+class delManyFiles:
+	@cherrypy.expose
+	def index(self,transaction_id=None,files=None,pattern=None,json=None):
+		http_method = getattr(self,cherrypy.request.method)
+		return (http_method)(transaction_id,files,pattern,json)
+	
+	def GET(self,transaction_id=None,files=None,pattern=None,json=None):
+		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
+		lfc_file_names=get_file_names(files)
+		if lfc_file_names is None and pattern is None:
+			answer_block=sgfsOutput.Answer(False)
+			sgfsOutput.addBlockValue(answer_block,"error","Either 'files' or 'pattern' must be given")
+			return sgfsOutput.render('\t')
+		sgfsDB=SGFSDB()
+		# Retrieve the (cached) LFC object of the transaction
+		lfc = sgfsDB.getTransactionLFC(transaction_id)
+		# Delete all the files, a few at once
+		returnCode,cmd,results=lfc.rmMany(lfc_file_names,pattern)
+		if returnCode != 0:
+			answer_block=sgfsOutput.Answer(False)
+			sgfsOutput.addBlockValue(answer_block,"error",results)
+			sgfsOutput.addBlockValue(answer_block,"command",cmd)
+			return sgfsOutput.render('\t')
+		# Log the DELETE actions of the deleted files
+		sgfsDB.logActions(transaction_id,1,[(lfn_name,'') for lfc_file_name,returnCode,cmd,output,lfn_name in results if returnCode == 0])
+		answer_block=sgfsOutput.Answer(True)
+		for lfc_file_name,returnCode,cmd,output,lfn_name in results:
+			if returnCode == 0:
+				sgfsOutput.addValue(answer_block,"deleted",(('lfc_file_name',lfc_file_name),('lfn_name',lfn_name),))
+			else:
+				sgfsOutput.addValue(answer_block,"failed",(('lfc_file_name',lfc_file_name),('error',str(output).strip()),('command',cmd),))
+		return sgfsOutput.render('\t')
+	
+	def POST(self,transaction_id=None,files=None,pattern=None,json=None):
+		# Long lists of files can be sent in the request body
+		return self.GET(transaction_id,files,pattern,json)
+
 class bookFile:
 	@cherrypy.expose
-	def index(self,transaction_id=None,lfc_file_name=None,json=None):
+	def index(self,transaction_id=None,lfc_file_name=None,json=None,priority=None):
 		http_method = getattr(self,cherrypy.request.method)
-		return (http_method)(transaction_id,lfc_file_name,json)
+		return (http_method)(transaction_id,lfc_file_name,json,priority)
 		
-	def GET(self,transaction_id=None,lfc_file_name=None,json=None):
+	def GET(self,transaction_id=None,lfc_file_name=None,json=None,priority=None):
 		# Retrieve LFC data from transaction
 		sgfsDB=SGFSDB()
-		infra_bdii,        \
-		infra_lfc,         \
-		app_lfcdir,        \
-		user_name,         \
-		transaction_proxy, \
-		infra_pxvo = sgfsDB.getTransactionLFCData(transaction_id)
-		# Create the LFC object
-		lfc = LFC(infra_bdii,infra_lfc,app_lfcdir,user_name,transaction_proxy,infra_pxvo)
-		# Get file from storage in background
-		file_name, file_size, p=lfc.book(lfc_file_name)
+		# Retrieve the (cached) LFC object of the transaction
+		lfc = sgfsDB.getTransactionLFC(transaction_id)
+		# Get file from storage in background (once scheduled)
+		returnCode,cmd,file_size,file_name=lfc.book(lfc_file_name)
+		if returnCode != 0:
+			# SGFS Answer
+			sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
+			answer_block=sgfsOutput.Answer(False)
+			sgfsOutput.addBlockValue(answer_block,"error",file_name)
+			sgfsOutput.addBlockValue(answer_block,"command",cmd)
+			return sgfsOutput.render('\t')
+		try:
+			priority=int(priority or 0)
+		except ValueError:
+			priority=0
 		# Register the BOOKING action on file
 		action_id = sgfsDB.registerAction(transaction_id,2,lfc_file_name,file_name)
 		# Register the BOOKING
-		booking_id = sgfsDB.registerBooking(action_id,transaction_id,file_size,p)
+		booking_id = sgfsDB.registerBooking(action_id,transaction_id,file_size)
+		SGFSBookingSupervisor.get().submit(booking_id,file_name,file_size,cmd,lfc.user_name,None,priority,lfc.storageElementLookup(lfc_file_name))
 		# SGFS Answer
 		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
 		answer_block=sgfsOutput.Answer(True)
 		sgfsOutput.addBlockValue(answer_block,"booking_id",booking_id)
 		return sgfsOutput.render('\t')
 
+class bookManyFiles:
+	@cherrypy.expose
+	def index(self,transaction_id=None,files=None,pattern=None,json=None,priority=None):
+		http_method = getattr(self,cherrypy.request.method)
+		return (http_method)(transaction_id,files,pattern,json,priority)
+	
+	def GET(self,transaction_id=None,files=None,pattern=None,json=None,priority=None):
+		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
+		lfc_file_names=get_file_names(files)
+		if lfc_file_names is None and pattern is None:
+			answer_block=sgfsOutput.Answer(False)
+			sgfsOutput.addBlockValue(answer_block,"error","Either 'files' or 'pattern' must be given")
+			return sgfsOutput.render('\t')
+		try:
+			priority=int(priority or 0)
+		except ValueError:
+			priority=0
+		sgfsDB=SGFSDB()
+		# Retrieve the (cached) LFC object of the transaction
+		lfc = sgfsDB.getTransactionLFC(transaction_id)
+		# Prepare all the bookings from one listing
+		returnCode,cmd,bookings,missing=lfc.bookMany(lfc_file_names,pattern)
+		if returnCode != 0:
+			answer_block=sgfsOutput.Answer(False)
+			sgfsOutput.addBlockValue(answer_block,"error",bookings)
+			sgfsOutput.addBlockValue(answer_block,"command",cmd)
+			return sgfsOutput.render('\t')
+		# Register all the BOOKING actions and bookings at once
+		ids=sgfsDB.registerBookings(transaction_id,[(lfc_file_name,file_name,file_size) for lfc_file_name,file_name,file_size,cmd in bookings])
+		answer_block=sgfsOutput.Answer(True)
+		supervisor=SGFSBookingSupervisor.get()
+		for (lfc_file_name,file_name,file_size,cmd),(action_id,booking_id) in zip(bookings,ids):
+			supervisor.submit(booking_id,file_name,file_size,cmd,lfc.user_name,None,priority,lfc.storageElementLookup(lfc_file_name))
+			sgfsOutput.addValue(answer_block,"booking",(('booking_id',booking_id),('action_id',action_id),('lfc_file_name',lfc_file_name),('file_size',file_size),))
+		for lfc_file_name in missing:
+			sgfsOutput.addValue(answer_block,"missing",(('lfc_file_name',lfc_file_name),))
+		return sgfsOutput.render('\t')
+	
+	def POST(self,transaction_id=None,files=None,pattern=None,json=None,priority=None):
+		# Long lists of files can be sent in the request body
+		return self.GET(transaction_id,files,pattern,json,priority)
+
 class bookingsCheck:
 	@cherrypy.expose
-	def index(self,transaction_id=None,json=None):
+	def index(self,transaction_id=None,json=None,pretty=None):
 		http_method = getattr(self,cherrypy.request.method)
-		return (http_method)(transaction_id,json)
+		return (http_method)(transaction_id,json,pretty)
+	index._cp_config = {'response.stream': True}
 		
-	def GET(self,transaction_id=None,json=None):
+	def GET(self,transaction_id=None,json=None,pretty=None):
 		# SGFS Answer
-		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
+		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json),True,SGFSOutput.prettyMode(pretty))
 		# Retrieve LFC data from transaction
 		sgfsDB=SGFSDB()
 		bookings = sgfsDB.getBookings(transaction_id)
+		sgfsOutput.headers()
 		answer_block=sgfsOutput.Answer(True)
+		return self.content(sgfsOutput,answer_block,sgfsDB,bookings)
+
+	def content(self,sgfsOutput,answer_block,sgfsDB,bookings):
 		for book in bookings:
 			booking_id         = book[0]
 			file_size          = book[1]
@@ -850,6 +4220,7 @@ class bookingsCheck:
 			action_id          = book[5]
 			file_name          = os.path.basename(book[6])
 			transaction_id     = book[7]
+			SGFSReaper.get().touchBooking(booking_id)
 			try:
 				new_download_file_size = os.path.getsize(book[6])
 			except OSError:
@@ -858,12 +4229,19 @@ class bookingsCheck:
 			# sets: download_file_size = -1
 			# informing the client about the no more unexisting pid
 			# (download failed).
+			status='done'
 			if new_download_file_size < file_size:
-				cmd="ps -ef | grep sgfs | grep %s | grep lcg-cp | grep -v grep | awk '{ print $2 }'" % download_pid
-				execCmd=ExecCmd()
-				pid = execCmd.cmd(cmd)
- 				if len(pid) == 0:
-					print "Orphan pid: %s detected" % pid
+				status=SGFSBookingSupervisor.get().status(booking_id,download_pid)
+				if status == 'done':
+					# lcg-cp may have finished after the size check
+					try:
+						new_download_file_size = os.path.getsize(book[6])
+					except OSError:
+						new_download_file_size = 0
+				if status in ('done','failed') and new_download_file_size < file_size:
+					print "Orphan pid: %s detected" % download_pid
+					status='failed'
+					SGFSBookingSupervisor.get().remove(booking_id)
 					download_file_size=-1
 					sgfsDB.closeBookings(transaction_id,(booking_id,))
 					booking_file = sgfsDB.orphanBooking(booking_id,download_pid)
@@ -871,6 +4249,8 @@ class bookingsCheck:
 						os.unlink(booking_file)
 					except OSError:
 						print "EXCEPTION: unlink %s" % booking_file
+			if status == 'done':
+				SGFSBookingSupervisor.get().forget((booking_id,))
 			# Prepare the output
 			sgfsOutput.addValue(answer_block,"booking", \
 								(('booking_id',booking_id),\
@@ -879,27 +4259,44 @@ class bookingsCheck:
 								 ('action_id',action_id), \
 								 ('file_name',file_name), \
 								 ('transaction_id',transaction_id),
-								 ('download_url',download_url),))
+								 ('download_url',download_url),
+								 ('status',status),))
 			if download_file_size < new_download_file_size:
 				sgfsDB.updateBookingFileSize(booking_id,new_download_file_size)
 			if download_file_size > 0 and download_url is None and new_download_file_size == file_size:
 				sgfsDB.updateBookingUrl(booking_id,transaction_id)
-		return sgfsOutput.render('\t')
+			data=sgfsOutput.flush(SGFS_StreamChunkSize)
+			if len(data) > 0:
+				yield data
+		yield sgfsOutput.render('\t')
 
 class bookedDownload:
 	@cherrypy.expose
 	def index(self,transaction_id=None,booking_id=None,json=None):
 		http_method = getattr(self,cherrypy.request.method)
 		return (http_method)(transaction_id,booking_id,json)
+	index._cp_config = {'response.stream': True}
 		
 	def GET(self,transaction_id=None,booking_id=None,json=None):
 		sgfsDB=SGFSDB()
 		# Get file from action_id
 		file_name=sgfsDB.getBookedFile(booking_id)
+		SGFSReaper.get().touchBooking(booking_id)
 		# Register the DOWNLOAD_BOOKING action
-		sgfsDB.registerAction(transaction_id,4,"%s"%booking_id,file_name)
+		sgfsDB.logAction(transaction_id,4,"%s"%booking_id,file_name)
+		try:
+			file_size=os.stat(file_name).st_size
+		except OSError:
+			raise cherrypy.NotFound()
 		# Serve it to the client for download
-		return serve_file(file_name, "application/x-download", "attachment")
+		fileRanges=SGFSRanges(file_size)
+		ranges=fileRanges.parse()
+		cherrypy.response.headers['Content-Type'       ] = 'application/x-download'
+		cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(file_name)
+		fileRanges.setHeaders()
+		fileStream=SGFSFileStream(file_name,file_size,label="%s-%s" % (transaction_id,booking_id),ranges=ranges)
+		fileStream.register()
+		return fileRanges.body(fileStream.chunks())
 
 class closeBookings:
 	@cherrypy.expose
@@ -913,27 +4310,8 @@ class closeBookings:
 			booking_info = sgfsDB.closeBookings(transaction_id,booking_ids.split(','))
 		else:
 			booking_info = sgfsDB.closeBookings(transaction_id,None)
-		# Check and remove active downloads
-		for booking_pid in booking_info[1]:
-			cmd="ps -ef | grep sgfs | grep %s | grep lcg-cp | grep -v grep | awk '{ print $2 }'" % booking_pid
-			execCmd=ExecCmd()
-			pids = execCmd.cmd(cmd).split('\n')
-			for pid in pids:
-				if len(pid) > 0:
-					print "Killing pid: %s" % pid
-					os.kill(int(pid),signal.SIGKILL)
-		# Update the database
-		for booking_file in booking_info[0]:
-			booking_file_dir=os.path.dirname(booking_file)
-			print "Removing %s - %s" % (booking_file,booking_file_dir)
-			try:
-				os.unlink(booking_file)
-			except OSError:
-				print "EXCEPTION: unlink %s" % booking_file
-			try:
-				os.rmdir(booking_file_dir)
-			except OSError:
-				print "EXCEPTION: rmdir  %s" % booking_file_dir
+		# Stop active downloads and remove booked files
+		release_bookings(*booking_info)
 		# SGFS Answer
 		sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
 		answer_block=sgfsOutput.Answer(True)
@@ -947,14 +4325,8 @@ class getSurl:
 		
 	def GET(self,transaction_id=None,lfc_file_name=None,json=None):
 		sgfsDB=SGFSDB()
-		infra_bdii,        \
-		infra_lfc,         \
-		app_lfcdir,        \
-		user_name,         \
-		transaction_proxy, \
-		infra_pxvo = sgfsDB.getTransactionLFCData(transaction_id)
-		# Create the LFC object
-		lfc = LFC(infra_bdii,infra_lfc,app_lfcdir,user_name,transaction_proxy,infra_pxvo)
+		# Retrieve the (cached) LFC object of the transaction
+		lfc = sgfsDB.getTransactionLFC(transaction_id)
 		#retrieve the SURL
 		returnCode,cmd,surls = lfc.getSurls(lfc_file_name)
 		# SGFS Answer
@@ -987,14 +4359,8 @@ class regSurl:
 	
 	def POST(self,transaction_id=None,surl=None,lfc_file_name=None,lfc_path=None,json=None):
 		sgfsDB=SGFSDB()
-		infra_bdii,        \
-		infra_lfc,         \
-		app_lfcdir,        \
-		user_name,         \
-		transaction_proxy, \
-		infra_pxvo = sgfsDB.getTransactionLFCData(transaction_id)
-		# Create the LFC object
-		lfc = LFC(infra_bdii,infra_lfc,app_lfcdir,user_name,transaction_proxy,infra_pxvo)
+		# Retrieve the (cached) LFC object of the transaction
+		lfc = sgfsDB.getTransactionLFC(transaction_id)
 		#register SURL
 		returnCode,cmd,guid,lfc_path = lfc.regSurl(surl,lfc_file_name,lfc_path)
 		# register Action
@@ -1012,14 +4378,6 @@ class regSurl:
 		return sgfsOutput.render('\t')
 
 class getFile:
-	gfal_f    = None
-	action_id = None
-	
-	def __del__(self):
-		if self.gfal_f is not None:
-			print "[%s] Closing interrupted transfer gfal file descriptor" % self.action_id
-			gfalthr.gfal_close(self.gfal_f)
-	
 	@cherrypy.expose
 	def index(self,transaction_id=None,lfc_file_name=None,json=None):
 		http_method = getattr(self,cherrypy.request.method)
@@ -1029,26 +4387,43 @@ class getFile:
 	def GET(self,transaction_id=None,lfc_file_name=None,json=None):
 		# Register the new transaction on the database
 		sgfsDB=SGFSDB()
-		infra_bdii,        \
-		infra_lfc,         \
-		app_lfcdir,        \
-		user_name,         \
-		transaction_proxy, \
-		infra_pxvo = sgfsDB.getTransactionLFCData(transaction_id)
-		# Create the LFC object
-		lfc = LFC(infra_bdii,infra_lfc,app_lfcdir,user_name,transaction_proxy,infra_pxvo)
+		# Retrieve the (cached) LFC object of the transaction
+		lfc = sgfsDB.getTransactionLFC(transaction_id)
 		# Get file from storage
 		returnCode,cmd,file_size,file_name=lfc.file_data(lfc_file_name)
-		# Register the DOWNLOAD  action on file
+		# Log the DOWNLOAD  action on file
 		if returnCode == 0:
-			self.action_id = sgfsDB.registerAction(transaction_id,0,lfc_file_name,file_name)
+			sgfsDB.logAction(transaction_id,0,lfc_file_name,file_name)
+			label="%s-%s" % (transaction_id,lfc_file_name)
 			# Serve it to the client for download
+			fileRanges=SGFSRanges(int(file_size))
+			ranges=fileRanges.parse()
+			body=None
+			if SGFS_DownloadStaging:
+				# Whole files are fetched once in the staging cache and shared
+				# by concurrent downloads; ranges use it only if already there
+				returnCode,cmd,staged_size,staged=lfc.stage(None,file_name,gfal=True,start=ranges is None,label=label)
+				if returnCode == 0 and staged is not None:
+					fileStream=SGFSFileStream(staged.path(),int(file_size),staged,lambda: LFC.stagingCache.release(staged),label,ranges)
+					fileStream.register()
+					body=self.stagedContent(fileStream,staged)
+			if body is None:
+				# Opened before the headers, so that failures are answered
+				gfal_f=SGFSGfalPool.get().open(lfc.transaction_proxy,lfc.infra_bdii,lfc.infra_lfc,file_name)
+				if gfal_f is None:
+					cherrypy.response.status=503
+					sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
+					answer_block=sgfsOutput.Answer(False)
+					sgfsOutput.addBlockValue(answer_block,"error","Unable to open file: '%s'" % os.path.basename(file_name))
+					sgfsOutput.addBlockValue(answer_block,"command","gfal_open('lfn:%s')" % file_name)
+					return sgfsOutput.render('\t')
+				body=self.content(gfal_f,lfc.transaction_proxy,lfc.infra_bdii,lfc.infra_lfc,file_name,int(file_size),ranges,label)
 			cherrypy.response.headers['Content-Type'       ] = 'application/x-download'
 			cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(file_name)
-			cherrypy.response.headers['Content-Length'     ] = '%s'                        % file_size
 			cherrypy.response.headers['Cache-Control'      ] = 'no-cache, must-revalidate'
 			cherrypy.response.headers['Pragma'             ] = 'no-cache'
-			return self.content(transaction_proxy,infra_bdii,infra_lfc,file_name,int(file_size))
+			fileRanges.setHeaders()
+			return fileRanges.body(body)
 		else:
 			# SGFS Answer
 			sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
@@ -1057,7 +4432,7 @@ class getFile:
 			sgfsOutput.addBlockValue(answer_block,"command",cmd)
 			return sgfsOutput.render('\t')
 	
-	def content(self,px_file,bdii_host,lfc_host,lfc_file_name,file_size):
+	def content(self,gfal_f,px_file,bdii_host,lfc_host,lfc_file_name,file_size,ranges=None,label=None):
 		print """
 --------------------------------------\n
 [%s] GFAL transfer \n
@@ -1066,29 +4441,18 @@ class getFile:
 	lfc  : '%s'
 	file : 'lfn:%s'
 	size : %s bytes\n
---------------------------------------""" % (self.action_id,px_file,bdii_host,lfc_host,lfc_file_name,file_size)
-		os.environ["X509_USER_PROXY"] = px_file
-		os.environ["LCG_GFAL_INFOSYS"] = bdii_host
-		os.environ["LFC_HOST"]=lfc_host
-		transfer_size=0
-		buffer_size=8*1024
-		self.gfal_f=gfalthr.gfal_open("lfn:%s" % lfc_file_name,os.O_RDONLY,0755)
-		while transfer_size < file_size:
-			buffer_data = gfalthr.gfal_read(self.gfal_f,buffer_size)
-			if buffer_data[1] is not None:
-				block_size=buffer_data[0]
-				transfer_size+=block_size
-				if transfer_size == file_size:
-					#print "transfer: %s/%s (%s) " % (transfer_size,file_size,block_size)
-					gfalthr.gfal_close(self.gfal_f)
-					self.gfal_f = None
-					print "[%s] transfer: (done)" % self.action_id
-				#else:
-					#print "transfer: %s/%s (%s) " % (transfer_size,file_size,block_size)
-				yield buffer_data[1][:buffer_size]
-			else:
-				print "[%s] Unable to download ..." % self.action_id
-				return
+--------------------------------------""" % (label,px_file,bdii_host,lfc_host,lfc_file_name,file_size)
+		# The reader closes gfal_f, also if the body is never read
+		return SGFSGfalReader(gfal_f,file_size,label,ranges).chunks()
+
+	def stagedContent(self,fileStream,staged):
+		try:
+			for data in fileStream.chunks():
+				yield data
+		finally:
+			# Completed streams already gave the file back
+			if not fileStream.finished:
+				LFC.stagingCache.release(staged)
 
 #
 # FileTransfer class (used to handle file streams)
@@ -1098,11 +4462,10 @@ class getFile:
 #
 class SGFS_FileTransfer:
 	sgfsDB         = None
-	gfal_f         = None
-	fs_f           = None
-	action_id      = None
+	gfal_reader    = None
+	fs_stream      = None
 	transaction_id = None
-	action_id      = None
+	label          = None  # Names the transfer in the log lines
 	px_file        = None
 	bdii_host      = None
 	lfc_host       = None
@@ -1111,25 +4474,26 @@ class SGFS_FileTransfer:
 	file_name      = None
 	transferCmd    = None
 	transfer_size  = None
+	staged         = None
 
 	#def __init__(self):
 	#	
 
 	def __del__(self):
-		if self.gfal_f is not None:
-			print "[%s-%s] Closing interrupted transfer gfal file descriptor at (%s/%s)" % (self.transaction_id,self.action_id,self.transfer_size,self.file_size)
-			gfalthr.gfal_close(self.gfal_f)
-		if self.fs_f is not None:
-			print "[%s-%s] Closing interrupted transfer fs file descriptor at (%s/%s)" % (self.transaction_id,self.action_id,self.transfer_size,self.file_size)
-			if self.transferCmd is not None:
+		if self.gfal_reader is not None:
+			self.gfal_reader.stop()
+		if self.fs_stream is not None and not self.fs_stream.finished:
+			print "[%s-%s] Closing interrupted transfer fs file descriptor at (%s/%s)" % (self.transaction_id,self.label,self.transfer_size,self.file_size)
+			# The fetch of a staged file may be shared (see releaseFile)
+			if self.transferCmd is not None and self.staged is None:
 				self.transferCmd.killAll()
-			self.fs_f.close()
+			self.fs_stream.close()
 			self.closeTransaction()
-			self.deleteFile()
+			self.releaseFile()
 
-	def gfalTransfer(self,transaction_id,action_id,px_file,bdii_host,lfc_host,lfc_file_name,file_size):
+	def gfalTransfer(self,transaction_id,label,px_file,bdii_host,lfc_host,lfc_file_name,file_size):
 		self.transaction_id = transaction_id
-		self.action_id      = action_id
+		self.label          = label
 		self.px_file        = px_file
 		self.bdii_host      = bdii_host
 		self.lfc_host       = lfc_host
@@ -1143,83 +4507,86 @@ class SGFS_FileTransfer:
 	lfc  : '%s'
 	file : 'lfn:%s'
 	size : %s bytes\n
---------------------------------------""" % (self.action_id,self.px_file,self.bdii_host,self.lfc_host,self.lfc_file_name,self.file_size)
-		os.environ["X509_USER_PROXY"] = px_file
-		os.environ["LCG_GFAL_INFOSYS"] = bdii_host
-		os.environ["LFC_HOST"]=lfc_host
+--------------------------------------""" % (self.label,self.px_file,self.bdii_host,self.lfc_host,self.lfc_file_name,self.file_size)
 		self.transfer_size=0
-		buffer_size=8*1024
-		self.gfal_f=gfalthr.gfal_open("lfn:%s" % self.lfc_file_name,os.O_RDONLY,0755)
-		if self.gfal_f > 0:
-			while self.transfer_size < self.file_size:
-				buffer_data = gfalthr.gfal_read(self.gfal_f,buffer_size)
-				if buffer_data[1] is not None:
-					block_size=buffer_data[0]
-					self.transfer_size+=block_size
-					if self.transfer_size == self.file_size:
-						#print "[%s] transfer: %s/%s (%s) " % (self.action_id,self.transfer_size,file_size,block_size)
-						print "[%s] transfer: (done)" % self.action_id
-						gfalthr.gfal_close(self.gfal_f)
-						self.gfal_f = None
-				#	else:
-						#print "[%s] transfer: %s/%s (%s) " % (self.action_id,self.transfer_size,file_size,block_size)
-				yield buffer_data[1][:buffer_size]
-			else:
-				print "[%s] Unable to download file '%s'" % (self.action_id,lfc_file_name)
-				return
+		gfal_f=SGFSGfalPool.get().open(px_file,bdii_host,lfc_host,self.lfc_file_name)
+		if gfal_f is not None:
+			self.gfal_reader=SGFSGfalReader(gfal_f,self.file_size,self.label)
+			for data in self.gfal_reader.chunks():
+				self.transfer_size+=len(data)
+				yield data
+		else:
+			print "[%s] Unable to download file '%s'" % (self.label,lfc_file_name)
 	
-	def fsTransfer(self,transaction_id,action_id,file_name,file_size):
-		self.action_id      = action_id
+	def fsTransfer(self,transaction_id,label,file_name,file_size,staged=None):
+		# file_name is ignored for files of the staging cache (staged)
+		self.label          = label
 		self.transaction_id = transaction_id
+		self.staged         = staged
+		if staged is not None:
+			file_name=staged.path()
 		self.file_name      = file_name
 		self.file_size      = file_size
 		print """
 --------------------------------------------\n
 [%s-%s] Transfer file: '%s' (%s) bytes\n
---------------------------------------------""" % (self.transaction_id,self.action_id,self.file_name,self.file_size)
+--------------------------------------------""" % (self.transaction_id,self.label,self.file_name,self.file_size)
 		self.transfer_size=0
-		buffer_size=16*1024
-		try:
-			self.fs_f=open(self.file_name,'r')
-			while self.transfer_size < self.file_size:
-				buffer_data=self.fs_f.read(buffer_size)
-				block_size=len(buffer_data)
-				self.transfer_size+=block_size
-				if block_size > 0:
-					#print "[%s] transfer: %s/%s (%s) " % (self.action_id,self.transfer_size,file_size,block_size)
-					if self.transfer_size == self.file_size:
-						print "[%s-%s] transfer: (done)" % (self.transaction_id,self.action_id)
-						self.fs_f.close()
-						self.fs_f=None
-						self.deleteFile()
-						self.closeTransaction()
-					yield buffer_data[:block_size]
-		except IOError, (errno, strerror):
+		writer=self.staged
+		if writer is None and self.transferCmd is not None:
+			writer=self.transferCmd.p
+		self.fs_stream=SGFSFileStream(self.file_name,self.file_size,writer,self.fsTransferDone,"%s-%s" % (self.transaction_id,self.label))
+		self.fs_stream.register()
+		return self.fsChunks()
+
+	def fsChunks(self):
+		try:
+			for buffer_data in self.fs_stream.chunks():
+				self.transfer_size+=len(buffer_data)
+				yield buffer_data
+		except (IOError,OSError), (errno, strerror):
 			# SGFS Answer
 			sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
 			answer_block=sgfsOutput.Answer(False)
 			sgfsOutput.addBlockValue(answer_block,"error","I/O-Error (%s): %s" % (errno, strerror))
 			yield sgfsOutput.render('\t')
 
+	def fsTransferDone(self):
+		print "[%s-%s] transfer: (done)" % (self.transaction_id,self.label)
+		self.releaseFile()
+		self.closeTransaction()
+
+	def releaseFile(self):
+		# Staged files are kept by the staging cache, which also stops
+		# their fetch when no other download is reading them
+		if self.staged is None:
+			self.deleteFile()
+			return
+		LFC.stagingCache.release(self.staged)
+		self.staged=None
+
 	def closeTransaction(self):
+		SGFSReaper.get().forgetTransaction(self.transaction_id)
 		sgfs_DB=SGFSDB()
 		tmpfile=sgfs_DB.closeTransaction(self.transaction_id)
-		print "[%s-%s] Removing proxy file - %s" % (self.transaction_id,self.action_id,tmpfile)
+		if Infrastructure.isSharedProxy(tmpfile):
+			return
+		print "[%s-%s] Removing proxy file - %s" % (self.transaction_id,self.label,tmpfile)
 		try:
 			os.unlink(tmpfile)
 		except OSError:
-			print "[%s-%s] EXCEPTION: unlink %s" % (self.transaction_id.self.action_id,self.action_id,tmpfile)
+			print "[%s-%s] EXCEPTION: unlink %s" % (self.transaction_id,self.label,tmpfile)
 
 	def deleteFile(self):
 		file_dir=os.path.dirname(self.file_name)
 		try:
 			os.unlink(self.file_name)
 		except OSError:
-			print "[%s-%s] EXCEPTION: unlink %s" % (self.transaction_id,self.action_id,self.file_name)
+			print "[%s-%s] EXCEPTION: unlink %s" % (self.transaction_id,self.label,self.file_name)
 		try:
 			os.rmdir(file_dir)
 		except OSError:
-			print "[%s-%s] EXCEPTION: rmdir  %s" % (self.transaction_id,self.action_id,action_dir)
+			print "[%s-%s] EXCEPTION: rmdir  %s" % (self.transaction_id,self.label,file_dir)
 
 	def getTransferCmd(self):
 		self.transferCmd = ExecCmd()
@@ -1266,46 +4633,43 @@ class fixedDownload:
  date_to          : %s \n\
  down_count       : %s \n\
 --------------------------\n""" % (user_name,application_name,lfc_file_name,lfc_absolute_path,date_from,date_to,down_count)
-		# Begin transaction
+		# Begin transaction; closed by the transfer once done (see
+		# SGFS_FileTransfer.fsTransferDone), by the reaper if interrupted
 		transaction_id=sgfsDB.registerTransaction(user_name,application_name)
-		# Associate a proxy to the new transaction
-		tmpfile = tempfile.mktemp()
+		SGFSReaper.get().addTransaction(transaction_id)
+		# The streamed answer keeps it alive (see SGFSReaper.touchResponse)
+		cherrypy.request.sgfs_transaction_id=transaction_id
+		# Associate the shared infrastructure proxy to the new transaction
 		infra_id=sgfsDB.getInfrastructureId(transaction_id)
 		infrastructure=Infrastructure(infra_id)
-		infrastructure.getProxy(tmpfile)
+		tmpfile=infrastructure.sharedProxy()
 		sgfsDB.storeTransactionProxy(transaction_id,tmpfile)
 		# Now I can download the requested file still form db
-		infra_bdii,        \
-		infra_lfc,         \
-		app_lfcdir,        \
-		user_name,         \
-		transaction_proxy, \
-		infra_pxvo = sgfsDB.getTransactionLFCData(transaction_id)
-		# Create the LFC object
-		lfc = LFC(infra_bdii,infra_lfc,app_lfcdir,user_name,transaction_proxy,infra_pxvo)
+		lfc = sgfsDB.getTransactionLFC(transaction_id)
 		# Instanciate the lcg-cp execute cmd
 		fileTransfer=SGFS_FileTransfer()
 		lcgCpCmd=fileTransfer.getTransferCmd()
-		# Get file from storage
-		returnCode,cmd,file_size,file_name=lfc.file(lcgCpCmd,lfc_file_name,lfc_absolute_path=True)
+		# Get file from the staging cache or from storage
+		returnCode,cmd,file_size,staged=lfc.stage(lcgCpCmd,lfc_file_name)
 		if returnCode == 0:
-			action_id = sgfsDB.registerAction(transaction_id,6,lfc_file_name,file_name)
+			sgfsDB.logAction(transaction_id,6,lfc_file_name,staged.path())
 			# Serve it to the client for download
 			cherrypy.response.headers['Content-Type'       ] = 'application/x-download'
 			cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(lfc_file_name)
 			cherrypy.response.headers['Content-Length'     ] = '%s'                        % file_size
 			cherrypy.response.headers['Cache-Control'      ] = 'no-cache, must-revalidate'
 			cherrypy.response.headers['Pragma'             ] = 'no-cache'
-			
-			return fileTransfer.fsTransfer(transaction_id,action_id,file_name,int(file_size))
+			# Logged as /download does: no action_id before the action log writes it
+			return fileTransfer.fsTransfer(transaction_id,lfc_file_name,None,int(file_size),staged)
 		else:
+			# Nothing left to download in this transaction
+			end_transaction(sgfsDB,transaction_id)
 			# SGFS Answer
 			sgfsOutput=SGFSOutput(SGFSOutput.jsonMode(json))
 			answer_block=sgfsOutput.Answer(False)
-			sgfsOutput.addBlockValue(answer_block,"error",file_name)
+			sgfsOutput.addBlockValue(answer_block,"error",staged)
 			sgfsOutput.addBlockValue(answer_block,"command",cmd)
 			return sgfsOutput.render('\t')
-		# What about the opened transaction?
 
 ##
 ## The application services will be defined here ...
@@ -1317,15 +4681,66 @@ def get_app():
 	root.list=listTransactionFiles()
 	root.download=getFile()
 	root.delete=delFile()
+	root.delete_many=delManyFiles()
 	root.json=JSONTester()
 	root.book=bookFile() 
+	root.book_many=bookManyFiles()
 	root.bookings=bookingsCheck()
 	root.async_download=bookedDownload()
 	root.close_bookings=closeBookings()
 	root.surl=getSurl()
 	root.register_surl=regSurl()
 	root.fixed_download=fixedDownload()
-	return cherrypy.tree.mount(root) 
+	root.refresh_cache=refreshCache()
+	# Started here so that the main thread can install its SIGCHLD handler
+	SGFSExecutor.get()
+	# SIGUSR1 (graceful) reloads the reference data cache
+	cherrypy.engine.subscribe('graceful',SGFSDB.refCache.invalidate)
+	# Stale transactions and bookings are closed in background
+	SGFSReaper.get()
+	cherrypy.tools.sgfs_touch=cherrypy.Tool('before_handler',SGFSReaper.touchRequest)
+	cherrypy.tools.sgfs_touch_body=cherrypy.Tool('before_finalize',SGFSReaper.touchResponse)
+	# Queued actions are written before the server goes away
+	cherrypy.engine.subscribe('stop',SGFSActionLog.flushAll)
+	atexit.register(SGFSActionLog.flushAll)
+	# Idle GFAL worker processes go away with the server
+	cherrypy.engine.subscribe('stop',SGFSGfalPool.stopAll)
+	# Give back pooled DB connections once the handler returns (streamed
+	# bodies may pick one up again, released at the end of the request)
+	cherrypy.tools.sgfs_dbrelease=cherrypy.Tool('before_finalize',SGFSDB.release)
+	cherrypy.tools.sgfs_dbrelease_end=cherrypy.Tool('on_end_request',SGFSDB.release)
+	config = {
+		'/': {
+			'tools.sgfs_dbrelease.on'    : True,
+			'tools.sgfs_dbrelease_end.on': True,
+			'tools.sgfs_touch.on'        : True,
+			'tools.sgfs_touch_body.on'   : True,
+		}
+	}
+	return cherrypy.tree.mount(root,config=config) 
+
+##
+## WSGI middleware that lets the server send local files by itself
+##
+## Handlers offer an SGFSFileStream with SGFSFileStream.register(); when
+## the file is complete it is returned in the server file wrapper
+## (sendfile under mod_wsgi) in place of the CherryPy body.
+##
+def sgfs_file_wrapper(app):
+	def wsgi_app(environ,start_response):
+		# Nothing left by a request served without the middleware
+		SGFSFileStream.take()
+		response=app(environ,start_response)
+		fileStream=SGFSFileStream.take()
+		file_wrapper=environ.get('wsgi.file_wrapper')
+		if fileStream is not None and file_wrapper is not None:
+			wrapper=fileStream.handOver(file_wrapper)
+			if wrapper is not None:
+				if hasattr(response,'close'):
+					response.close()
+				return wrapper
+		return response
+	return wsgi_app
 
 ##
 ## SGFS WSGI startup
@@ -1339,12 +4754,469 @@ def get_wsgi_app():
 		"engine.autoreload_on":       True, 
 	} 
 	cherrypy.config.update(config) 
-	return app 
+	return sgfs_file_wrapper(app) 
+
+##
+## SGFS asynchronous server
+##
+## Serves the WSGI application from a single asyncore loop (poll based)
+## instead of one thread per connection, so that slow clients of large
+## downloads only cost a socket and a small buffer. Handlers and every
+## read of a response body (disk or GFAL) run in a pool of
+## SGFS_AsyncWorkers threads; the next body chunk of a client is only
+## read once less than SGFS_AsyncBuffer bytes wait to be sent to it.
+## Bodies never block a worker for long: GFAL files are read one buffer
+## per task, and an empty chunk (a file still being downloaded) makes the
+## loop read the body again after SGFS_FilePollInterval.
+## Files handed over through wsgi.file_wrapper are sent with sendfile(2).
+## Each task restores the CherryPy request of its connection and gives
+## back the DB connection of the worker thread once done.
+##
+class SGFSAsyncTrigger(asyncore.file_dispatcher):
+	# Runs callbacks of the worker threads in the loop thread
+	def __init__(self,socket_map):
+		self.rfd,self.wfd=os.pipe()
+		asyncore.file_dispatcher.__init__(self,self.rfd,socket_map)
+		self.lock=threading.Lock()
+		self.callbacks=deque()
+
+	def post(self,callback,*args):
+		self.lock.acquire()
+		try:
+			self.callbacks.append((callback,args))
+		finally:
+			self.lock.release()
+		try:
+			os.write(self.wfd,'x')
+		except OSError:
+			pass
+
+	def writable(self):
+		return False
+
+	def handle_read(self):
+		try:
+			self.recv(4096)
+		except socket.error:
+			pass
+		while True:
+			self.lock.acquire()
+			try:
+				if len(self.callbacks) == 0:
+					return
+				callback,args=self.callbacks.popleft()
+			finally:
+				self.lock.release()
+			try:
+				callback(*args)
+			except Exception, e:
+				print "[async] EXCEPTION: %s" % e
+
+class SGFSAsyncExecutor:
+	def __init__(self,trigger,workers=SGFS_AsyncWorkers):
+		self.trigger=trigger
+		self.tasks=Queue.Queue()
+		for i in range(workers):
+			thread=threading.Thread(target=self.run,name='sgfs-async-%s' % i)
+			thread.setDaemon(True)
+			thread.start()
+
+	def submit(self,request,func,callback):
+		# callback(result,error) is called in the loop thread
+		self.tasks.put((request,func,callback))
+
+	def run(self):
+		while True:
+			request,func,callback=self.tasks.get()
+			result=None
+			error=None
+			if request.serving is not None:
+				cherrypy.serving.load(*request.serving)
+			try:
+				result=func()
+			except StopIteration, e:
+				error=e
+			except Exception, e:
+				error=e
+				print "[async] EXCEPTION: %s" % e
+			finally:
+				request.serving=(cherrypy.serving.request,cherrypy.serving.response)
+				cherrypy.serving.clear()
+				SGFSDB.release()
+			self.trigger.post(callback,result,error)
+
+class SGFSAsyncFileWrapper:
+	# wsgi.file_wrapper; sent with sendfile(2) when possible
+	def __init__(self,fileobj,blksize=SGFS_FileChunkSize):
+		self.fileobj=fileobj
+		self.blksize=blksize
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		data=self.fileobj.read(self.blksize)
+		if not data:
+			raise StopIteration
+		return data
+
+	def close(self):
+		self.fileobj.close()
+
+class SGFSAsyncChannel(asyncore.dispatcher):
+	libc       = None
+	libcLoaded = False
+
+	@staticmethod
+	def sendfile():
+		if not SGFSAsyncChannel.libcLoaded:
+			SGFSAsyncChannel.libcLoaded=True
+			try:
+				libc=ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+				if hasattr(libc,'sendfile'):
+					libc.sendfile.restype=ctypes.c_ssize_t
+					libc.sendfile.argtypes=[ctypes.c_int,ctypes.c_int,ctypes.POINTER(ctypes.c_long),ctypes.c_size_t]
+					SGFSAsyncChannel.libc=libc
+			except OSError:
+				pass
+		return SGFSAsyncChannel.libc
+
+	def __init__(self,server,sock,addr):
+		asyncore.dispatcher.__init__(self,sock,server.socket_map)
+		self.server     = server
+		self.addr       = addr
+		self.inbuf      = ''
+		self.outbuf     = deque()
+		self.outlen     = 0
+		self.reading    = True
+		self.headers    = None  # request line and headers, once read
+		self.body_size  = 0
+		self.serving    = None  # CherryPy (request,response) of the handler
+		self.status     = None
+		self.out_headers= None
+		self.response   = None  # WSGI response being sent
+		self.body       = None  # and its iterator
+		self.pending    = False # A worker is busy for this channel
+		self.waiting    = False # The body is read again by a timer
+		self.finished   = False # The whole response is queued
+		self.closed     = False # The client is gone or the answer is broken
+		self.shut       = False # The socket is closed
+		self.file       = None  # [fd,offset,remaining] sent with sendfile
+
+	def readable(self):
+		return self.reading
+
+	def writable(self):
+		return self.outlen > 0 or (self.file is not None and self.status is not None)
+
+	def handle_read(self):
+		try:
+			data=self.recv(65536)
+		except socket.error:
+			self.handle_close()
+			return
+		if not data:
+			self.handle_close()
+			return
+		self.inbuf+=data
+		if self.headers is None:
+			end=self.inbuf.find('\r\n\r\n')
+			if end < 0:
+				if len(self.inbuf) > 65536:
+					self.error('400 Bad Request')
+				return
+			if not self.parseHeaders(self.inbuf[:end]):
+				return
+			self.inbuf=self.inbuf[end+4:]
+		if len(self.inbuf) >= self.body_size:
+			self.reading=False
+			self.server.executor.submit(self,self.callApp,self.appStarted)
+			self.pending=True
+
+	def parseHeaders(self,head):
+		lines=head.split('\r\n')
+		try:
+			method,uri,protocol=lines[0].split(' ',2)
+		except ValueError:
+			self.error('400 Bad Request')
+			return False
+		headers={}
+		for line in lines[1:]:
+			name,sep,value=line.partition(':')
+			name=name.strip().upper().replace('-','_')
+			if name in headers:
+				headers[name]+=','+value.strip()
+			else:
+				headers[name]=value.strip()
+		if headers.get('TRANSFER_ENCODING','identity').lower() != 'identity':
+			self.error('411 Length Required')
+			return False
+		try:
+			self.body_size=int(headers.get('CONTENT_LENGTH') or 0)
+		except ValueError:
+			self.error('400 Bad Request')
+			return False
+		if self.body_size > SGFS_AsyncMaxBody:
+			self.error('413 Request Entity Too Large')
+			return False
+		if self.body_size > 0 and headers.get('EXPECT','').lower() == '100-continue':
+			self.push('%s 100 Continue\r\n\r\n' % protocol)
+		self.headers=(method,uri,protocol,headers)
+		return True
+
+	def environ(self):
+		method,uri,protocol,headers=self.headers
+		path,sep,query=uri.partition('?')
+		environ={
+			'REQUEST_METHOD'   : method,
+			'SCRIPT_NAME'      : '',
+			'PATH_INFO'        : urllib.unquote(path),
+			'QUERY_STRING'     : query,
+			'SERVER_NAME'      : self.server.host,
+			'SERVER_PORT'      : str(self.server.port),
+			'SERVER_PROTOCOL'  : protocol,
+			'REMOTE_ADDR'      : self.addr[0],
+			'REMOTE_PORT'      : str(self.addr[1]),
+			'wsgi.version'     : (1,0),
+			'wsgi.url_scheme'  : 'http',
+			'wsgi.input'       : StringIO.StringIO(self.inbuf[:self.body_size]),
+			'wsgi.errors'      : sys.stderr,
+			'wsgi.multithread' : True,
+			'wsgi.multiprocess': False,
+			'wsgi.run_once'    : False,
+			'wsgi.file_wrapper': SGFSAsyncFileWrapper,
+		}
+		for name,value in headers.items():
+			if name in ('CONTENT_TYPE','CONTENT_LENGTH'):
+				environ[name]=value
+			else:
+				environ['HTTP_%s' % name]=value
+		return environ
+
+	def startResponse(self,status,headers,exc_info=None):
+		self.status=status
+		self.out_headers=headers
+		return self.push
+
+	def callApp(self):
+		# Worker thread
+		return self.server.app(self.environ(),self.startResponse)
+
+	def appStarted(self,response,error):
+		self.pending=False
+		if error is not None or self.status is None:
+			self.error('500 Internal Server Error')
+			return
+		self.response=response
+		try:
+			self.body=iter(response)
+		except TypeError:
+			self.error('500 Internal Server Error')
+			return
+		head=['HTTP/1.1 %s' % self.status]
+		content_length=None
+		for name,value in self.out_headers:
+			if name.lower() == 'connection':
+				continue
+			if name.lower() == 'content-length':
+				content_length=int(value)
+			head.append('%s: %s' % (name,value))
+		head.append('Connection: close')
+		self.outbuf.appendleft('\r\n'.join(head)+'\r\n\r\n')
+		self.outlen+=len(self.outbuf[0])
+		if self.headers[0] == 'HEAD':
+			self.finished=True
+		elif isinstance(response,SGFSAsyncFileWrapper) and SGFSAsyncChannel.sendfile() is not None:
+			fileobj=response.fileobj
+			size=os.fstat(fileobj.fileno()).st_size-fileobj.tell()
+			if content_length is not None:
+				size=min(size,content_length)
+			self.file=[fileobj.fileno(),fileobj.tell(),size]
+		self.next()
+
+	def next(self):
+		# Reads the next body chunk if the client keeps up
+		if self.closed:
+			self.done()
+			return
+		if self.pending or self.waiting or self.finished or self.file is not None or self.outlen >= SGFS_AsyncBuffer:
+			return
+		if self.body is None:
+			return
+		self.pending=True
+		self.server.executor.submit(self,self.body.next,self.chunkRead)
+
+	def chunkRead(self,data,error):
+		self.pending=False
+		if error is not None:
+			self.finished=True
+			if not isinstance(error,StopIteration):
+				# Headers are gone already; the client sees a short answer
+				self.closed=True
+		elif data:
+			self.push(data)
+		elif not self.closed:
+			# Nothing to send yet: the file is still being downloaded
+			self.waiting=True
+			self.server.later(SGFS_FilePollInterval,self.wake)
+			return
+		if self.finished and self.outlen == 0:
+			self.done()
+		else:
+			self.next()
+
+	def wake(self):
+		self.waiting=False
+		if not self.shut:
+			self.next()
+
+	def push(self,data):
+		# Also the WSGI write() callable
+		self.outbuf.append(data)
+		self.outlen+=len(data)
+
+	def handle_write(self):
+		while self.outlen > 0:
+			data=self.outbuf[0]
+			try:
+				sent=self.send(data)
+			except socket.error:
+				self.handle_close()
+				return
+			if sent == 0:
+				return
+			self.outlen-=sent
+			if sent < len(data):
+				self.outbuf[0]=data[sent:]
+				return
+			self.outbuf.popleft()
+		if self.file is not None:
+			self.sendFile()
+			return
+		if self.finished:
+			self.done()
+		else:
+			self.next()
+
+	def sendFile(self):
+		fd,offset,remaining=self.file
+		if remaining > 0:
+			offset_p=ctypes.c_long(offset)
+			sent=SGFSAsyncChannel.libc.sendfile(self.socket.fileno(),fd,ctypes.byref(offset_p),min(remaining,SGFS_FileChunkSize))
+			if sent < 0:
+				if ctypes.get_errno() in (errno.EAGAIN,errno.EINTR):
+					return
+				self.file=None
+				self.finished=True
+				self.closed=True
+				self.done()
+				return
+			self.file=[fd,offset_p.value,remaining-sent]
+			if sent > 0 and remaining-sent > 0:
+				return
+		self.file=None
+		self.finished=True
+		self.done()
+
+	def error(self,status):
+		self.reading=False
+		self.status=status
+		self.push('HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %s\r\nConnection: close\r\n\r\n%s' % (status,len(status),status))
+		self.finished=True
+
+	def handle_close(self):
+		self.closed=True
+		self.reading=False
+		self.outbuf.clear()
+		self.outlen=0
+		self.done()
+
+	def done(self):
+		# Closes the WSGI response (in a worker, with its CherryPy request)
+		# and the connection once the worker is free and the output sent
+		if self.pending:
+			return
+		if self.outlen > 0 and not self.closed:
+			return
+		self.body=None
+		if self.response is not None:
+			response,self.response=self.response,None
+			if hasattr(response,'close'):
+				self.pending=True
+				self.server.executor.submit(self,response.close,lambda result,error: self.responseClosed())
+				return
+		self.responseClosed()
+
+	def responseClosed(self):
+		self.pending=False
+		self.file=None
+		self.closed=True
+		if not self.shut:
+			self.shut=True
+			self.close()
+
+	def handle_error(self):
+		print "[async] Connection error from %s: %s" % (self.addr[0],sys.exc_info()[1])
+		self.handle_close()
+
+class SGFSAsyncServer(asyncore.dispatcher):
+	def __init__(self,app,host='0.0.0.0',port=SGFS_Port):
+		self.socket_map={}
+		asyncore.dispatcher.__init__(self,map=self.socket_map)
+		self.app=app
+		self.host=host
+		self.port=port
+		self.trigger=SGFSAsyncTrigger(self.socket_map)
+		self.executor=SGFSAsyncExecutor(self.trigger)
+		self.timers=[]  # heap of (time,sequence,callback), loop thread only
+		self.sequence=0
+		self.create_socket(socket.AF_INET,socket.SOCK_STREAM)
+		self.set_reuse_addr()
+		self.bind((host,port))
+		self.listen(SGFS_AsyncBacklog)
+
+	def handle_accept(self):
+		try:
+			pair=self.accept()
+		except socket.error:
+			return
+		if pair is not None:
+			SGFSAsyncChannel(self,*pair)
+
+	def later(self,delay,callback):
+		# Runs callback in the loop thread after delay seconds
+		self.sequence+=1
+		heapq.heappush(self.timers,(time.time()+delay,self.sequence,callback))
+
+	def runTimers(self):
+		now=time.time()
+		while len(self.timers) > 0 and self.timers[0][0] <= now:
+			callback=heapq.heappop(self.timers)[2]
+			try:
+				callback()
+			except Exception, e:
+				print "[async] EXCEPTION: %s" % e
+
+	def serve(self):
+		while cherrypy.engine.state == cherrypy.engine.states.STARTED:
+			timeout=1.0
+			if len(self.timers) > 0:
+				timeout=max(0.0,min(timeout,self.timers[0][0]-time.time()))
+			asyncore.loop(timeout,True,self.socket_map,1)
+			self.runTimers()
 
 ##
 ## SGFS Standalone startup
 ##
 def main():
+	mode = SGFS_ServerMode
+	if len(sys.argv) > 1:
+		mode = sys.argv[1]
+	if mode == 'async':
+		main_async()
+		return
+	# The CherryPy HTTP server offers no wsgi.file_wrapper: files are
+	# always sent through Python here (see sgfs_file_wrapper)
 	app = get_app() 
 	config = { 
 		'server.socket_host': '0.0.0.0',
@@ -1355,6 +5227,30 @@ def main():
 	cherrypy.config.update(config) 
 	cherrypy.quickstart(app) 
 
+def main_async():
+	# Same application, served by SGFSAsyncServer in place of the
+	# CherryPy HTTP server
+	app = get_app() 
+	config = { 
+		'response.timeout'    :   1000000,
+		'response.stream'     :      True,
+		'engine.autoreload_on':     False,
+	} 
+	cherrypy.config.update(config) 
+	cherrypy.server.unsubscribe()
+	# Bodies are read by the server pool, without blocking its threads
+	SGFSGfalReader.readAhead = False
+	SGFSFileStream.blocking  = False
+	if hasattr(cherrypy.engine,'signal_handler'):
+		cherrypy.engine.signal_handler.subscribe()
+	server = SGFSAsyncServer(sgfs_file_wrapper(app),'0.0.0.0',SGFS_Port)
+	cherrypy.engine.start()
+	try:
+		server.serve()
+	finally:
+		if cherrypy.engine.state == cherrypy.engine.states.STARTED:
+			cherrypy.engine.exit()
+
 if __name__ == "__main__":
 	main() 
 
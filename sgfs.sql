@@ -9,6 +9,7 @@
 -- (!) Pay attention the current script removes the existing database
 --     in case you need keep old data, please save your data first
 --     and then migrate your old data to the new database
+--     (existing databases can be upgraded in place with sgfs_migrate.py)
 --
 -- Copyright (c) 2011:
 -- Istituto Nazionale di Fisica Nucleare (INFN), Italy
@@ -39,6 +40,22 @@ grant all on sgfs.* TO 'sgfs_user'@'localhost' IDENTIFIED BY "sgfs_password";
 flush privileges;
 use sgfs;
 
+--
+-- Schema version table - Migrations applied to the database (see migrations/)
+--
+-- Fresh databases already include every migration listed below
+--
+create table sgfs_schema_version (
+	 version          int unsigned not null
+	,version_ts       datetime not null
+	,version_desc     varchar(256)
+
+	,primary key (version)
+);
+
+insert into sgfs_schema_version (version,version_ts,version_desc) values (1,now(),'Indexes for bookings, actions and cleaner queries');
+insert into sgfs_schema_version (version,version_ts,version_desc) values (2,now(),'Last request of the open transactions');
+
 --
 -- Infrastructure table - Science Gateway enabled infrastructure
 --
@@ -115,9 +132,12 @@ create table sgfs_transactions (
 	,transaction_proxy varchar(256)
 	,transaction_from  datetime  not null
 	,transaction_to    datetime
+	,transaction_touched datetime
 	,transaction_ip    varchar(32)
 
 	,primary key (transaction_id)
+	,index sgfs_transactions_user_app (user_id,app_id)
+	,index sgfs_transactions_from (transaction_from)
 	,foreign key (user_id) references sgfs_users(user_id)
 	,foreign key (app_id)  references sgjp_applications(app_id)
 	,foreign key (infra_id) references sgfs_infrastructures(infra_id)
@@ -147,6 +167,7 @@ create table sgfs_actions (
 	,action_ip        varchar(32)
 	
 	,primary key (action_id)
+	,index sgfs_actions_transaction (transaction_id,action)
 	,foreign key (transaction_id) references sgfs_transactions(transaction_id)
 );
 
@@ -164,6 +185,8 @@ create table sgfs_bookings (
 	,booking_ip         varchar(32)
 	
 	,primary key (booking_id)
+	,index sgfs_bookings_transaction (transaction_id,action_id)
+	,index sgfs_bookings_action (action_id)
 	,foreign key (action_id) references sgfs_actions(action_id)
 	,foreign key (transaction_id) references sgfs_transactions(transaction_id)
 );
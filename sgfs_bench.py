@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#coding: utf-8
+'''
+sgfs_bench.py - Times the SGFS bookings and actions queries as the tables grow
+
+Loads the sgfs.sql schema in a scratch database, then grows the
+transactions, actions and bookings tables step by step with rows of many
+users. After each step it times the SGFSDB queries of a single transaction,
+whose own rows never change: with the schema indexes their times stay flat
+while the tables grow.
+
+The scratch database must exist and be writable by the SGFS user, e.g.:
+  mysql -u root -p -e "create database sgfs_bench; grant all on sgfs_bench.* to 'sgfs_user'@'localhost'"
+
+Usage:
+  sgfs_bench.py [database [actions,actions,...]] > bench_output.txt
+
+  database - scratch database (default: sgfs_bench); its tables are replaced
+  actions  - table sizes of each step (default: 10000,100000,1000000)
+
+Author: Riccardo Bruno (riccardo.bruno@ct.infn.it)
+'''
+import os
+import sys
+import time
+from sgfs import SGFSDB
+from sgfs_migrate import sql_statements
+
+BENCH_Users=1000          # Users owning the background transactions
+BENCH_TransactionActions=10 # Actions of each background transaction
+BENCH_BookingRatio=5      # One action every BENCH_BookingRatio is a booking
+BENCH_ProbeBookings=10    # Bookings of the timed transaction
+BENCH_Repeat=20           # Runs of each timed query
+BENCH_InsertBatch=10000   # Rows of each insert while growing the tables
+
+def load_schema(sgfsDB):
+	# sgfs.sql without the database creation part
+	sql_file=os.path.join(os.path.dirname(os.path.abspath(__file__)),'sgfs.sql')
+	statements=sql_statements(sql_file)
+	statements=statements[[statement.lower() for statement in statements].index('use sgfs')+1:]
+	sgfsDB.connect()
+	for table in ('sgfs_downloads','sgfs_bookings','sgfs_actions','sgfs_transactions','sgfs_applications','sgfs_users','sgfs_infrastructures','sgfs_schema_version'):
+		sgfsDB.execute("""drop table if exists %s;""" % table)
+	for statement in statements:
+		sgfsDB.execute(statement)
+	sgfsDB.dbConn.cursor().executemany("""insert into sgfs_users (user_name) values (%s);""",[('bench_%s' % user,) for user in range(BENCH_Users)])
+	sgfsDB.commit()
+	sgfsDB.close()
+
+def insert_many(sgfsDB,sql_query,rows):
+	cursor=sgfsDB.dbConn.cursor()
+	for start in range(0,len(rows),BENCH_InsertBatch):
+		cursor.executemany(sql_query,rows[start:start+BENCH_InsertBatch])
+	return cursor
+
+def add_transactions(sgfsDB,transactions,user_ids=None,transaction_actions=BENCH_TransactionActions,booking_ratio=BENCH_BookingRatio):
+	# Adds transactions with their actions and bookings; returns their ids
+	sgfsDB.connect()
+	if user_ids is None:
+		cursor=sgfsDB.execute("""select user_id from sgfs_users where user_name like 'bench\\_%';""")
+		user_ids=[row[0] for row in cursor.fetchall()]
+	cursor=sgfsDB.execute("""select coalesce(max(transaction_id),0) from sgfs_transactions;""")
+	last_id=cursor.fetchone()[0]
+	insert_many(sgfsDB,"""insert into sgfs_transactions (user_id,app_id,infra_id,transaction_from,transaction_ip) values (%s,%s,1,now(),'127.0.0.1');""",[(user_ids[transaction % len(user_ids)],1+transaction % 4) for transaction in range(transactions)])
+	cursor=sgfsDB.execute("""select transaction_id from sgfs_transactions where transaction_id > %s;""" % last_id)
+	transaction_ids=[row[0] for row in cursor.fetchall()]
+	actions=[]
+	for transaction_id in transaction_ids:
+		for action in range(transaction_actions):
+			actions.append((transaction_id,2 if action % booking_ratio == 0 else 0,'bench_%s_%s' % (transaction_id,action),'/tmp/bench_%s_%s' % (transaction_id,action)))
+	insert_many(sgfsDB,"""insert into sgfs_actions (transaction_id,action_ts,action,lfc_file_name,file_name,action_ip) values (%s,now(),%s,%s,%s,'127.0.0.1');""",actions)
+	sgfsDB.execute("""insert into sgfs_bookings (action_id,transaction_id,file_size,download_file_size,download_pid,booking_ip) select action_id,transaction_id,1024,0,NULL,'127.0.0.1' from sgfs_actions where action=2 and transaction_id > %s;""" % last_id)
+	sgfsDB.commit()
+	sgfsDB.close()
+	return transaction_ids
+
+def add_probe(sgfsDB):
+	# The timed transaction: its own (user,application), a few bookings and
+	# as many downloads
+	sgfsDB.connect()
+	cursor=sgfsDB.execute("""insert into sgfs_users (user_name) values ('probe');""")
+	user_id=cursor.lastrowid
+	sgfsDB.commit()
+	sgfsDB.close()
+	return add_transactions(sgfsDB,1,[user_id],2*BENCH_ProbeBookings,2)[0]
+
+def count_actions(sgfsDB):
+	sgfsDB.connect()
+	cursor=sgfsDB.execute("""select count(*) from sgfs_actions;""")
+	actions=cursor.fetchone()[0]
+	sgfsDB.close()
+	return actions
+
+def reopen_bookings(sgfsDB,transaction_id):
+	sgfsDB.connect()
+	sgfsDB.execute("""update sgfs_actions set action=2 where action=3 and transaction_id=%s;""" % transaction_id)
+	sgfsDB.commit()
+	sgfsDB.close()
+
+def time_query(query):
+	# Median milliseconds of BENCH_Repeat runs
+	times=[]
+	for run in range(BENCH_Repeat):
+		start=time.time()
+		query()
+		times.append((time.time()-start)*1000)
+	return sorted(times)[len(times)/2]
+
+def closeBookings(sgfsDB,transaction_id):
+	sgfsDB.closeBookings(transaction_id,None)
+	reopen_bookings(sgfsDB,transaction_id)
+
+def main():
+	database=len(sys.argv) > 1 and sys.argv[1] or 'sgfs_bench'
+	steps=len(sys.argv) > 2 and [int(step) for step in sys.argv[2].split(',')] or [10000,100000,1000000]
+	sgfsDB=SGFSDB()
+	sgfsDB.database_name=database
+	# SGFSDB prints every query; only the results go to stdout
+	stdout=sys.stdout
+	sys.stdout=sys.stderr
+	try:
+		load_schema(sgfsDB)
+		probe_id=add_probe(sgfsDB)
+		queries=(
+			('getBookings'   ,lambda: sgfsDB.getBookings(probe_id)),
+			('getActionFiles',lambda: sgfsDB.getActionFiles(probe_id)),
+			('closeBookings' ,lambda: closeBookings(sgfsDB,probe_id)),
+		)
+		results=[]
+		for step in steps:
+			actions=count_actions(sgfsDB)
+			if step > actions:
+				add_transactions(sgfsDB,(step-actions)/BENCH_TransactionActions)
+			results.append((count_actions(sgfsDB),[time_query(query) for name,query in queries]))
+	finally:
+		sys.stdout=stdout
+		SGFSDB.release()
+	print "SGFS query times (median of %s runs, ms)" % BENCH_Repeat
+	print "%10s %s" % ('actions',' '.join(['%15s' % name for name,query in queries]))
+	for actions,times in results:
+		print "%10s %s" % (actions,' '.join(['%15.2f' % query_time for query_time in times]))
+
+if __name__ == "__main__":
+	main()
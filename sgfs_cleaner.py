@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+#coding: utf-8
+'''
+sgfs_cleaner.py - Cleans the Science Gateway File System database and the
+                  related temporary files; it also kills pending lcg-* commands
+
+Transactions started before the cutoff date are processed in chunks of
+CLEANER_Chunk: their bookings, actions and the transactions themselves are
+deleted with a few set-based statements per chunk, while the downloaded
+files and proxies are removed by a pool of CLEANER_Workers threads.
+Files of the staging cache and shared proxies are owned by the running
+server and never removed; the server is asked to refresh its caches at the end.
+
+Call this script manually or via scheduled cron job executing:
+
+#sgfs_cleaner.py [info|exec] [cutoff] [sgfs_url] > $(date +%Y%m%d%H%M%S)_sgfs_cleaner.log
+
+  info - (default) shows what would be done; no changes on both DB/FS
+  exec - applies the changes on both DB/FS
+
+Author: riccardo.bruno@ct.infn.it
+'''
+import os
+import sys
+import time
+import signal
+import shutil
+import urllib2
+import threading
+import Queue
+import MySQLdb
+from sgfs import SGFSDB, SGFS_StagingDir, SGFS_ProxyDir
+
+CLEANER_CutoffDate='2012-07-14'
+CLEANER_URL='http://localhost:8088'
+CLEANER_Chunk=1000  # Transactions deleted by each set of statements
+CLEANER_Workers=8   # Threads removing files and proxies
+
+##
+## Counters of the cleaner statistics
+##
+class SGFSCleanerStats:
+	names=('bookings','actions','transactions','proxies','files','kills')
+
+	def __init__(self):
+		self.lock=threading.Lock()
+		self.done  =dict([(name,0) for name in SGFSCleanerStats.names])
+		self.errors=dict([(name,0) for name in SGFSCleanerStats.names])
+
+	def add(self,name,count=1,error=False):
+		self.lock.acquire()
+		try:
+			if error:
+				self.errors[name]+=count
+			else:
+				self.done[name]+=count
+		finally:
+			self.lock.release()
+
+	def show(self):
+		print "[i]  "
+		print "[i] Statistics ..."
+		print "[i]  "
+		print "[i] Number of deleted bookings     : %s" % self.done['bookings']
+		print "[i] Number of deleted actions      : %s" % self.done['actions']
+		print "[i] Number of deleted transactions : %s" % self.done['transactions']
+		print "[i] Number of deleted proxies      : %s" % self.done['proxies']
+		print "[i] Number of deleted files        : %s" % self.done['files']
+		print "[i] Number of killed  processes    : %s" % self.done['kills']
+		print "[i]  "
+		print "[i] Errors ..."
+		print "[i] "
+		print "[i] Number of errored bookings     : %s" % self.errors['bookings']
+		print "[i] Number of errored actions      : %s" % self.errors['actions']
+		print "[i] Number of errored transactions : %s" % self.errors['transactions']
+		print "[i] Number of errored proxies      : %s" % self.errors['proxies']
+		print "[i] Number of errored files        : %s" % self.errors['files']
+		print "[i] Number of errored processes    : %s" % self.errors['kills']
+		print "[i]  "
+
+##
+## Pool of threads removing files and proxies
+##
+class SGFSCleanerPool:
+	def __init__(self,stats,exec_flag,workers=CLEANER_Workers):
+		self.stats=stats
+		self.exec_flag=exec_flag
+		self.queue=Queue.Queue(4*workers)
+		self.threads=[threading.Thread(target=self.run) for i in range(workers)]
+		for thread in self.threads:
+			thread.setDaemon(True)
+			thread.start()
+
+	def remove(self,name,path):
+		# name is the statistics counter: 'files' or 'proxies'
+		self.queue.put((name,path))
+
+	def join(self):
+		self.queue.join()
+
+	def run(self):
+		while True:
+			name,path=self.queue.get()
+			try:
+				self.removePath(name,path)
+			finally:
+				self.queue.task_done()
+
+	def removePath(self,name,path):
+		if not self.exec_flag:
+			print "  COMMAND: rm -rf %s" % path
+			self.stats.add(name)
+			return
+		try:
+			if os.path.isdir(path) and not os.path.islink(path):
+				shutil.rmtree(path)
+			else:
+				os.unlink(path)
+			self.stats.add(name)
+		except OSError, e:
+			print "ERROR: Unable to remove %s: %s (%s)" % (name,path,e)
+			self.stats.add(name,error=True)
+
+def is_lcg_process(pid):
+	# pid belongs to a live lcg-* command
+	try:
+		cmdline=open('/proc/%d/cmdline' % int(pid)).read()
+	except (IOError,ValueError,TypeError):
+		return False
+	return 'lcg-' in cmdline
+
+def is_server_file(path):
+	# Staged files and shared proxies are owned by the running server
+	for server_dir in (SGFS_StagingDir,SGFS_ProxyDir):
+		if os.path.abspath(path).startswith(os.path.join(server_dir,'')):
+			return True
+	return False
+
+def kill_process(pid,stats,exec_flag):
+	if not exec_flag:
+		print "    COMMAND: kill -9 %s" % pid
+		stats.add('kills')
+		return
+	try:
+		try:
+			# Commands of the server run in their own process group
+			os.killpg(int(pid),signal.SIGKILL)
+		except OSError:
+			os.kill(int(pid),signal.SIGKILL)
+		stats.add('kills')
+	except OSError:
+		print "ERROR: Unable to kill download_pid: %s" % pid
+		stats.add('kills',error=True)
+
+def get_transactions(sgfsDB,cutoff_date,last_id,chunk=CLEANER_Chunk):
+	# Next chunk of (transaction_id,transaction_proxy) older than cutoff_date
+	sgfsDB.connect()
+	cursor=sgfsDB.execute("""select transaction_id, transaction_proxy from sgfs_transactions where transaction_from < '%s' and transaction_id > %s order by transaction_id limit %s;""" % (cutoff_date,last_id,chunk))
+	transactions=cursor.fetchall()
+	sgfsDB.close()
+	return transactions
+
+def delete_rows(sgfsDB,name,sql_query,count,stats,exec_flag):
+	if not exec_flag:
+		print "QUERY: %s" % sql_query
+		stats.add(name,count)
+		return
+	try:
+		sgfsDB.connect()
+		cursor=sgfsDB.execute(sql_query)
+		sgfsDB.commit()
+		sgfsDB.close()
+		stats.add(name,cursor.rowcount)
+	except MySQLdb.Error, e:
+		print "ERROR: Unable to remove %s: %s" % (name,e)
+		stats.add(name,count,error=True)
+
+def clean_transactions(sgfsDB,transactions,pool,stats,exec_flag):
+	transaction_ids=','.join([str(transaction_id) for transaction_id,transaction_proxy in transactions])
+	print "[i] Processing transactions: %s-%s (%s)" % (transactions[0][0],transactions[-1][0],len(transactions))
+	sgfsDB.connect()
+	cursor=sgfsDB.execute("""select booking_id, download_pid from sgfs_bookings where transaction_id in (%s);""" % transaction_ids)
+	bookings=cursor.fetchall()
+	cursor=sgfsDB.execute("""select action_id, file_name from sgfs_actions where transaction_id in (%s);""" % transaction_ids)
+	actions=cursor.fetchall()
+	sgfsDB.close()
+	# Stop the downloads still running
+	for booking_id,download_pid in bookings:
+		if download_pid is not None and is_lcg_process(download_pid):
+			print "[i]   Booking %s download_pid: %s" % (booking_id,download_pid)
+			kill_process(download_pid,stats,exec_flag)
+	# Remove action files and proxies
+	for action_id,file_name in actions:
+		if file_name and os.path.exists(file_name) and not is_server_file(file_name):
+			pool.remove('files',file_name)
+	for transaction_id,transaction_proxy in transactions:
+		if transaction_proxy and os.path.isfile(transaction_proxy) and not is_server_file(transaction_proxy):
+			pool.remove('proxies',transaction_proxy)
+	pool.join()
+	# Remove the database entries
+	delete_rows(sgfsDB,'bookings',"""delete from sgfs_bookings where transaction_id in (%s);""" % transaction_ids,len(bookings),stats,exec_flag)
+	delete_rows(sgfsDB,'actions',"""delete from sgfs_actions where transaction_id in (%s);""" % transaction_ids,len(actions),stats,exec_flag)
+	delete_rows(sgfsDB,'transactions',"""delete from sgfs_transactions where transaction_id in (%s);""" % transaction_ids,len(transactions),stats,exec_flag)
+
+def refresh_cache(sgfs_url,exec_flag):
+	# Let the running server forget about the removed transactions
+	if not exec_flag:
+		print "COMMAND: GET %s/refresh_cache" % sgfs_url
+		return
+	try:
+		urllib2.urlopen("%s/refresh_cache" % sgfs_url,timeout=30).read()
+	except (urllib2.URLError,IOError), e:
+		print "ERROR: Unable to refresh the SGFS server cache at: %s (%s)" % (sgfs_url,e)
+
+def clean(cutoff_date=CLEANER_CutoffDate,exec_flag=False,sgfs_url=CLEANER_URL):
+	stats=SGFSCleanerStats()
+	pool=SGFSCleanerPool(stats,exec_flag)
+	sgfsDB=SGFSDB()
+	last_id=0
+	try:
+		while True:
+			transactions=get_transactions(sgfsDB,cutoff_date,last_id)
+			if len(transactions) == 0:
+				break
+			clean_transactions(sgfsDB,transactions,pool,stats,exec_flag)
+			last_id=transactions[-1][0]
+	finally:
+		SGFSDB.release()
+	refresh_cache(sgfs_url,exec_flag)
+	return stats
+
+def main():
+	# Only [exec|info] command line argument can override the default (info)
+	exec_flag=len(sys.argv) > 1 and sys.argv[1].lower() == 'exec'
+	cutoff_date=len(sys.argv) > 2 and sys.argv[2] or CLEANER_CutoffDate
+	sgfs_url=len(sys.argv) > 3 and sys.argv[3] or CLEANER_URL
+	print "[i]"
+	print "[i] Starting at: %s" % time.strftime('%c')
+	print "[i]"
+	print "[i] Cutoff date: %s" % cutoff_date
+	print "[i]"
+	if exec_flag:
+		print "[i] !!!"
+		print "[i] !!! EXEC FLAG is active; the script will make changes on both DB/FS"
+		print "[i] !!!"
+	else:
+		print "[i] ---"
+		print "[i] --- EXEC FLAG is off; no changes will be done on both DB/FS"
+		print "[i] ---"
+	clean(cutoff_date,exec_flag,sgfs_url).show()
+	print "[i] done at: %s" % time.strftime('%c')
+
+if __name__ == "__main__":
+	main()
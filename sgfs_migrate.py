@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#coding: utf-8
+'''
+sgfs_migrate.py - Brings an existing SGFS database to the current schema
+
+Applies, in order, the migrations/<version>_<name>.sql files whose version
+is newer than the one stored in the sgfs_schema_version table (databases
+created before that table existed are at version 0). Each migration records
+its own version once applied; databases created with the current sgfs.sql
+are already up to date. MySQL commits every DDL statement on its own, so
+migrations only change what is still missing: after a failure part-way,
+running sgfs_migrate.py again completes the migration.
+
+Usage:
+  sgfs_migrate.py [info|exec]
+
+  info - (default) shows the current version and the pending migrations
+  exec - applies the pending migrations
+
+The database connection is the one of the SGFS server (see SGFSDB).
+
+Author: Riccardo Bruno (riccardo.bruno@ct.infn.it)
+'''
+import os
+import re
+import sys
+import MySQLdb
+from sgfs import SGFSDB
+
+SGFS_MigrationsDir=os.path.join(os.path.dirname(os.path.abspath(__file__)),'migrations')
+
+def sql_statements(sql_file):
+	# Statements of a SQL script ('--' comments removed)
+	lines=[line for line in open(sql_file).read().splitlines() if not line.strip().startswith('--')]
+	return [statement.strip() for statement in '\n'.join(lines).split(';') if len(statement.strip()) > 0]
+
+def get_migrations(migrations_dir=SGFS_MigrationsDir):
+	# Sorted (version,file) of the available migrations
+	migrations=[]
+	for file_name in os.listdir(migrations_dir):
+		match=re.match(r'^(\d+)_.*\.sql$',file_name)
+		if match is not None:
+			migrations.append((int(match.group(1)),os.path.join(migrations_dir,file_name)))
+	return sorted(migrations)
+
+def get_schema_version(sgfsDB):
+	sgfsDB.connect()
+	try:
+		cursor=sgfsDB.execute("""select max(version) from sgfs_schema_version;""")
+		version=cursor.fetchone()[0] or 0
+	except MySQLdb.ProgrammingError:
+		# No version table yet
+		version=0
+	sgfsDB.close()
+	return version
+
+def migrate(sgfsDB,exec_flag=False,migrations_dir=SGFS_MigrationsDir):
+	version=get_schema_version(sgfsDB)
+	print "[i] Schema version: %s" % version
+	pending=[(migration_version,migration_file) for migration_version,migration_file in get_migrations(migrations_dir) if migration_version > version]
+	if len(pending) == 0:
+		print "[i] No pending migrations"
+		return version
+	for migration_version,migration_file in pending:
+		print "[i] Migration %s: %s" % (migration_version,os.path.basename(migration_file))
+		if not exec_flag:
+			continue
+		sgfsDB.connect()
+		for statement in sql_statements(migration_file):
+			sgfsDB.execute(statement)
+		sgfsDB.commit()
+		sgfsDB.close()
+		version=get_schema_version(sgfsDB)
+		if version != migration_version:
+			print "[e] Migration %s did not record its version (schema version: %s)" % (migration_version,version)
+			break
+	print "[i] Schema version: %s" % version
+	return version
+
+def main():
+	exec_flag=len(sys.argv) > 1 and sys.argv[1].lower() == 'exec'
+	try:
+		migrate(SGFSDB(),exec_flag)
+	finally:
+		SGFSDB.release()
+
+if __name__ == "__main__":
+	main()